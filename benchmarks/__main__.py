@@ -0,0 +1,88 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+from oci_api import oci_config
+from oci_api.version import __version__
+from .store import generate_store
+from .metadata import run_metadata_benchmarks, reset
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+        description='Metadata load, save and lookup benchmarks on a synthetic store')
+    parser.add_argument('--layers', type=int, default=1000, help='number of layers')
+    parser.add_argument('--chain', type=int, default=10, help='layers per chain (image depth)')
+    parser.add_argument('--images', type=int, default=100, help='number of images')
+    parser.add_argument('--tags', type=int, default=2, help='tags per image')
+    parser.add_argument('--containers', type=int, default=100, help='number of containers')
+    parser.add_argument('--metadata', choices=['json', 'sqlite'], default='json', 
+        help='metadata store')
+    parser.add_argument('--snapshot', action='store_true', help='enable binary snapshots')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every operation')
+    parser.add_argument('--lookups', type=int, default=1000, help='lookups per lookup run')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    parser.add_argument('--path', default=None, 
+        help='store directory (default: a temporary directory, removed at the end)')
+    parser.add_argument('--output', default=None, help='results file (default: stdout)')
+    parser.add_argument('--debug', action='store_true', help='debug logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    path = args.path or tempfile.mkdtemp(prefix='oci-benchmark-')
+    try:
+        oci_config['global']['path'] = path
+        oci_config['global']['metadata'] = 'json'
+        oci_config['global']['snapshot'] = args.snapshot
+        ids = generate_store(path, layers=args.layers, chain=args.chain, images=args.images, 
+            tags=args.tags, containers=args.containers, driver_type=oci_config['driver']['type'],
+            seed=args.seed)
+        if args.metadata == 'sqlite':
+            from oci_api.metadata import migrate_json_to_sqlite
+            migrate_json_to_sqlite()
+            oci_config['global']['metadata'] = 'sqlite'
+        reset()
+        results = run_metadata_benchmarks(ids, repeat=args.repeat, lookups=args.lookups, 
+            seed=args.seed)
+    finally:
+        reset()
+        if args.path is None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    report = {
+        'oci_api': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            key: value 
+                for key, value in vars(args).items() 
+                    if key not in ('path', 'output', 'debug')
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+if __name__ == '__main__':
+    sys.exit(main())
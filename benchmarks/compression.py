@@ -0,0 +1,157 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In process gzip (GzipWriter, GzipReader) against the gzip and pigz commands
+# it replaced, and zstd when the zstandard package is installed, run with:
+#   python -m benchmarks.compression --help
+# Throughput is uncompressed bytes per second (median run).
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from oci_api.version import __version__
+from oci_api import OCIError
+from oci_api.util.compression import GzipWriter, GzipReader, zstd_module, zstd_compressor, \
+    ZstdReader
+from .measure import measure
+from .hashing import parse_size
+
+def generate_file(file_path, size):
+    # Half random, half repeated text: compresses about as well as a layer
+    text = b''.join(b'%08i some text of a configuration file\n' % index for index in range(25000))
+    with open(file_path, 'wb') as generated_file:
+        left = size
+        while left > 0:
+            left -= generated_file.write(os.urandom(min(len(text), left)))
+            left -= generated_file.write(text[:max(left, 0)])
+
+def command_compress(command, file_path, compressed_file_path):
+    with open(compressed_file_path, 'wb') as compressed_file:
+        subprocess.run(command + ['--stdout', str(file_path)], stdout=compressed_file, check=True)
+
+def command_uncompress(command, compressed_file_path):
+    subprocess.run(command + ['-d', '--stdout', str(compressed_file_path)],
+        stdout=subprocess.DEVNULL, check=True)
+
+def gzip_compress(file_path, compressed_file_path, threads):
+    with open(file_path, 'rb') as uncompressed_file, open(compressed_file_path, 'wb') as compressed_file:
+        with GzipWriter(compressed_file, threads=threads) as writer:
+            shutil.copyfileobj(uncompressed_file, writer, 1 << 20)
+
+def gzip_uncompress(compressed_file_path):
+    with open(compressed_file_path, 'rb') as compressed_file, GzipReader(compressed_file) as reader:
+        while len(reader.read(1 << 20)) > 0:
+            pass
+
+def zstd_compress(file_path, compressed_file_path, threads):
+    with open(file_path, 'rb') as uncompressed_file, open(compressed_file_path, 'wb') as compressed_file:
+        with zstd_compressor(compressed_file, threads=threads) as writer:
+            shutil.copyfileobj(uncompressed_file, writer, 1 << 20)
+
+def zstd_uncompress(compressed_file_path):
+    with open(compressed_file_path, 'rb') as compressed_file, ZstdReader(compressed_file) as reader:
+        while len(reader.read(1 << 20)) > 0:
+            pass
+
+def throughput(result, size):
+    result['throughput'] = size / result['median']
+    return result
+
+def run_compression_benchmarks(path, size, threads=[1, 4, 16], repeat=5):
+    file_path = os.path.join(path, 'file')
+    compressed_file_path = os.path.join(path, 'file.gz')
+    generate_file(file_path, size)
+    results = {'size': size}
+    for command in ['gzip', 'pigz']:
+        if shutil.which(command) is None:
+            continue
+        results[command] = {
+            'compress': throughput(measure(
+                lambda: command_compress([command], file_path, compressed_file_path), repeat), size),
+            'compressed_size': os.path.getsize(compressed_file_path),
+            'uncompress': throughput(measure(
+                lambda: command_uncompress([command], compressed_file_path), repeat), size)
+        }
+    for thread_count in threads:
+        results['threads_%i' % thread_count] = {
+            'compress': throughput(measure(
+                lambda: gzip_compress(file_path, compressed_file_path, thread_count), repeat), size),
+            'compressed_size': os.path.getsize(compressed_file_path),
+            # Single thread inflate plus the read ahead thread
+            'uncompress': throughput(measure(
+                lambda: gzip_uncompress(compressed_file_path), repeat), size)
+        }
+    try:
+        zstd_module()
+    except OCIError:
+        return results
+    for thread_count in threads:
+        results['zstd_threads_%i' % thread_count] = {
+            'compress': throughput(measure(
+                lambda: zstd_compress(file_path, compressed_file_path, thread_count), repeat), size),
+            'compressed_size': os.path.getsize(compressed_file_path),
+            'uncompress': throughput(measure(
+                lambda: zstd_uncompress(compressed_file_path), repeat), size)
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.compression',
+        description='In process block parallel gzip and zstd against the gzip and pigz commands')
+    parser.add_argument('--size', default='256M', help='file size, with K, M or G suffix')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16],
+        help='compression threads of the in process runs')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every operation')
+    parser.add_argument('--path', default=None,
+        help='directory of the files (default: a temporary directory, removed at the end)')
+    parser.add_argument('--output', default=None, help='results file (default: stdout)')
+    parser.add_argument('--debug', action='store_true', help='debug logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    path = args.path or tempfile.mkdtemp(prefix='oci-benchmark-')
+    try:
+        results = run_compression_benchmarks(path, parse_size(args.size), threads=args.threads,
+            repeat=args.repeat)
+    finally:
+        if args.path is None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    report = {
+        'oci_api': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {
+            key: value
+                for key, value in vars(args).items()
+                    if key not in ('path', 'output', 'debug')
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Changeset extraction (ChangesetExtractor) with a thread pool against the
+# calling thread only and against tarfile.extractall, run with:
+#   python -m benchmarks.extraction --help
+# The changeset is many small files, as the layers of a distribution are.
+
+import io
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import tarfile
+import argparse
+import platform
+import tempfile
+from oci_api.version import __version__
+from oci_api.graph.changeset import ChangesetExtractor
+from .measure import measure
+
+def generate_changeset(changeset_file_path, files, directories):
+    # Sizes of 0 to 16 KB, a few larger ones
+    generator = random.Random(files)
+    with tarfile.open(changeset_file_path, 'w') as tar_file:
+        for index in range(directories):
+            tar_info = tarfile.TarInfo('usr/share/%04i' % index)
+            tar_info.type = tarfile.DIRTYPE
+            tar_info.mode = 0o755
+            tar_file.addfile(tar_info)
+        for index in range(files):
+            size = generator.randint(0, 16 << 10) if index % 100 else 1 << 20
+            tar_info = tarfile.TarInfo('usr/share/%04i/%08i' % (index % directories, index))
+            tar_info.size = size
+            tar_info.mode = 0o644
+            tar_file.addfile(tar_info, fileobj=io.BytesIO(os.urandom(size)))
+
+def extract(changeset_file_path, path, threads):
+    with tarfile.open(changeset_file_path, 'r|') as tar_file:
+        ChangesetExtractor(path, threads).extract(tar_file)
+
+def extractall(changeset_file_path, path):
+    with tarfile.open(changeset_file_path, 'r|') as tar_file:
+        tar_file.extractall(path)
+
+def run_extraction_benchmarks(path, files, directories=100, threads=[1, 4, 16], repeat=5):
+    changeset_file_path = os.path.join(path, 'changeset.tar')
+    generate_changeset(changeset_file_path, files, directories)
+    target_path = os.path.join(path, 'target')
+    clean = lambda: shutil.rmtree(target_path, ignore_errors=True)
+    results = {
+        'files': files,
+        'size': os.path.getsize(changeset_file_path),
+        'extractall': measure(lambda: extractall(changeset_file_path, target_path), repeat,
+            setup=clean)
+    }
+    for thread_count in threads:
+        results['threads_%i' % thread_count] = measure(
+            lambda: extract(changeset_file_path, target_path, thread_count), repeat, setup=clean)
+    clean()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.extraction',
+        description='Parallel changeset extraction against tarfile')
+    parser.add_argument('--files', type=int, default=20000, help='files of the changeset')
+    parser.add_argument('--directories', type=int, default=100, help='directories of the files')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16],
+        help='extraction threads (1 is the calling thread only)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every operation')
+    parser.add_argument('--path', default=None,
+        help='directory of the files (default: a temporary directory, removed at the end)')
+    parser.add_argument('--output', default=None, help='results file (default: stdout)')
+    parser.add_argument('--debug', action='store_true', help='debug logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    path = args.path or tempfile.mkdtemp(prefix='oci-benchmark-')
+    try:
+        results = run_extraction_benchmarks(path, args.files, directories=args.directories,
+            threads=args.threads, repeat=args.repeat)
+    finally:
+        if args.path is None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    report = {
+        'oci_api': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {
+            key: value
+                for key, value in vars(args).items()
+                    if key not in ('path', 'output', 'debug')
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# sha256sum (in process, hashlib) against the sha256sum command it replaced,
+# run with:
+#   python -m benchmarks.hashing --help
+# Files are hashed from the page cache after the first run, it measures the
+# hashing, not the disk.
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from oci_api.version import __version__
+from oci_api.util.file import sha256sum, sha256sums
+from .measure import measure
+
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def parse_size(size):
+    if size[-1].upper() in UNITS:
+        return int(size[:-1]) * UNITS[size[-1].upper()]
+    return int(size)
+
+def generate_file(file_path, size):
+    # Random data (not compressible or sparse), written 1 MB at a time
+    block = os.urandom(min(size, 1 << 20)) if size > 0 else b''
+    with open(file_path, 'wb') as generated_file:
+        left = size
+        while left > 0:
+            left -= generated_file.write(block[:left])
+
+def command_sha256sum(file_path):
+    # The former implementation
+    output = subprocess.run(['sha256sum', str(file_path)], capture_output=True, check=True)
+    return output.stdout.decode('utf-8').split(' ')[0]
+
+def run_hashing_benchmarks(path, sizes, files=8, threads=None, repeat=5):
+    results = {}
+    for size in sizes:
+        file_path = os.path.join(path, 'file-%s' % size)
+        generate_file(file_path, parse_size(size))
+        expected = command_sha256sum(file_path)
+        if sha256sum(file_path) != expected or sha256sum(file_path, use_mmap=True) != expected:
+            raise RuntimeError('sha256sum of (%s) does not match the command' % file_path)
+        results[size] = {
+            'command': measure(lambda: command_sha256sum(file_path), repeat),
+            'readinto': measure(lambda: sha256sum(file_path), repeat),
+            'mmap': measure(lambda: sha256sum(file_path, use_mmap=True), repeat),
+        }
+        # Same data in `files` files, one after the other and on the pool
+        file_paths = [file_path]
+        for index in range(1, files):
+            file_paths.append('%s.%i' % (file_path, index))
+            shutil.copyfile(file_path, file_paths[-1])
+        results[size]['files'] = files
+        results[size]['sequential'] = measure(
+            lambda: [sha256sum(file_path) for file_path in file_paths], repeat)
+        results[size]['pool'] = measure(lambda: sha256sums(file_paths, threads), repeat)
+        for file_path in file_paths:
+            os.unlink(file_path)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.hashing',
+        description='In process sha256sum against the sha256sum command')
+    parser.add_argument('--sizes', nargs='+', default=['1K', '1M', '100M', '1G'],
+        help='file sizes, with K, M or G suffix (up to 10G needs that much disk, times files)')
+    parser.add_argument('--files', type=int, default=8, help='files hashed by the thread pool')
+    parser.add_argument('--threads', type=int, default=None, help='thread pool size')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every operation')
+    parser.add_argument('--path', default=None,
+        help='directory of the files (default: a temporary directory, removed at the end)')
+    parser.add_argument('--output', default=None, help='results file (default: stdout)')
+    parser.add_argument('--debug', action='store_true', help='debug logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    path = args.path or tempfile.mkdtemp(prefix='oci-benchmark-')
+    try:
+        results = run_hashing_benchmarks(path, args.sizes, files=args.files,
+            threads=args.threads, repeat=args.repeat)
+    finally:
+        if args.path is None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    report = {
+        'oci_api': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {
+            key: value
+                for key, value in vars(args).items()
+                    if key not in ('path', 'output', 'debug')
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gc
+import sys
+import time
+import statistics
+import tracemalloc
+
+def measure(function, repeat=5, setup=None):
+    # Wall time of every run, then one more run under tracemalloc for the peak
+    # memory and the net memory (bytes and blocks) the operation left
+    # allocated. Allocations freed during the run are not in the net values,
+    # transient_memory (peak minus net) is the most memory that was allocated
+    # and freed again at a time. The number of allocations made is not known
+    # to the stdlib. setup runs before every run and is not measured.
+    times = []
+    for index in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        function()
+        (current, peak) = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    return {
+        'repeat': repeat,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'peak_memory': peak,
+        'net_memory': current,
+        'transient_memory': peak - current,
+        'net_traced_blocks': sum(statistic.count for statistic in snapshot.statistics('filename')),
+        'net_allocated_blocks': sys.getallocatedblocks() - blocks
+    }
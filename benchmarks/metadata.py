@@ -0,0 +1,78 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import random
+import logging
+from oci_api import oci_config
+from oci_api.util import Singleton
+from .measure import measure
+
+log = logging.getLogger(__name__)
+
+def reset():
+    # Forget the loaded stores, next Driver(), Distribution() and Runtime()
+    # load them from disk
+    for cls in list(Singleton._instances):
+        if cls.__name__ in ('Driver', 'Distribution', 'Runtime', 'Database'):
+            del Singleton._instances[cls]
+
+def run_metadata_benchmarks(ids, repeat=5, lookups=1000, seed=None):
+    from oci_api.graph import Driver
+    from oci_api.image import Distribution
+    from oci_api.runtime import Runtime
+    rng = random.Random(seed)
+    def sample(values):
+        if len(values) == 0:
+            return []
+        return [rng.choice(values) for index in range(lookups)]
+    results = {}
+
+    def load_driver():
+        reset()
+        Driver()
+    results['driver_load'] = measure(load_driver, repeat)
+    if oci_config['global']['metadata'] == 'json':
+        results['driver_save'] = measure(lambda: Driver().save(), repeat)
+    layer_ids = sample(ids['layers'])
+    results['driver_get_layer'] = measure(
+        lambda: [Driver().get_layer(layer_id) for layer_id in layer_ids], repeat)
+    diff_ids = sample(ids['diff_ids'])
+    results['driver_get_layer_by_diff_id'] = measure(
+        lambda: [Driver().get_layer_by_diff_id(diff_id) for diff_id in diff_ids], repeat)
+    container_ids = sample(ids['containers'])
+    results['driver_get_filesystem_by_container_id'] = measure(
+        lambda: [Driver().get_filesystem_by_container_id(container_id) for container_id in container_ids],
+        repeat)
+
+    def load_distribution():
+        Singleton._instances.pop(Distribution, None)
+        Distribution()
+    results['distribution_load'] = measure(load_distribution, repeat)
+    if oci_config['global']['metadata'] == 'json':
+        results['distribution_save'] = measure(lambda: Distribution().save(), repeat)
+    tags = sample(ids['tags'])
+    results['distribution_get_image'] = measure(
+        lambda: [Distribution().get_image(tag) for tag in tags], repeat)
+
+    def load_runtime():
+        Singleton._instances.pop(Runtime, None)
+        Runtime()
+    results['runtime_load'] = measure(load_runtime, repeat)
+    if oci_config['global']['metadata'] == 'json':
+        results['runtime_save'] = measure(lambda: Runtime().save(), repeat)
+    names = sample(ids['container_names'])
+    results['runtime_get_container'] = measure(
+        lambda: [Runtime().get_container(name) for name in names], repeat)
+    return results
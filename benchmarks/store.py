@@ -0,0 +1,155 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import random
+import hashlib
+import pathlib
+import logging
+from datetime import datetime, timedelta
+from oci_api.util import generate_random_sha256, generate_random_filesystem_id, id_to_digest
+
+log = logging.getLogger(__name__)
+
+LAYER_MEDIA_TYPE = 'application/vnd.oci.image.layer.v1.tar+gzip'
+CONFIG_MEDIA_TYPE = 'application/vnd.oci.image.config.v1+json'
+
+def write_json(file_path, data):
+    if not file_path.parent.is_dir():
+        file_path.parent.mkdir(parents=True)
+    data = json.dumps(data, separators=(',', ':')).encode()
+    file_path.write_bytes(data)
+    return data
+
+def generate_store(path, layers=1000, chain=10, images=100, tags=2, containers=100, 
+        driver_type='zfs', seed=None):
+    # Writes driver.json, distribution.json, runtime.json and the image
+    # manifests, configs and container configs they need, as if created by
+    # the api. Layers are committed in chains of chain layers, image i uses
+    # every layer of chain (i % number of chains) and containers are mounted
+    # on filesystems cloned from the top layer of an image.
+    # Returns the ids, for the lookup benchmarks.
+    log.debug('Start generating store (%s)' % path)
+    rng = random.Random(seed)
+    path = pathlib.Path(path)
+    filesystems_json = []
+    layers_json = []
+    chains = []
+    for index in range(layers):
+        if index % chain == 0:
+            chains.append([])
+            parent_layer_id = None
+        else:
+            parent_layer_id = chains[-1][-1]['id']
+        filesystem_id = generate_random_filesystem_id()
+        filesystem_json = {'id': filesystem_id}
+        if parent_layer_id is not None:
+            filesystem_json['layer'] = parent_layer_id
+        filesystems_json.append(filesystem_json)
+        layer_id = generate_random_sha256()
+        layer = {
+            'id': layer_id,
+            'diff_id': generate_random_sha256(),
+            'size': rng.randrange(1024, 64 * 1024 * 1024)
+        }
+        layers_json.append({
+            'descriptor': {
+                'mediaType': LAYER_MEDIA_TYPE,
+                'digest': id_to_digest(layer_id),
+                'size': layer['size'] // 3
+            },
+            'diff_id': layer['diff_id'],
+            'filesystem': filesystem_id,
+            'size': layer['size'],
+            'images': []
+        })
+        layer['json'] = layers_json[-1]
+        chains[-1].append(layer)
+    images_json = []
+    image_tags = []
+    for index in range(images if len(chains) > 0 else 0):
+        image_layers = chains[index % len(chains)]
+        config_json = {
+            'created': (datetime(2020, 1, 1) + timedelta(seconds=index)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'architecture': 'amd64',
+            'os': 'SunOS',
+            'config': {'Cmd': ['/bin/sh'], 'WorkingDir': '/'},
+            'rootfs': {'type': 'layers', 'diff_ids': [id_to_digest(layer['diff_id']) for layer in image_layers]},
+            'history': [{'created_by': 'benchmark layer %i' % position} for position in range(len(image_layers))]
+        }
+        config_data = json.dumps(config_json, separators=(',', ':')).encode()
+        config_id = hashlib.sha256(config_data).hexdigest()
+        write_json(path.joinpath('configs', config_id), config_json)
+        manifest_json = {
+            'schemaVersion': 2,
+            'config': {'mediaType': CONFIG_MEDIA_TYPE, 'digest': id_to_digest(config_id), 'size': len(config_data)},
+            'layers': [layer['json']['descriptor'] for layer in image_layers]
+        }
+        manifest_data = json.dumps(manifest_json, separators=(',', ':')).encode()
+        image_id = hashlib.sha256(manifest_data).hexdigest()
+        path.joinpath('manifests').mkdir(parents=True, exist_ok=True)
+        path.joinpath('manifests', image_id).write_bytes(manifest_data)
+        for layer in image_layers:
+            layer['json']['images'].append(image_id)
+        names = ['benchmark/image%i:tag%i' % (index, tag) for tag in range(tags)]
+        image_tags.extend(names)
+        images_json.append({'id': image_id, 'tags': names, 'top_layer': image_layers[-1]['id']})
+    containers_json = []
+    for index in range(containers if len(images_json) > 0 else 0):
+        image_json = images_json[index % len(images_json)]
+        container_id = generate_random_sha256()
+        filesystem_id = generate_random_filesystem_id()
+        filesystems_json.append({
+            'id': filesystem_id, 
+            'layer': image_json['top_layer'], 
+            'container_id': container_id
+        })
+        container_path = path.joinpath('containers', container_id)
+        write_json(container_path.joinpath('config.json'), {
+            'ociVersion': '1.0.2',
+            'process': {'terminal': True, 'user': {'uid': 0, 'gid': 0}, 'args': ['/bin/sh'], 'cwd': '/'},
+            'root': {'path': str(container_path.joinpath('rootfs')), 'readonly': False},
+            'hostname': container_id[:12],
+            'platform': {'os': 'SunOS', 'arch': 'amd64'}
+        })
+        create_time = datetime(2020, 1, 1) + timedelta(seconds=index)
+        containers_json.append({
+            'id': container_id, 
+            'name': 'benchmark_%i' % index,
+            'create_time': create_time.strftime('%Y-%m-%dT%H:%M:%S.%f000Z')
+        })
+    for layer_json in layers_json:
+        if len(layer_json['images']) == 0:
+            del layer_json['images']
+    write_json(path.joinpath('driver.json'), {
+        'type': driver_type,
+        'version': 2,
+        'sequence': 0,
+        'filesystems': filesystems_json,
+        'layers': layers_json
+    })
+    write_json(path.joinpath('distribution.json'), {
+        'images': [{'id': image_json['id'], 'tags': image_json['tags']} for image_json in images_json]
+    })
+    write_json(path.joinpath('runtime.json'), {'containers': containers_json})
+    log.debug('Finish generating store (%s)' % path)
+    return {
+        'layers': [layer['id'] for layers in chains for layer in layers],
+        'diff_ids': [layer['diff_id'] for layers in chains for layer in layers],
+        'images': [image_json['id'] for image_json in images_json],
+        'tags': image_tags,
+        'containers': [container_json['id'] for container_json in containers_json],
+        'container_names': [container_json['name'] for container_json in containers_json]
+    }
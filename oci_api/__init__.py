@@ -17,14 +17,102 @@ from .exceptions import OCIException, OCIError
 oci_config = {
     'global': {
         'path': '/var/lib/oci',
-        'run_path': '/var/run/oci'
+        'run_path': '/var/run/oci',
+        # Metadata store, either 'json' (driver.json, distribution.json and
+        # runtime.json) or 'sqlite' (metadata.db)
+        'metadata': 'json',
+        # With json metadata, keep a binary copy (.snapshot) of every json file
+        # that is read through mmap on startup instead of parsing the json.
+        # Every record is still decoded and loaded, startup time keeps growing
+        # with the store, only faster than json.
+        'snapshot': False,
+        # External commands (zfs, runc, tar...) run at the same time by the
+        # async api of one event loop
+        'concurrency': 16,
+        # In process compression of layer blobs: gzip level, zstd level and
+        # threads compressing the stream (0 is one per cpu)
+        'compression': {
+            'level': 6,
+            'zstd_level': 3,
+            'threads': 0
+        },
+        # Changeset extraction (load_changeset): threads writing the regular
+        # files up to max_file_size bytes (0 is one per cpu, 1 extracts in
+        # the calling thread), at most max_pending_size bytes read ahead
+        'extraction': {
+            'threads': 0,
+            'max_file_size': 1 << 20,
+            'max_pending_size': 64 << 20
+        }
     },
     'driver': {
+        # 'zfs', 'directory' (plain directories, for hosts without zfs) or
+        # 'overlay' (union mounts of the layer directories, Linux)
         'type': 'zfs',
+        'journal': {
+            # Compact driver.journal into driver.json after this many records
+            'max_records': 1000
+        },
         'zfs': {
             'base': 'rpool/oci',
             'compression': 'lz4',
 #            'compression': 'off',
+            # Seconds the properties read with one zfs list over base are
+            # trusted, changes made by other programs show up after that.
+            # 0 disables the cache (one zfs get per property).
+            'cache_ttl': 30,
+            'command': '/usr/sbin/zfs',
+            # Run the snapshots and destroys of a driver transaction as one zfs
+            # channel program (zfs program), needs OpenZFS 0.8 or newer
+            'channel_programs': False,
+            # Removed filesystems are renamed into base/graveyard and destroyed
+            # by background threads (reapers), removal does not wait for zfs
+            # destroy. Leftovers of a previous process are destroyed when the
+            # graveyard is used again or on Driver().reap()
+            'graveyard': False,
+            'reapers': 2,
+            # Layer blobs made by commit: 'tar' (OCI changeset) or 'send', an
+            # incremental zfs send stream that only other hosts using 'send'
+            # can load (custom media type)
+            'layer_format': 'tar',
+            # Compression of the layer blobs made by commit: 'gzip', 'zstd'
+            # (+zstd media types, needs the zstandard package) or None
+            'layer_compression': 'gzip'
+        },
+        'directory': {
+            # How the files of a layer are copied into its filesystems:
+            # 'reflink' (copy on write, btrfs or xfs with reflink=1), 'copy'
+            # (in the kernel with copy_file_range) or 'auto' (reflink if the
+            # filesystem supports it, else copy). Without reflink (ext4) every
+            # clone is a full copy of the layer, its time and space grow with
+            # the layer size; the overlay driver clones in constant time there.
+            # Files are never hardlinked to the layer, a write in place would
+            # change the layer.
+            'clone': 'auto',
+            'layer_compression': 'gzip'
+        },
+        'overlay': {
+            # 'kernel' (overlayfs, needs root), 'fuse' (fuse-overlayfs) or
+            # 'auto', the kernel as root and fuse otherwise
+            'mount': 'auto',
+            # Extra kernel mount options. Changesets are made from the upper
+            # directories, redirect_dir and metacopy have to be off.
+            'options': ['redirect_dir=off', 'metacopy=off'],
+            'fuse_command': 'fuse-overlayfs',
+            'fusermount_command': 'fusermount3',
+            'layer_compression': 'gzip'
+        },
+        'pool': {
+            # Clones of the most launched layers made ahead of time by a
+            # background thread: enough for `lead` seconds of the launches of
+            # the last `window` seconds, at most `size` per layer and
+            # `max_total` overall. 0 disables the pool. The thread runs in
+            # long running processes that call Driver().start_pool(), every
+            # process takes the clones.
+            'size': 0,
+            'max_total': 64,
+            'window': 600,
+            'lead': 60
         }
     }
 }
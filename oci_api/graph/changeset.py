@@ -0,0 +1,258 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import logging
+import collections
+import concurrent.futures
+from oci_api import oci_config, OCIError
+from oci_api.util.file import HashReader, COPY_BUFFER_SIZE
+from oci_api.util.compression import decompressor
+
+log = logging.getLogger(__name__)
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+
+def extraction_config():
+    return oci_config['global'].get('extraction', {})
+
+def remove_path(file_path):
+    # No retries, a whiteout of a missing entry is not an error
+    if os.path.isdir(file_path) and not os.path.islink(file_path):
+        shutil.rmtree(file_path)
+    elif os.path.lexists(file_path):
+        os.unlink(file_path)
+
+class ChangesetReader:
+    # Changeset of a layer blob (path or file object) as a stream: decompressed
+    # with method (None if it is not compressed) and hashed as it is read,
+    # nothing is written to disk. verify() reads what is left (the padding
+    # after the end of the tar) and checks the diff id.
+    def __init__(self, changeset, method=None, diff_id=None):
+        self.file = None
+        if isinstance(changeset, (str, os.PathLike)):
+            self.name = str(changeset)
+            self.file = open(changeset, 'rb')
+            changeset = self.file
+        else:
+            self.name = str(getattr(changeset, 'name', changeset))
+        self.decompressor = None
+        if method is not None:
+            self.decompressor = decompressor(changeset, method)
+            changeset = self.decompressor
+        self.reader = HashReader(changeset)
+        self.diff_id = diff_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        return self.reader.read(size)
+
+    @property
+    def size(self):
+        # Uncompressed bytes read so far
+        return self.reader.size
+
+    def hexdigest(self):
+        return self.reader.hexdigest()
+
+    def verify(self):
+        while len(self.reader.read(COPY_BUFFER_SIZE)) > 0:
+            pass
+        if self.diff_id is not None and self.reader.hexdigest() != self.diff_id:
+            raise OCIError('Changeset (%s) does not match diff id (%s)' % (self.name, self.diff_id))
+
+    def close(self):
+        try:
+            if self.decompressor is not None:
+                self.decompressor.close()
+        finally:
+            if self.file is not None:
+                self.file.close()
+
+class ChangesetExtractor:
+    # Extracts a changeset (OCI layer tar) into path in three stages:
+    #  1. tar headers are read in order, as a stream. Whiteouts, opaque
+    #     directories, directories, links and devices are applied right away.
+    #  2. regular files up to max_file_size are read into memory and written
+    #     (data, owner, mode, mtime) by a thread pool, at most max_pending_size
+    #     bytes are waiting. Larger files are written by stage 1.
+    #  3. owner, mode and mtime of the directories are set once everything
+    #     is written, deepest first, as tarfile.extractall does.
+    # An entry is never touched while a write to it is pending, so the tree
+    # is the same as with threads = 1 (everything in the calling thread).
+    def __init__(self, path, threads=None):
+        config = extraction_config()
+        self.path = str(path)
+        if threads is None:
+            threads = config.get('threads', 0) or os.cpu_count() or 1
+        self.threads = threads
+        self.max_file_size = config.get('max_file_size', 1 << 20)
+        self.max_pending_size = config.get('max_pending_size', 64 << 20)
+        self.executor = None
+        # Pending writes, oldest first, and the last write of every path
+        self.pending = collections.deque()
+        self.pending_size = 0
+        self.pending_paths = {}
+        self.directories = {}
+        # Names added by the changeset in every directory, opaque directories
+        # keep them
+        self.added = collections.defaultdict(set)
+        self.tar_file = None
+        self.size = 0
+
+    def extract(self, tar_file):
+        # Returns the size of the files of the changeset
+        self.tar_file = tar_file
+        if self.threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads,
+                thread_name_prefix='extract')
+        try:
+            for member in tar_file:
+                self.extract_member(member)
+            self.wait()
+        except:
+            for (file_path, future, size) in self.pending:
+                future.cancel()
+            raise
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+        self.set_directory_attributes()
+        return self.size
+
+    def target_path(self, name):
+        return os.path.join(self.path, name.rstrip('/'))
+
+    def extract_member(self, member):
+        target_path = self.target_path(member.name)
+        (dir_path, name) = os.path.split(target_path)
+        if name == OPAQUE_WHITEOUT:
+            self.wait()
+            self.opaque(member, dir_path)
+            return
+        if name.startswith(WHITEOUT_PREFIX):
+            hidden_path = os.path.join(dir_path, name[len(WHITEOUT_PREFIX):])
+            self.added[dir_path].discard(name[len(WHITEOUT_PREFIX):])
+            if not self.whiteout(member, hidden_path):
+                return
+        else:
+            self.prepare(member, target_path)
+            self.size += member.size
+        self.mark_added(target_path)
+        if member.isdir():
+            self.tar_file.extract(member, self.path, set_attrs=False)
+            self.directories[target_path] = member
+        elif member.isreg() and member.sparse is None and member.size <= self.max_file_size and \
+                self.executor is not None:
+            os.makedirs(dir_path, exist_ok=True)
+            data = self.tar_file.extractfile(member).read()
+            self.submit(member, target_path, data)
+        else:
+            if member.islnk():
+                self.wait_for(self.target_path(member.linkname))
+            self.tar_file.extract(member, self.path)
+
+    def mark_added(self, file_path):
+        # The entry and the directories above it, up to path
+        while file_path != self.path:
+            (dir_path, name) = os.path.split(file_path)
+            if name in self.added[dir_path]:
+                return
+            self.added[dir_path].add(name)
+            file_path = dir_path
+
+    def submit(self, member, target_path, data):
+        while len(self.pending) > 0 and self.pending_size + len(data) > self.max_pending_size:
+            self.complete()
+        future = self.executor.submit(self.write_file, member, target_path, data)
+        self.pending.append((target_path, future, len(data)))
+        self.pending_size += len(data)
+        self.pending_paths[target_path] = future
+
+    def write_file(self, member, target_path, data):
+        # Same as tarfile.extract of a regular file
+        with open(target_path, 'wb') as target_file:
+            target_file.write(data)
+        self.tar_file.chown(member, target_path, False)
+        self.tar_file.chmod(member, target_path)
+        self.tar_file.utime(member, target_path)
+
+    def complete(self):
+        (file_path, future, size) = self.pending.popleft()
+        self.pending_size -= size
+        if self.pending_paths.get(file_path) is future:
+            del self.pending_paths[file_path]
+        future.result()
+
+    def wait(self):
+        while len(self.pending) > 0:
+            self.complete()
+
+    def wait_for(self, file_path):
+        future = self.pending_paths.get(file_path)
+        if future is not None:
+            future.result()
+
+    def remove(self, file_path):
+        # Once no write to file_path (or below it) is pending
+        if os.path.isdir(file_path) and not os.path.islink(file_path):
+            self.wait()
+            prefix = file_path + os.sep
+            for dir_path in [ dir_path for dir_path in self.directories 
+                    if dir_path == file_path or dir_path.startswith(prefix) ]:
+                del self.directories[dir_path]
+        else:
+            self.wait_for(file_path)
+            self.directories.pop(file_path, None)
+        remove_path(file_path)
+
+    def prepare(self, member, target_path):
+        # Replaced instead of written through, as tarfile does. Directories
+        # are merged.
+        if not member.isdir() or (os.path.lexists(target_path) and 
+                (os.path.islink(target_path) or not os.path.isdir(target_path))):
+            self.remove(target_path)
+
+    def whiteout(self, member, hidden_path):
+        # Removes hidden_path, True to extract the whiteout itself too
+        self.remove(hidden_path)
+        return False
+
+    def opaque(self, member, dir_path):
+        # Hides the entries of the lower layers, entries of this changeset
+        # are kept
+        if not os.path.isdir(dir_path) or os.path.islink(dir_path):
+            return
+        added = self.added.get(dir_path, set())
+        for name in os.listdir(dir_path):
+            if name not in added:
+                self.remove(os.path.join(dir_path, name))
+
+    def set_directory_attributes(self):
+        # Deepest first, setting the mtime of a directory does not change
+        # the mtime of its parent
+        for dir_path in sorted(self.directories, reverse=True):
+            if not os.path.isdir(dir_path) or os.path.islink(dir_path):
+                continue
+            member = self.directories[dir_path]
+            self.tar_file.chown(member, dir_path, False)
+            self.tar_file.utime(member, dir_path)
+            self.tar_file.chmod(member, dir_path)
@@ -0,0 +1,259 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import logging
+import pathlib
+from oci_spec.image.v1 import MediaTypeImageLayer
+from oci_api import OCIError, oci_config
+from oci_api.util.random import generate_random_filesystem_id
+from oci_api.util.file import rm, clone_file, tree_size
+from .filesystem import Filesystem
+
+log = logging.getLogger(__name__)
+
+# Next to a pooled filesystem directory, the id of the layer it was cloned from
+POOL_SUFFIX = '.pool'
+
+# driver.directory.clone -> reflink argument of clone_file
+CLONE_MODES = {
+    'auto': 'auto',
+    'reflink': 'always',
+    'copy': 'never'
+}
+
+def filesystems_path():
+    return pathlib.Path(oci_config['global']['path'], 'filesystems')
+
+def list_pooled():
+    pooled = {}
+    for pool_path in filesystems_path().glob('*' + POOL_SUFFIX):
+        try:
+            layer_id = pool_path.read_text()
+        except FileNotFoundError:
+            continue
+        pooled.setdefault(layer_id, []).append(pool_path.name[:-len(POOL_SUFFIX)])
+    return pooled
+
+def unpool(path, layer_id):
+    # Removes the pool tag next to the filesystem directory path, also a tag
+    # left without its directory
+    pool_path = path.with_name(path.name + POOL_SUFFIX)
+    try:
+        if pool_path.read_text() != layer_id:
+            return False
+        pool_path.unlink()
+    except FileNotFoundError:
+        return False
+    return path.is_dir()
+
+def copy_metadata(path, file_stat):
+    if os.geteuid() == 0:
+        os.chown(path, file_stat.st_uid, file_stat.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(file_stat.st_mode):
+        os.chmod(path, stat.S_IMODE(file_stat.st_mode))
+    os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns), follow_symlinks=False)
+
+def clone_tree(origin_path, path, clone='auto'):
+    # Copy of the tree at origin_path keeping owners, modes, times and the
+    # hardlinks inside the tree. Regular files are copied with clone_file,
+    # never linked to the ones of origin_path: a write in place would go
+    # through to the layer.
+    if clone not in CLONE_MODES:
+        raise OCIError('Clone mode (%s) not supported' % clone)
+    links = {}
+    directories = [(path, os.lstat(origin_path))]
+    os.mkdir(path)
+    pending = [(origin_path, path)]
+    while len(pending) > 0:
+        (origin_directory, directory) = pending.pop()
+        with os.scandir(origin_directory) as entries:
+            for entry in entries:
+                file_path = os.path.join(directory, entry.name)
+                file_stat = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(file_stat.st_mode):
+                    os.mkdir(file_path)
+                    directories.append((file_path, file_stat))
+                    pending.append((entry.path, file_path))
+                    continue
+                if stat.S_ISREG(file_stat.st_mode):
+                    if file_stat.st_nlink > 1:
+                        inode = (file_stat.st_dev, file_stat.st_ino)
+                        if inode in links:
+                            os.link(links[inode], file_path)
+                            continue
+                        links[inode] = file_path
+                    clone_file(entry.path, file_path, CLONE_MODES[clone])
+                elif stat.S_ISLNK(file_stat.st_mode):
+                    os.symlink(os.readlink(entry.path), file_path)
+                else:
+                    try:
+                        os.mknod(file_path, file_stat.st_mode, file_stat.st_rdev)
+                    except PermissionError:
+                        log.warning('Could not create special file (%s), skipping' % file_path)
+                        continue
+                copy_metadata(file_path, file_stat)
+    # Deepest first, creating their entries changed the times of directories
+    for (directory, file_stat) in reversed(directories):
+        copy_metadata(directory, file_stat)
+
+def is_modified(file_path, file_stat, origin_file_path, origin_stat):
+    # Quick check as rsync does, metadata and size/mtime, not contents
+    if (file_stat.st_mode, file_stat.st_uid, file_stat.st_gid, file_stat.st_mtime_ns) != \
+            (origin_stat.st_mode, origin_stat.st_uid, origin_stat.st_gid, origin_stat.st_mtime_ns):
+        return True
+    if stat.S_ISREG(file_stat.st_mode):
+        return file_stat.st_size != origin_stat.st_size
+    if stat.S_ISLNK(file_stat.st_mode):
+        return os.readlink(file_path) != os.readlink(origin_file_path)
+    if stat.S_ISCHR(file_stat.st_mode) or stat.S_ISBLK(file_stat.st_mode):
+        return file_stat.st_rdev != origin_stat.st_rdev
+    return False
+
+def scan_directory(directory):
+    with os.scandir(directory) as entries:
+        return { entry.name: entry.stat(follow_symlinks=False) for entry in entries }
+
+def diff_tree(path, origin_path=None):
+    # Implemented as generator, same records as zfs_diff: ['-', path] for a
+    # removed entry (not its contents), ['+', path] for an added one and
+    # ['M', path] for a modified one. A changed file type is removed and added.
+    # Names are sorted, the same trees always give the same changeset.
+    pending = [(str(path), None if origin_path is None else str(origin_path))]
+    while len(pending) > 0:
+        (directory, origin_directory) = pending.pop()
+        entries = scan_directory(directory)
+        origin_entries = {}
+        if origin_directory is not None:
+            origin_entries = scan_directory(origin_directory)
+        for name in sorted(origin_entries.keys() - entries.keys()):
+            yield ['-', os.path.join(directory, name)]
+        directories = []
+        for name in sorted(entries):
+            file_path = os.path.join(directory, name)
+            file_stat = entries[name]
+            origin_file_path = None
+            origin_stat = origin_entries.get(name)
+            if origin_stat is not None:
+                origin_file_path = os.path.join(origin_directory, name)
+                if stat.S_IFMT(file_stat.st_mode) != stat.S_IFMT(origin_stat.st_mode):
+                    yield ['-', file_path]
+                    origin_file_path = None
+            if origin_file_path is None:
+                yield ['+', file_path]
+            elif is_modified(file_path, file_stat, origin_file_path, origin_stat):
+                yield ['M', file_path]
+            if stat.S_ISDIR(file_stat.st_mode):
+                directories.append((file_path, origin_file_path))
+        pending.extend(reversed(directories))
+
+class DirectoryFilesystem(Filesystem):
+    # Filesystems are plain directories under filesystems/, for hosts without
+    # zfs. A filesystem of a layer is a copy of the layer's directory made of
+    # reflinks where the filesystem supports them (btrfs, xfs) so cloning
+    # does not copy data, elsewhere a full copy, see driver.directory.clone. Mounting moves the
+    # directory to the container and leaves a symlink to it behind.
+    @classmethod
+    def create(cls, layer, pooled=False):
+        filesystem_id = generate_random_filesystem_id()
+        path = filesystems_path().joinpath(filesystem_id)
+        if not path.parent.is_dir():
+            path.parent.mkdir(parents=True)
+        if layer is None:
+            log.debug('Creating filesystem (%s)' % path)
+            path.mkdir(mode=0o755)
+        else:
+            origin_path = layer.filesystem.path
+            log.debug('Cloning filesystem (%s) from (%s)' % (path, origin_path))
+            try:
+                clone_tree(origin_path, path, oci_config['driver']['directory'].get('clone', 'auto'))
+            except OSError as e:
+                rm(path, recursive=True)
+                raise OCIError('Could not clone filesystem (%s) from (%s): %s' % (path, origin_path, e))
+        if pooled:
+            path.with_name(filesystem_id + POOL_SUFFIX).write_text(layer.id)
+        return Filesystem(filesystem_id, layer, None)
+
+    @classmethod
+    def receive(cls, layer, changeset, media_type):
+        if media_type != MediaTypeImageLayer:
+            raise OCIError('Layer media type (%s) not supported by directory driver' % media_type)
+        filesystem = cls.create(layer)
+        try:
+            filesystem.load_changeset(changeset)
+        except:
+            filesystem.destroy()
+            raise
+        return filesystem
+
+    @classmethod
+    def list_pooled(cls):
+        return list_pooled()
+
+    @property
+    def link_path(self):
+        return filesystems_path().joinpath(self.id)
+
+    @property
+    def path(self):
+        link_path = self.link_path
+        if link_path.is_symlink():
+            return pathlib.Path(os.readlink(link_path))
+        return link_path
+
+    def unpool(self, layer_id):
+        return unpool(self.link_path, layer_id)
+
+    def size(self):
+        return tree_size(self.path)
+
+    def virtual_size(self):
+        # Reflinked blocks are shared with the layer, not known here
+        return self.size()
+
+    def destroy(self):
+        path = self.path
+        if rm(path, recursive=True) != 0:
+            raise OCIError('Could not destroy filesystem (%s)' % path)
+        if self.link_path.is_symlink():
+            self.link_path.unlink()
+        rm(self.link_path.with_name(self.id + POOL_SUFFIX))
+
+    def commit(self, changeset_file):
+        # The directory stays where it is as the origin of the clones
+        self.save_changeset(changeset_file)
+
+    def diff(self):
+        origin_path = None
+        if self.layer is not None:
+            origin_path = self.layer.filesystem.path
+        return diff_tree(self.path, origin_path)
+
+    def mount(self, container_id, path):
+        if self.is_mounted_for(container_id, path):
+            return
+        self.container_id = container_id
+        try:
+            # Replaces path if it is an empty directory
+            os.rename(self.link_path, path)
+        except OSError as e:
+            raise OCIError('Could not move filesystem (%s) to (%s): %s' % (self.id, path, e))
+        os.symlink(path, self.link_path)
+
+    def unmount(self, container_id):
+        path = self.path
+        link_path = self.prepare_unmount(container_id)
+        link_path.unlink()
+        os.rename(path, link_path)
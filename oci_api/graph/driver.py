@@ -16,27 +16,78 @@
 import pathlib
 import logging
 import json
-from oci_spec.image.v1 import Descriptor
+import threading
+import collections
+import contextlib
+import contextvars
 from oci_api import oci_config, OCIError
 from oci_api.util import Singleton, generate_random_sha256
-from .filesystem import Filesystem
+from oci_api.util.journal import Journal
+from oci_api.util.lock import FileLock
+from oci_api.util.file import atomic_write, file_stamp
+from oci_api.util.snapshot import Snapshot, write_snapshot
+from oci_api.util.process import current_task, run_blocking
+from oci_api.metadata import Database
+from .filesystem import Filesystem, get_filesystem_class
 from .layer import Layer
+from .pool import FilesystemPool
 from .exceptions import FilesystemInUseException, FilesystemUnknownException, \
     LayerInUseException, LayerUnknownException
 
 log = logging.getLogger(__name__)
 
+def descriptor_to_row(descriptor):
+    # Snapshot row for a descriptor json: media type, digest, size and the
+    # json of any other field
+    others = {
+        key: value 
+            for key, value in descriptor.items() 
+                if key not in ('mediaType', 'digest', 'size')
+    }
+    return (descriptor['mediaType'], descriptor['digest'], descriptor['size'], 
+        json.dumps(others) if len(others) > 0 else None)
+
+def descriptor_from_row(media_type, digest, size, others):
+    descriptor = {'mediaType': media_type, 'digest': digest, 'size': size}
+    if others is not None:
+        descriptor.update(json.loads(others))
+    return descriptor
+
 class Driver(metaclass=Singleton):
     def __init__(self):
         super().__init__()
         log.debug('Creating instance of %s()' % type(self).__name__)
         self.filesystems = None
+        self.sequence = 0
         driver_path = pathlib.Path(oci_config['global']['path'])
         driver_file_path = driver_path.joinpath('driver.json')
-        if driver_file_path.is_file():
-            self.load()
-        else:
-            self.create()
+        self.journal = Journal(driver_path.joinpath('driver.journal'))
+        self.lock = FileLock(driver_path.joinpath('driver.lock'))
+        self.stamp = None
+        self.generation = None
+        self.database = None
+        # Guards the in memory state, zfs work runs without holding it
+        self.mutex = threading.RLock()
+        # Per thread (or asyncio task) transaction state
+        self.current_transaction = contextvars.ContextVar('transaction', default=None)
+        # Records of the changes made in memory, oldest first, waiting for
+        # the transactions they (or older ones) belong to
+        self.unpersisted = collections.deque()
+        # filesystem id -> thread or asyncio task working on it (mount,
+        # unmount, commit, destroy)
+        self.busy = {}
+        # layer id -> number of filesystems being cloned from it
+        self.cloning = {}
+        self.pool = None
+        if oci_config['driver'].get('pool', {}).get('size', 0) > 0:
+            self.pool = FilesystemPool(self)
+        if oci_config['global']['metadata'] == 'sqlite':
+            self.database = Database()
+        elif not driver_file_path.is_file():
+            with self.lock.exclusive():
+                if not driver_file_path.is_file():
+                    self.create()
+        self.refresh()
 
     def create(self):
         driver_path = pathlib.Path(oci_config['global']['path'])
@@ -46,8 +97,7 @@ class Driver(metaclass=Singleton):
             raise OCIError('Driver file (%s) already exist' % driver_file_path)
         if self.filesystems is not None:
             raise OCIError('Driver filesystems is already initialized' % driver_file_path)        
-        self.filesystems = {}
-        self.layers = {}
+        self.init_indexes()
         self.save()
 
     def load(self):
@@ -58,37 +108,383 @@ class Driver(metaclass=Singleton):
             raise OCIError('Driver file (%s) does not exist' % driver_file_path)
         if self.filesystems is not None:
             raise OCIError('Driver filesystems is already initialized' % driver_file_path)        
+        self.stamp = file_stamp(driver_file_path)
+        if self.load_snapshot():
+            self.load_journal()
+            log.debug('Finish loading driver file (%s)' % driver_file_path)
+            return
         with driver_file_path.open() as driver_file:
             driver_json = json.load(driver_file)
             if oci_config['driver']['type'] != driver_json['type']:
                 # Convertion between drivers
                 raise NotImplementedError()
-            self.filesystems = {}
-            self.layers = {}
-            for filesystem_json in driver_json.get('filesystems', []):
-                self.load_filesystem(filesystem_json)
+            self.init_indexes()
+            self.sequence = driver_json.get('sequence', 0)
+            if driver_json.get('version', 1) >= 2:
+                self.load_rows(
+                    (
+                        (filesystem_json['id'], filesystem_json.get('layer'), 
+                            filesystem_json.get('container_id'))
+                            for filesystem_json in driver_json['filesystems']
+                    ),
+                    (
+                        (layer_json['descriptor'], layer_json['diff_id'], layer_json['filesystem'], 
+                            layer_json['size'], layer_json.get('images', []))
+                            for layer_json in driver_json['layers']
+                    )
+                )
+            else:
+                self.load_nested(driver_json.get('filesystems', []))
+        self.save_snapshot()
+        self.load_journal()
         log.debug('Finish loading driver file (%s)' % driver_file_path)
 
-    def load_filesystem(self, filesystem_json, layer=None):
-        filesystem_id = filesystem_json['id']
-        log.debug('Loading filesystem (%s)' % filesystem_id)
-        container_id = filesystem_json.get('container_id', None)
-        filesystem = Filesystem(filesystem_id, layer, container_id)
-        layer_json = filesystem_json.get('layer')
-        if layer_json is not None:
-            self.load_layer(layer_json, filesystem)
-        self.filesystems[filesystem_id] = filesystem
-
-    def load_layer(self, layer_json, filesystem):
-        layer_descriptor = Descriptor.from_json(layer_json['descriptor'])
-        log.debug('Loading layer (%s)' % layer_descriptor.get('Digest').encoded())
-        diff_id = layer_json['diff_id']
-        size = layer_json['size']
-        images = layer_json.get('images', [])
-        layer = Layer(layer_descriptor, diff_id, filesystem, size, images)
+    def load_snapshot(self):
+        # Returns False if snapshots are disabled or driver.snapshot is missing
+        # or older than driver.json, the caller falls back to the json file
+        if not oci_config['global']['snapshot']:
+            return False
+        driver_path = pathlib.Path(oci_config['global']['path'])
+        snapshot = Snapshot.open(driver_path.joinpath('driver.snapshot'), self.stamp)
+        if snapshot is None:
+            return False
+        log.debug('Start loading driver snapshot (%s)' % snapshot.file_path)
+        with snapshot:
+            settings = dict(snapshot.rows(0))
+            if oci_config['driver']['type'] != settings['type']:
+                # Convertion between drivers
+                raise NotImplementedError()
+            self.init_indexes()
+            self.sequence = snapshot.sequence
+            images = {}
+            for layer_index, image_id in snapshot.rows(3):
+                images.setdefault(layer_index, []).append(image_id)
+            self.load_rows(
+                snapshot.rows(1),
+                (
+                    (descriptor_from_row(*row[:4]), row[4], row[5], row[6], images.get(layer_index, []))
+                        for layer_index, row in enumerate(snapshot.rows(2))
+                )
+            )
+        log.debug('Finish loading driver snapshot (%s)' % snapshot.file_path)
+        return True
+
+    def save_snapshot(self):
+        if not oci_config['global']['snapshot']:
+            return
+        driver_path = pathlib.Path(oci_config['global']['path'])
+        layers = list(self.layers.values())
+        try:
+            write_snapshot(driver_path.joinpath('driver.snapshot'), self.stamp, self.sequence, [
+                ('ss', [('type', oci_config['driver']['type'])]),
+                ('sss', (
+                    (filesystem.id, filesystem.layer.id if filesystem.layer is not None else None,
+                        filesystem.container_id)
+                        for filesystem in self.filesystems.values()
+                )),
+                ('ssqsssq', (
+                    descriptor_to_row(layer.descriptor_to_dict()) + 
+                        (layer.diff_id, layer.filesystem.id, layer.size)
+                        for layer in layers
+                )),
+                ('qs', (
+                    (layer_index, image_id)
+                        for layer_index, layer in enumerate(layers)
+                            for image_id in layer.images
+                ))
+            ])
+        except OSError as e:
+            # Only an optimization, loading keeps working from the json file
+            log.warning('Could not write driver snapshot: %s' % e)
+
+    def init_indexes(self):
+        self.filesystems = {}
+        self.layers = {}
+        self.layers_by_diff_id = {}
+        self.filesystems_by_container_id = {}
+        # filesystem id -> layer committed from that filesystem
+        self.child_layers = {}
+        # layer id -> {filesystem id: filesystem} cloned from that layer
+        self.child_filesystems = {}
+
+    def insert_filesystem(self, filesystem):
+        self.filesystems[filesystem.id] = filesystem
+        if filesystem.container_id is not None:
+            self.filesystems_by_container_id[filesystem.container_id] = filesystem
+        if filesystem.layer is not None:
+            self.child_filesystems[filesystem.layer.id][filesystem.id] = filesystem
+
+    def delete_filesystem(self, filesystem):
+        del self.filesystems[filesystem.id]
+        if filesystem.container_id is not None:
+            del self.filesystems_by_container_id[filesystem.container_id]
+        if filesystem.layer is not None:
+            child_filesystems = self.child_filesystems.get(filesystem.layer.id)
+            if child_filesystems is not None:
+                del child_filesystems[filesystem.id]
+
+    def set_container_id(self, filesystem, container_id):
+        if filesystem.container_id is not None:
+            self.filesystems_by_container_id.pop(filesystem.container_id, None)
+        filesystem.container_id = container_id
+        if container_id is not None:
+            self.filesystems_by_container_id[container_id] = filesystem
+
+    def insert_layer(self, layer):
         self.layers[layer.id] = layer
-        for filesystem_json in layer_json.get('filesystems', []):
-            self.load_filesystem(filesystem_json, layer)
+        self.layers_by_diff_id[layer.diff_id] = layer
+        self.child_layers[layer.filesystem.id] = layer
+        self.child_filesystems[layer.id] = {}
+
+    def delete_layer(self, layer_id, diff_id, filesystem_id):
+        # Layer.destroy() clears the layer attributes, so take them as arguments
+        del self.layers[layer_id]
+        del self.layers_by_diff_id[diff_id]
+        del self.child_layers[filesystem_id]
+        del self.child_filesystems[layer_id]
+
+    def load_database(self):
+        log.debug('Start loading driver database (%s)' % self.database.file_path)
+        if self.filesystems is not None:
+            raise OCIError('Driver filesystems is already initialized')
+        driver_type = self.database.get_setting('driver_type')
+        if driver_type is None:
+            self.database.set_setting('driver_type', oci_config['driver']['type'])
+        elif oci_config['driver']['type'] != driver_type:
+            # Convertion between drivers
+            raise NotImplementedError()
+        self.generation = self.database.get_generation('driver')
+        self.init_indexes()
+        images = {}
+        for layer_id, image_id in self.database.select(
+                'SELECT layer_id, image_id FROM image_references ORDER BY rowid'):
+            images.setdefault(layer_id, []).append(image_id)
+        self.load_rows(
+            self.database.select('SELECT id, layer_id, container_id FROM filesystems ORDER BY rowid'),
+            (
+                (json.loads(descriptor), diff_id, filesystem_id, size, images.get(layer_id, []))
+                    for layer_id, descriptor, diff_id, filesystem_id, size in self.database.select(
+                        'SELECT id, descriptor, diff_id, filesystem_id, size FROM layers ORDER BY rowid')
+            )
+        )
+        log.debug('Finish loading driver database (%s)' % self.database.file_path)
+
+    def refresh(self):
+        # Pick up the changes made by other processes since the last load,
+        # a rewritten driver.json (compaction) or database means a full reload
+        with self.mutex, self.lock.shared():
+            if self.database is not None:
+                if self.filesystems is None or \
+                        self.database.get_generation('driver') != self.generation:
+                    self.filesystems = None
+                    self.load_database()
+                return
+            driver_path = pathlib.Path(oci_config['global']['path'])
+            driver_file_path = driver_path.joinpath('driver.json')
+            if self.filesystems is None or file_stamp(driver_file_path) != self.stamp:
+                self.filesystems = None
+                self.load()
+            elif self.journal.size() != self.journal.offset:
+                self.load_journal(tail=True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.mutex, self.lock.exclusive():
+            self.refresh()
+            yield self
+
+    def get_owner(self):
+        task = current_task()
+        if task is not None:
+            return task
+        return threading.get_ident()
+
+    def reserve_filesystem(self, filesystem):
+        # Called with the driver locked, keeps other threads away from the
+        # filesystem while its (slow) zfs work runs unlocked. Returns False if
+        # the calling thread already had it reserved.
+        owner = self.busy.get(filesystem.id)
+        if owner == self.get_owner():
+            return False
+        if owner is not None:
+            raise FilesystemInUseException('Filesystem (%s) is busy' % filesystem.id)
+        self.busy[filesystem.id] = self.get_owner()
+        return True
+
+    def release_filesystem(self, filesystem_id):
+        with self.mutex:
+            del self.busy[filesystem_id]
+
+    def reap(self, wait=False):
+        # Destroys the filesystems left behind by deferred destroys (zfs
+        # graveyard) of this or a previous process
+        get_filesystem_class().reap(wait)
+
+    def get_transaction(self):
+        return self.current_transaction.get()
+
+    def load_journal(self, tail=False):
+        # Records older than the snapshot are left over from a compaction
+        # interrupted between writing driver.json and truncating the journal
+        for record in self.journal.replay(tail):
+            if record['sequence'] > self.sequence:
+                self.replay_record(record)
+                self.sequence = record['sequence']
+
+    def replay_record(self, record):
+        operation = record['operation']
+        if operation == 'create_filesystem':
+            layer = None
+            if record['layer'] is not None:
+                layer = self.layers[record['layer']]
+            self.insert_filesystem(Filesystem(record['id'], layer, None))
+        elif operation == 'mount_filesystem':
+            self.set_container_id(self.filesystems[record['id']], record['container_id'])
+        elif operation == 'unmount_filesystem':
+            self.set_container_id(self.filesystems[record['id']], None)
+        elif operation == 'remove_filesystem':
+            self.delete_filesystem(self.filesystems[record['id']])
+        elif operation == 'create_layer':
+            filesystem = self.filesystems[record['filesystem']]
+            layer = Layer(record['descriptor'], record['diff_id'], filesystem, record['size'], [])
+            self.insert_layer(layer)
+        elif operation == 'remove_layer':
+            layer = self.layers[record['id']]
+            self.delete_layer(layer.id, layer.diff_id, layer.filesystem.id)
+        elif operation == 'add_image_reference':
+            self.layers[record['layer']].add_image_reference(record['image'])
+        elif operation == 'remove_image_reference':
+            self.layers[record['layer']].remove_image_reference(record['image'])
+        else:
+            raise OCIError('Unknown driver journal operation (%s)' % operation)
+
+    def write_record(self, operation, **arguments):
+        # Called with the driver locked, right after the change was applied in
+        # memory. Records are persisted in that order: the record of a change
+        # made inside a transaction, and every record after it, waits for the
+        # end of the transaction. Returns the entry of the record.
+        record = {'operation': operation}
+        record.update(arguments)
+        entry = {'record': record, 'done': False}
+        self.unpersisted.append(entry)
+        transaction = self.get_transaction()
+        if transaction is not None:
+            transaction['entries'].append(entry)
+        else:
+            entry['done'] = True
+            self.persist_done()
+        return entry
+
+    def persist_done(self):
+        # Persists the oldest records up to the first one of a transaction
+        # still open
+        records = []
+        while len(self.unpersisted) > 0 and self.unpersisted[0]['done']:
+            record = self.unpersisted.popleft()['record']
+            if record is not None:
+                records.append(record)
+        self.persist_records(records)
+
+    def persist_records(self, records):
+        # Sequence numbers are given at persist time, in the order the changes
+        # were made
+        if len(records) == 0:
+            return
+        for record in records:
+            self.sequence += 1
+            record['sequence'] = self.sequence
+        if self.database is not None:
+            self.generation = self.database.write_records(records, 'driver')
+            return
+        self.journal.append(records)
+        # driver.json is written from memory, it must not hold changes whose
+        # records are not persisted yet
+        if self.journal.length >= oci_config['driver']['journal']['max_records'] and \
+                len(self.unpersisted) == 0:
+            self.save()
+
+    def add_undo(self, entry, function, *args):
+        # Changes that are only metadata (image references) are undone if the
+        # transaction fails, their records are dropped
+        transaction = self.get_transaction()
+        if transaction is not None:
+            transaction['undo'].append((entry, function, args))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Defers persistence of every change made inside the block to a single
+        # write at the end, nested transactions are merged into the outer one.
+        # On exception the changes that are only metadata are rolled back in
+        # memory, the others were made to the filesystems (zfs datasets, layer
+        # files) before they were recorded and are written all the same, so
+        # the metadata keeps matching them.
+        # Transactions are per thread (or asyncio task), other processes are
+        # kept out for the whole transaction while other threads only wait for
+        # in memory changes. Their records wait for the transaction.
+        if self.get_transaction() is not None:
+            yield self
+            return
+        with self.lock.exclusive():
+            log.debug('Start driver transaction')
+            transaction = {'entries': [], 'undo': []}
+            token = self.current_transaction.set(transaction)
+            try:
+                with get_filesystem_class().batch():
+                    yield self
+            except BaseException:
+                log.debug('Rolling back driver transaction metadata')
+                with self.mutex:
+                    for entry, function, args in reversed(transaction['undo']):
+                        function(*args)
+                        entry['record'] = None
+                raise
+            finally:
+                self.current_transaction.reset(token)
+                with self.locked():
+                    for entry in transaction['entries']:
+                        entry['done'] = True
+                    self.persist_done()
+            log.debug('Finish driver transaction')
+
+    def load_rows(self, filesystem_rows, layer_rows):
+        # Flat representation (driver.json version 2 and database), children
+        # reference their parent by id so rows can come in any order.
+        # filesystem_rows: (id, parent layer id, container id)
+        # layer_rows: (descriptor json, diff id, filesystem id, size, images)
+        filesystems = {}
+        filesystem_layer_ids = {}
+        for filesystem_id, layer_id, container_id in filesystem_rows:
+            filesystems[filesystem_id] = Filesystem(filesystem_id, None, container_id)
+            filesystem_layer_ids[filesystem_id] = layer_id
+        for descriptor, diff_id, filesystem_id, size, images in layer_rows:
+            layer = Layer(descriptor, diff_id, filesystems[filesystem_id], size, images)
+            self.insert_layer(layer)
+        for filesystem in filesystems.values():
+            layer_id = filesystem_layer_ids[filesystem.id]
+            if layer_id is not None:
+                filesystem.layer = self.layers[layer_id]
+            self.insert_filesystem(filesystem)
+
+    def load_nested(self, filesystems_json):
+        # driver.json before version 2, every layer is nested in the filesystem
+        # it was committed from and every filesystem in the layer it was cloned
+        # from. Walked with a stack, long layer chains do not recurse.
+        stack = [(filesystem_json, None) for filesystem_json in reversed(filesystems_json)]
+        while len(stack) > 0:
+            filesystem_json, parent_layer = stack.pop()
+            filesystem_id = filesystem_json['id']
+            log.debug('Loading filesystem (%s)' % filesystem_id)
+            container_id = filesystem_json.get('container_id', None)
+            filesystem = Filesystem(filesystem_id, parent_layer, container_id)
+            self.insert_filesystem(filesystem)
+            layer_json = filesystem_json.get('layer')
+            if layer_json is None:
+                continue
+            layer = Layer(layer_json['descriptor'], layer_json['diff_id'], filesystem, 
+                layer_json['size'], layer_json.get('images', []))
+            self.insert_layer(layer)
+            for child_filesystem_json in reversed(layer_json.get('filesystems', [])):
+                stack.append((child_filesystem_json, layer))
 
     def save(self):
         driver_path = pathlib.Path(oci_config['global']['path'])
@@ -96,168 +492,426 @@ class Driver(metaclass=Singleton):
         log.debug('Start saving driver file (%s)' % driver_file_path)
         if self.filesystems is None:
             raise OCIError('Driver filesystems is not initialized, can not save')
-        filesystems_json = [
-            self.filesystem_to_json(filesystem)
-                for filesystem in self.filesystems.values()
-                    if filesystem.layer is None
-        ]
+        filesystems_json = [self.filesystem_to_json(filesystem) for filesystem in self.filesystems.values()]
+        layers_json = [self.layer_to_json(layer) for layer in self.layers.values()]
         if not driver_path.is_dir():
-            driver_path.mkdir(filesystems=True)
-        with driver_file_path.open('w') as driver_file:
-            driver_json = {
-                'type': oci_config['driver']['type'], 
-                'filesystems': filesystems_json
-            }
-            json.dump(driver_json, driver_file, separators=(',', ':'))
+            driver_path.mkdir(parents=True)
+        driver_json = {
+            'type': oci_config['driver']['type'], 
+            'version': 2,
+            'sequence': self.sequence,
+            'filesystems': filesystems_json,
+            'layers': layers_json
+        }
+        atomic_write(driver_file_path, json.dumps(driver_json, separators=(',', ':')).encode())
+        self.stamp = file_stamp(driver_file_path)
+        self.save_snapshot()
+        self.journal.truncate()
         log.debug('Finish saving driver file (%s)' % driver_file_path)
 
     def filesystem_to_json(self, filesystem):
         filesystem_json = {'id': filesystem.id}
+        if filesystem.layer is not None:
+            filesystem_json['layer'] = filesystem.layer.id
         if filesystem.container_id is not None:
             filesystem_json['container_id'] = filesystem.container_id
-        layer = self.get_child_layer(filesystem)
-        if layer is not None:
-            filesystem_json['layer'] = self.layer_to_json(layer)
         return filesystem_json
 
     def layer_to_json(self, layer):
         layer_json = {
-            'descriptor': layer.descriptor.to_dict(),
+            'descriptor': layer.descriptor_to_dict(),
             'diff_id': layer.diff_id,
+            'filesystem': layer.filesystem.id,
             'size': layer.size
         }
         if len(layer.images) > 0:
             layer_json['images'] = layer.images
-        filesystems = self.get_child_filesystems(layer)
-        if len(filesystems) > 0:
-            layer_json['filesystems'] = [self.filesystem_to_json(filesystem) for filesystem in filesystems]
         return layer_json
 
     def get_filesystem(self, filesystem_id):
-        if filesystem_id not in self.filesystems:
-            raise FilesystemUnknownException('There is no filesystem with id (%s)' % filesystem_id)
-        return self.filesystems[filesystem_id]
+        with self.mutex:
+            self.refresh()
+            if filesystem_id not in self.filesystems:
+                raise FilesystemUnknownException('There is no filesystem with id (%s)' % filesystem_id)
+            return self.filesystems[filesystem_id]
 
     def get_filesystem_by_container_id(self, container_id):
-        for filesystem in self.filesystems.values():
-            if filesystem.container_id == container_id:
-                return filesystem
-        raise FilesystemUnknownException('There is no filesystem mounted for container (%s)' % container_id)
+        with self.mutex:
+            self.refresh()
+            if container_id not in self.filesystems_by_container_id:
+                raise FilesystemUnknownException('There is no filesystem mounted for container (%s)' % container_id)
+            return self.filesystems_by_container_id[container_id]
 
     def get_child_filesystems(self, layer):
-        return [ 
-            filesystem 
-                for filesystem in self.filesystems.values()
-                    if filesystem.layer == layer 
-        ]
+        with self.mutex:
+            self.refresh()
+            return list(self.child_filesystems.get(layer.id, {}).values())
     
     def create_filesystem(self, layer=None):
         log.debug('Start creating filesystem')
-        if layer is not None and layer.id not in self.layers:
-            raise LayerUnknownException('There is no layer with id (%s)' % layer.id)
-        filesystem = Filesystem.create(layer)
-        self.filesystems[filesystem.id] = filesystem
-        self.save()
+        filesystem = self.create_pooled_filesystem(layer)
+        if filesystem is not None:
+            log.debug('Finish creating filesystem (%s) from pool' % filesystem.id)
+            return filesystem
+        layer = self.prepare_create_filesystem(layer)
+        try:
+            filesystem = Filesystem.create(layer)
+            self.finish_create_filesystem(filesystem, layer)
+        finally:
+            self.release_layer(layer)
         log.debug('Finish creating filesystem')
         return filesystem
 
+    async def async_create_filesystem(self, layer=None):
+        log.debug('Start creating filesystem')
+        filesystem = self.create_pooled_filesystem(layer)
+        if filesystem is not None:
+            log.debug('Finish creating filesystem (%s) from pool' % filesystem.id)
+            return filesystem
+        layer = self.prepare_create_filesystem(layer)
+        try:
+            filesystem = await get_filesystem_class().async_create(layer)
+            self.finish_create_filesystem(filesystem, layer)
+        finally:
+            self.release_layer(layer)
+        log.debug('Finish creating filesystem')
+        return filesystem
+
+    def create_pooled_filesystem(self, layer):
+        # A clone of layer made ahead of time, None if the pool has none
+        if self.pool is None or layer is None:
+            return None
+        self.pool.launch(layer.id)
+        while True:
+            filesystem_id = self.pool.take(layer.id)
+            if filesystem_id is None:
+                return None
+            filesystem = self.take_pooled_filesystem(layer.id, filesystem_id)
+            if filesystem is not None:
+                return filesystem
+
+    def take_pooled_filesystem(self, layer_id, filesystem_id):
+        # Registers a pooled filesystem, None if another process took it first
+        # (the list of the pool may be older than the filesystems on disk)
+        with self.locked():
+            if layer_id not in self.layers:
+                raise LayerUnknownException('There is no layer with id (%s)' % layer_id)
+            if filesystem_id in self.filesystems:
+                return None
+            layer = self.layers[layer_id]
+            filesystem = Filesystem(filesystem_id, layer, None)
+            if not filesystem.unpool(layer_id):
+                return None
+            self.finish_create_filesystem(filesystem, layer)
+            return filesystem
+
+    def start_pool(self):
+        # Starts making the clones of the pool (driver.pool) in a background
+        # thread, for long running processes. The others only take the
+        # clones made by them.
+        if self.pool is not None:
+            self.pool.start()
+
+    def prepare_create_filesystem(self, layer):
+        # Keeps the layer from being removed while it is cloned
+        with self.locked():
+            if layer is not None:
+                if layer.id not in self.layers:
+                    raise LayerUnknownException('There is no layer with id (%s)' % layer.id)
+                layer = self.layers[layer.id]
+                self.cloning[layer.id] = self.cloning.get(layer.id, 0) + 1
+        return layer
+
+    def finish_create_filesystem(self, filesystem, layer):
+        with self.locked():
+            # The driver may have been reloaded while the filesystem was created
+            if layer is not None:
+                filesystem.layer = self.layers[layer.id]
+            self.insert_filesystem(filesystem)
+            self.write_record('create_filesystem', id=filesystem.id, 
+                layer=layer.id if layer is not None else None)
+
+    def release_layer(self, layer):
+        if layer is not None:
+            with self.mutex:
+                self.cloning[layer.id] -= 1
+                if self.cloning[layer.id] == 0:
+                    del self.cloning[layer.id]
+
     def mount_filesystem(self, filesystem, container_id, path):
         log.debug('Start mounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
-        if filesystem.id not in self.filesystems:
-            raise FilesystemUnknownException('Filesystem (%s) is not in driver, can not mount'
-                % filesystem.id)
-        filesystem.mount(container_id, path)
-        self.save()
+        (filesystem, reserved) = self.prepare_mount_filesystem(filesystem)
+        try:
+            filesystem.mount(container_id, path)
+            self.finish_mount_filesystem(filesystem, container_id)
+        finally:
+            if reserved:
+                self.release_filesystem(filesystem.id)
         log.debug('Finish mounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
 
+    async def async_mount_filesystem(self, filesystem, container_id, path):
+        log.debug('Start mounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
+        (filesystem, reserved) = self.prepare_mount_filesystem(filesystem)
+        try:
+            await filesystem.async_mount(container_id, path)
+            self.finish_mount_filesystem(filesystem, container_id)
+        finally:
+            if reserved:
+                self.release_filesystem(filesystem.id)
+        log.debug('Finish mounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
+
+    def prepare_mount_filesystem(self, filesystem):
+        with self.locked():
+            if filesystem.id not in self.filesystems:
+                raise FilesystemUnknownException('Filesystem (%s) is not in driver, can not mount'
+                    % filesystem.id)
+            filesystem = self.filesystems[filesystem.id]
+            return (filesystem, self.reserve_filesystem(filesystem))
+
+    def finish_mount_filesystem(self, filesystem, container_id):
+        with self.locked():
+            # The driver may have been reloaded while the filesystem was mounted
+            filesystem = self.filesystems[filesystem.id]
+            self.set_container_id(filesystem, container_id)
+            self.write_record('mount_filesystem', id=filesystem.id, container_id=container_id)
+
     def unmount_filesystem(self, container_id, remove=False):
-        filesystem = self.get_filesystem_by_container_id(container_id)
-        log.debug('Start unmounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
-        filesystem.unmount(container_id)
-        if remove:
-            self.remove_filesystem(filesystem)
-        self.save()
+        (filesystem, reserved) = self.prepare_unmount_filesystem(container_id)
+        try:
+            log.debug('Start unmounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
+            filesystem.unmount(container_id)
+            filesystem = self.finish_unmount_filesystem(filesystem, container_id)
+            if remove:
+                self.remove_filesystem(filesystem)
+        finally:
+            if reserved:
+                self.release_filesystem(filesystem.id)
+        log.debug('Finish unmounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
+
+    async def async_unmount_filesystem(self, container_id, remove=False):
+        (filesystem, reserved) = self.prepare_unmount_filesystem(container_id)
+        try:
+            log.debug('Start unmounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
+            await filesystem.async_unmount(container_id)
+            filesystem = self.finish_unmount_filesystem(filesystem, container_id)
+            if remove:
+                await self.async_remove_filesystem(filesystem)
+        finally:
+            if reserved:
+                self.release_filesystem(filesystem.id)
         log.debug('Finish unmounting filesystem (%s) for container (%s)' % (filesystem.id, container_id))
 
+    def prepare_unmount_filesystem(self, container_id):
+        with self.locked():
+            filesystem = self.get_filesystem_by_container_id(container_id)
+            return (filesystem, self.reserve_filesystem(filesystem))
+
+    def finish_unmount_filesystem(self, filesystem, container_id):
+        with self.locked():
+            filesystem = self.filesystems[filesystem.id]
+            self.set_container_id(filesystem, None)
+            self.write_record('unmount_filesystem', id=filesystem.id)
+        return filesystem
+
     def remove_filesystem(self, filesystem):
         filesystem_id = filesystem.id
         log.debug('Start removing filesystem (%s)' % filesystem_id)
-        if filesystem_id not in self.filesystems:
-            raise FilesystemUnknownException('Filesystem (%s) is not in driver, can not remove'
-                % filesystem_id)
-        if filesystem.is_mounted() or self.get_child_layer(filesystem) is not None:
-            raise FilesystemInUseException('Filesystem (%s) is in use, can not remove' 
-                % filesystem_id)
-        filesystem.destroy()
-        del self.filesystems[filesystem_id]
-        self.save()
+        (filesystem, reserved) = self.prepare_remove_filesystem(filesystem_id)
+        try:
+            filesystem.destroy()
+            self.finish_remove_filesystem(filesystem_id)
+        finally:
+            if reserved:
+                self.release_filesystem(filesystem_id)
+        log.debug('Finish removing filesystem (%s)' % filesystem_id)
+
+    async def async_remove_filesystem(self, filesystem):
+        filesystem_id = filesystem.id
+        log.debug('Start removing filesystem (%s)' % filesystem_id)
+        (filesystem, reserved) = self.prepare_remove_filesystem(filesystem_id)
+        try:
+            await filesystem.async_destroy()
+            self.finish_remove_filesystem(filesystem_id)
+        finally:
+            if reserved:
+                self.release_filesystem(filesystem_id)
         log.debug('Finish removing filesystem (%s)' % filesystem_id)
 
+    def prepare_remove_filesystem(self, filesystem_id):
+        with self.locked():
+            if filesystem_id not in self.filesystems:
+                raise FilesystemUnknownException('Filesystem (%s) is not in driver, can not remove'
+                    % filesystem_id)
+            filesystem = self.filesystems[filesystem_id]
+            if filesystem.is_mounted() or self.get_child_layer(filesystem) is not None:
+                raise FilesystemInUseException('Filesystem (%s) is in use, can not remove' 
+                    % filesystem_id)
+            return (filesystem, self.reserve_filesystem(filesystem))
+
+    def finish_remove_filesystem(self, filesystem_id):
+        with self.locked():
+            filesystem = self.filesystems[filesystem_id]
+            self.delete_filesystem(filesystem)
+            self.write_record('remove_filesystem', id=filesystem_id)
+
     def get_layer(self, layer_id):
         '''if layer_id is None:
             return None'''
-        if layer_id not in self.layers:
-            raise LayerUnknownException('There is no layer with id (%s)' % layer_id)
-        return self.layers[layer_id]
+        with self.mutex:
+            self.refresh()
+            if layer_id not in self.layers:
+                raise LayerUnknownException('There is no layer with id (%s)' % layer_id)
+            return self.layers[layer_id]
 
     def get_layer_by_diff_id(self, diff_id):
-        for layer in self.layers.values():
-            if layer.diff_id == diff_id:
-                return layer
-        raise LayerUnknownException('There is no layer with diff id (%s)' % diff_id)
+        with self.mutex:
+            self.refresh()
+            if diff_id not in self.layers_by_diff_id:
+                raise LayerUnknownException('There is no layer with diff id (%s)' % diff_id)
+            return self.layers_by_diff_id[diff_id]
 
     def get_child_layer(self, filesystem):
-        for layer in self.layers.values():
-            if layer.filesystem == filesystem:
-                return layer
         # If no layer is pointing to filesystem, it is a temp filesystem
+        with self.mutex:
+            self.refresh()
+            return self.child_layers.get(filesystem.id)
     
     def create_layer(self, filesystem):
         original_filesystem_id = filesystem.id
         log.debug('Start creating layer from filesystem (%s)' % original_filesystem_id)
-        if filesystem.id not in self.filesystems:
-            raise FilesystemUnknownException('Unknown filesystem (%s)' % filesystem.id)
-        layer = Layer.create(filesystem)
-        self.layers[layer.id] = layer
-        self.filesystems[layer.filesystem.id] = layer.filesystem
-        self.save()
+        (filesystem, reserved) = self.prepare_create_layer(filesystem)
+        try:
+            layer = Layer.create(filesystem)
+            (layer, duplicate) = self.finish_create_layer(layer)
+            if duplicate:
+                self.remove_filesystem(filesystem)
+        finally:
+            if reserved:
+                self.release_filesystem(original_filesystem_id)
         log.debug('Finish creating layer from (%s)' % original_filesystem_id)
         return layer
 
+    async def async_create_layer(self, filesystem):
+        # Layer.create (zfs diff, tar and compression) runs in a thread
+        original_filesystem_id = filesystem.id
+        log.debug('Start creating layer from filesystem (%s)' % original_filesystem_id)
+        (filesystem, reserved) = self.prepare_create_layer(filesystem)
+        try:
+            layer = await run_blocking(Layer.create, filesystem)
+            (layer, duplicate) = self.finish_create_layer(layer)
+            if duplicate:
+                await self.async_remove_filesystem(filesystem)
+        finally:
+            if reserved:
+                self.release_filesystem(original_filesystem_id)
+        log.debug('Finish creating layer from (%s)' % original_filesystem_id)
+        return layer
+
+    def prepare_create_layer(self, filesystem):
+        with self.locked():
+            if filesystem.id not in self.filesystems:
+                raise FilesystemUnknownException('Unknown filesystem (%s)' % filesystem.id)
+            filesystem = self.filesystems[filesystem.id]
+            return (filesystem, self.reserve_filesystem(filesystem))
+
+    def finish_create_layer(self, layer):
+        # Returns the layer and whether it was a duplicate
+        with self.locked():
+            if layer.id not in self.layers:
+                layer.filesystem = self.filesystems[layer.filesystem.id]
+                self.insert_layer(layer)
+                self.write_record('create_layer', id=layer.id, descriptor=layer.descriptor_to_dict(),
+                    diff_id=layer.diff_id, filesystem=layer.filesystem.id, size=layer.size)
+            elif self.layers[layer.id] is not layer:
+                # Same changeset committed by another thread in the meantime
+                return (self.layers[layer.id], True)
+        return (layer, False)
+
+    def load_layer(self, layer_file_path, descriptor, diff_id, parent=None, move=False):
+        # Counterpart of create_layer for a layer blob made elsewhere, parent
+        # is the layer below it. With move the blob file is handed over (a
+        # download in a temp file), see Layer.load
+        log.debug('Start loading layer (%s)' % layer_file_path)
+        with self.mutex:
+            self.refresh()
+            if diff_id in self.layers_by_diff_id:
+                return self.layers_by_diff_id[diff_id]
+        parent = self.prepare_create_filesystem(parent)
+        try:
+            layer = Layer.load(layer_file_path, descriptor, diff_id, parent, move)
+            filesystem = layer.filesystem
+            with self.locked():
+                self.finish_create_filesystem(filesystem, parent)
+                (layer, duplicate) = self.finish_create_layer(layer)
+            if duplicate:
+                self.remove_filesystem(filesystem)
+        finally:
+            self.release_layer(parent)
+        log.debug('Finish loading layer (%s)' % layer_file_path)
+        return layer
+
     def remove_layer(self, layer):
         layer_id = layer.id
         log.debug('Start removing layer (%s)' % layer_id)
-        if layer_id not in self.layers:
-            raise LayerUnknownException('Layer (%s) is not in driver, can not remove'
-                % layer_id)
-        if len(layer.images) > 0:
-            images = ', '.join(layer.images)
-            raise LayerInUseException('Layer (%s) is used by %s, can not remove' % (layer_id, images))
-        if len(self.get_child_filesystems(layer)):
-            raise LayerInUseException('Layer (%s) is in use, can not remove' 
-                % layer_id)
-        layer_filesystem = layer.filesystem
-        layer.destroy()
-        del self.layers[layer_id]
+        layer_filesystem = self.destroy_layer(layer_id)
         self.remove_filesystem(layer_filesystem) 
         log.debug('Finish removing layer (%s)' % layer_id)
 
+    async def async_remove_layer(self, layer):
+        layer_id = layer.id
+        log.debug('Start removing layer (%s)' % layer_id)
+        layer_filesystem = self.destroy_layer(layer_id)
+        await self.async_remove_filesystem(layer_filesystem) 
+        log.debug('Finish removing layer (%s)' % layer_id)
+
+    def destroy_layer(self, layer_id):
+        # Returns the filesystem the layer was committed from, left to remove.
+        # Pooled clones of the layer are destroyed here.
+        with self.locked():
+            if layer_id not in self.layers:
+                raise LayerUnknownException('Layer (%s) is not in driver, can not remove'
+                    % layer_id)
+            layer = self.layers[layer_id]
+            if len(layer.images) > 0:
+                images = ', '.join(layer.images)
+                raise LayerInUseException('Layer (%s) is used by %s, can not remove' % (layer_id, images))
+            if len(self.get_child_filesystems(layer)) or layer_id in self.cloning:
+                raise LayerInUseException('Layer (%s) is in use, can not remove' 
+                    % layer_id)
+            # Nobody can take the pooled clones of a removed layer
+            pooled = self.pool.drain(layer_id) if self.pool is not None else []
+            layer_filesystem = layer.filesystem
+            diff_id = layer.diff_id
+            layer.destroy()
+            self.delete_layer(layer_id, diff_id, layer_filesystem.id)
+            self.write_record('remove_layer', id=layer_id)
+        for filesystem_id in pooled:
+            Filesystem(filesystem_id, None, None).destroy()
+        return layer_filesystem
+
     def add_image_reference(self, layer, image_id):
         layer_id = layer.id
         log.debug('Start adding image reference (%s) to layer (%s)' % (image_id, layer_id))
-        if layer_id not in self.layers:
-            raise LayerUnknownException('Layer (%s) is not in driver, can not add image ref'
-                % layer_id)
-        layer.add_image_reference(image_id)
-        self.save()
+        with self.locked():
+            if layer_id not in self.layers:
+                raise LayerUnknownException('Layer (%s) is not in driver, can not add image ref'
+                    % layer_id)
+            layer = self.layers[layer_id]
+            layer.add_image_reference(image_id)
+            entry = self.write_record('add_image_reference', layer=layer_id, image=image_id)
+            self.add_undo(entry, layer.images.remove, image_id)
         log.debug('Finish adding image reference (%s) to layer (%s)' % (image_id, layer_id))
 
     def remove_image_reference(self, layer, image_id):
         layer_id = layer.id
         log.debug('Start removing layer (%s) reference to image (%s)' % (layer_id, image_id))
-        if layer_id not in self.layers:
-            raise LayerUnknownException('Layer (%s) is not in driver, can not add image ref'
-                % layer_id)
-        layer.remove_image_reference(image_id)
-        self.save()
+        with self.locked():
+            if layer_id not in self.layers:
+                raise LayerUnknownException('Layer (%s) is not in driver, can not add image ref'
+                    % layer_id)
+            layer = self.layers[layer_id]
+            index = layer.images.index(image_id) if image_id in layer.images else None
+            layer.remove_image_reference(image_id)
+            entry = self.write_record('remove_image_reference', layer=layer_id, image=image_id)
+            self.add_undo(entry, layer.images.insert, index, image_id)
         log.debug('Finish removing layer (%s) reference to image (%s)' % (layer_id, image_id))
@@ -15,8 +15,15 @@
 
 import logging
 import pathlib
+import tarfile
+import tempfile
+import contextlib
+import humanize
+from oci_spec.image.v1 import MediaTypeImageLayer
 from oci_api import oci_config, OCIError
 from oci_api.util import id_to_digest
+from oci_api.util.process import run_blocking
+from .changeset import ChangesetReader, ChangesetExtractor
 
 log = logging.getLogger(__name__)
 
@@ -25,20 +32,55 @@ def get_filesystem_class():
     if driver_type == 'zfs':
         from .zfs_filesystem import ZFSFilesystem
         return ZFSFilesystem
+    if driver_type == 'directory':
+        from .directory_filesystem import DirectoryFilesystem
+        return DirectoryFilesystem
+    if driver_type == 'overlay':
+        from .overlay_filesystem import OverlayFilesystem
+        return OverlayFilesystem
     raise OCIError('Unsupported driver type (%s)' % driver_type)
 
 
 class Filesystem:
-    @classmethod
     def __new__(cls, *args, **kwargs):
-        if cls is not Filesystem:
-            return super(Filesystem, cls).__new__(cls, *args, **kwargs)
-        return super(Filesystem, cls).__new__(get_filesystem_class())
+        if cls is Filesystem:
+            cls = get_filesystem_class()
+        return super(Filesystem, cls).__new__(cls)
+
+    @classmethod
+    def create(cls, layer, pooled=False):
+        # A pooled filesystem is cloned ahead of time, it is not mounted and
+        # is tagged so list_pooled() finds it
+        filesystem_class = get_filesystem_class()
+        return filesystem_class.create(layer, pooled)
 
     @classmethod
-    def create(cls, layer):
+    def receive(cls, layer, changeset, media_type):
+        # Inverse of commit(), a committed filesystem with the contents of
+        # layer plus a changeset of media_type: the path of an uncompressed
+        # changeset or a ChangesetReader (compressed blob, verified diff id)
         filesystem_class = get_filesystem_class()
-        return filesystem_class.create(layer)
+        return filesystem_class.receive(layer, changeset, media_type)
+
+    @classmethod
+    def list_pooled(cls):
+        # layer id -> ids of the existing pooled filesystems of that layer
+        return get_filesystem_class().list_pooled()
+
+    @classmethod
+    async def async_create(cls, layer, pooled=False):
+        # Filesystem classes without async operations run them in a thread
+        return await run_blocking(cls.create, layer, pooled)
+
+    @classmethod
+    def batch(cls):
+        # Context in which the filesystem class may group its operations
+        return contextlib.nullcontext()
+
+    @classmethod
+    def reap(cls, wait=False):
+        # Finishes the destroys the filesystem class deferred to the background
+        pass
 
     def __init__(self, id, layer, container_id):
         log.debug('Creating instance of %s(%s)' % (type(self).__name__, id))
@@ -47,4 +89,95 @@ class Filesystem:
         self.container_id = container_id
 
     def is_mounted(self):
-        return self.container_id is not None
\ No newline at end of file
+        return self.container_id is not None
+
+    def changeset_media_type(self):
+        # Media type of the (uncompressed) changesets made by commit()
+        return MediaTypeImageLayer
+
+    def unpool(self, layer_id):
+        # Clears the tag of a pooled filesystem of layer_id when it is handed
+        # out, False if it is gone or not tagged (another process took it)
+        raise NotImplementedError()
+
+    async def async_mount(self, container_id, path):
+        await run_blocking(self.mount, container_id, path)
+
+    async def async_unmount(self, container_id):
+        await run_blocking(self.unmount, container_id)
+
+    async def async_destroy(self):
+        await run_blocking(self.destroy)
+
+    def diff(self):
+        # Changes from the filesystem of layer, zfs diff records: [change type,
+        # path] with '+' added, '-' removed, 'M' modified or [R, path, new path]
+        # for renamed, parents before their children
+        raise NotImplementedError()
+
+    @property
+    def diff_path(self):
+        # Directory the paths of diff() are in
+        return self.path
+
+    def load_changeset(self, changeset, method=None, diff_id=None):
+        # changeset is a path or a file object, compressed with method, or a
+        # ChangesetReader. It is extracted as it is decompressed, a diff id
+        # mismatch raises before the filesystem is committed. Returns the
+        # size of the (uncompressed) changeset.
+        if not isinstance(changeset, ChangesetReader):
+            with ChangesetReader(changeset, method, diff_id) as reader:
+                return self.load_changeset(reader)
+        log.debug('Start loading changeset (%s)' % changeset.name)
+        with tarfile.open(fileobj=changeset, mode="r|") as tar_file:
+            size = self.changeset_extractor().extract(tar_file)
+        changeset.verify()
+        log.debug('Finish loading changeset (%s), size: %s' % 
+            (changeset.name, humanize.naturalsize(size)))
+        return changeset.size
+
+    def changeset_extractor(self):
+        # Whiteouts and opaque directories remove the entries of the layers
+        # below, see ChangesetExtractor
+        return ChangesetExtractor(self.path)
+    
+    def save_changeset(self, changeset_file):
+        # Written as a stream, changeset_file only needs write()
+        log.debug('Start saving changeset of filesystem (%s)' % self.id)
+        with tarfile.open(fileobj=changeset_file, mode="w|") as tar_file:
+            with tempfile.NamedTemporaryFile() as wh_temp_file:
+                path = self.diff_path
+                for change_info in self.diff():
+                    change_type = change_info[0]
+                    file_path = pathlib.Path(change_info[1])
+                    if file_path != path:
+                        if change_type == 'M' or change_type == '+':
+                            tar_file.add(file_path, arcname=file_path.relative_to(path), recursive=False)
+                        elif change_type == '-' or change_type == 'R':
+                            file_path = file_path.parent.joinpath('.wh.' + file_path.name)
+                            tar_file.add(wh_temp_file.name, arcname=file_path.relative_to(path), recursive=False)
+                        if change_type == 'R':
+                            file_path = pathlib.Path(change_info[2])
+                            tar_file.add(file_path, arcname=file_path.relative_to(path), recursive=False)
+        log.debug('Finish saving changeset of filesystem (%s)' % self.id)
+
+    def is_mounted_for(self, container_id, path):
+        # Raises if the filesystem is mounted for another container
+        if self.container_id is None:
+            return False
+        if self.container_id != container_id:
+            raise OCIError('Filesystem (%s) already mounted for container (%s)' % (self.id, self.container_id))
+        log.warning('Filesystem (%s) already mounted for container (%s)' % (self.id, container_id))
+        if self.path != path:
+            raise OCIError('Filesystem (%s) path (%s) should be (%s)' % (self.id, self.path, path))
+        return True
+
+    def prepare_unmount(self, container_id):
+        # Returns the path of the unmounted filesystem
+        if self.container_id is None:
+            raise OCIError('Filesystem (%s) is not mounted' % self.id)
+        if self.container_id != container_id:
+            raise OCIError('Filesystem (%s) mounted for container (%s), not (%s)' % 
+                (self.id, self.container_id, container_id))
+        self.container_id = None
+        return pathlib.Path(oci_config['global']['path'], 'filesystems', self.id)
@@ -14,55 +14,107 @@
 
 import logging
 import pathlib
-import tempfile
-from oci_spec.image.v1 import Descriptor, MediaTypeImageLayer, MediaTypeImageLayerGzip
+from oci_spec.image.v1 import Descriptor
 from oci_api import oci_config, OCIError
 from oci_api.util import id_to_digest
-from oci_api.util.file import rm, cp, compress, sha256sum
+from oci_api.util.file import rm, place_file, BlobWriter
+from .filesystem import Filesystem
+from .changeset import ChangesetReader
 from .exceptions import LayerUnknownException
 
 log = logging.getLogger(__name__)
 
+GZIP_SUFFIX = '+gzip'
+ZSTD_SUFFIX = '+zstd'
+# driver.<type>.layer_compression: compression method and media type suffix
+COMPRESSIONS = {
+    'gzip': ('gz', GZIP_SUFFIX),
+    'zstd': ('zst', ZSTD_SUFFIX)
+}
+
+def layer_compression():
+    driver_type = oci_config['driver']['type']
+    compression = oci_config['driver'].get(driver_type, {}).get('layer_compression', 'gzip')
+    if compression is not None and compression not in COMPRESSIONS:
+        raise OCIError('Layer compression (%s) not supported' % compression)
+    return compression
+
+def media_type_compression(media_type):
+    # Uncompressed media type and compression method of a layer media type
+    for method, suffix in COMPRESSIONS.values():
+        if media_type.endswith(suffix):
+            return media_type[:-len(suffix)], method
+    return media_type, None
+
 class Layer:
     @classmethod
     def create(cls, filesystem, compressed=True):
         filesystem_id = filesystem.id
         log.debug('Start creating layer from filesystem (%s)' % filesystem.id)
-        with tempfile.TemporaryDirectory() as temp_dir_name:
-            size = filesystem.size()
-            changeset_file_path = pathlib.Path(temp_dir_name, 'changeset.tar')
-            diff_id = filesystem.commit(changeset_file_path)
-            try:
-                from .driver import Driver
-                layer = Driver().get_layer_by_diff_id(diff_id)
-                Driver().remove_filesystem(filesystem)
-            except LayerUnknownException:
-                layer_id = diff_id
-                media_type=MediaTypeImageLayer
-                if compressed:
-                    changeset_file_path = compress(changeset_file_path, keep_original=True)
-                    if changeset_file_path is None:
-                        raise OCIError('Could not compress layer file (%s)' % str(changeset_file_path))
-                    media_type=MediaTypeImageLayerGzip
-                    layer_id = sha256sum(changeset_file_path)
-                    if layer_id is None:
-                        raise OCIError('Could not get hash of file %s' % str(changeset_file_path))
-                layers_path = pathlib.Path(oci_config['global']['path'], 'layers')
-                layer_file_path = layers_path.joinpath(layer_id)
-                if not layer_file_path.is_file():
-                    if not layers_path.is_dir():
-                        layers_path.mkdir(parents=True)
-                    cp(changeset_file_path, layer_file_path)
-                descriptor = Descriptor(
-                    digest=id_to_digest(layer_id),
-                    size=layer_file_path.stat().st_size,
-                    media_type=media_type,
-                )
-                layer = cls(descriptor, diff_id, filesystem, size, [])
+        size = filesystem.size()
+        layers_path = pathlib.Path(oci_config['global']['path'], 'layers')
+        if not layers_path.is_dir():
+            layers_path.mkdir(parents=True)
+        # The changeset is hashed (diff id), compressed, hashed again (layer
+        # id) and written to layers/ as it is made, it is never read back
+        compression = layer_compression() if compressed else None
+        method, suffix = COMPRESSIONS.get(compression, (None, None))
+        with BlobWriter(layers_path, method) as blob_writer:
+            filesystem.commit(blob_writer)
+        diff_id = blob_writer.diff_id
+        try:
+            from .driver import Driver
+            layer = Driver().get_layer_by_diff_id(diff_id)
+            blob_writer.discard()
+            Driver().remove_filesystem(filesystem)
+        except LayerUnknownException:
+            media_type = filesystem.changeset_media_type()
+            if suffix is not None:
+                # tar+gzip or tar+zstd for MediaTypeImageLayer
+                media_type = media_type + suffix
+            layer_id = blob_writer.digest
+            blob_writer.store(layers_path.joinpath(layer_id))
+            descriptor = Descriptor(
+                digest=id_to_digest(layer_id),
+                size=blob_writer.size,
+                media_type=media_type,
+            )
+            layer = cls(descriptor, diff_id, filesystem, size, [])
+        except:
+            blob_writer.discard()
+            raise
         log.debug('Finish creating layer from filesystem (%s)' % filesystem_id)
         return layer
 
+    @classmethod
+    def load(cls, layer_file_path, descriptor, diff_id, parent, move=False):
+        # Inverse of create, layer of a blob made elsewhere (another host, an
+        # image archive) on top of parent. The blob is placed into layers/,
+        # moved (renamed if possible) with move, else cloned.
+        layer = cls(descriptor, diff_id, None, None, [])
+        log.debug('Start loading layer (%s) from (%s)' % (layer.id, layer_file_path))
+        media_type, method = media_type_compression(layer.media_type)
+        # Decompressed, hashed and extracted in one pass, a diff id mismatch
+        # discards the filesystem
+        with ChangesetReader(layer_file_path, method, diff_id) as changeset:
+            layer.filesystem = Filesystem.receive(parent, changeset, media_type)
+            # Size of the changeset, the filesystem is already committed
+            layer.size = changeset.size
+        layers_path = pathlib.Path(oci_config['global']['path'], 'layers')
+        layer_file_copy_path = layers_path.joinpath(layer.id)
+        if not layer_file_copy_path.is_file():
+            if not layers_path.is_dir():
+                layers_path.mkdir(parents=True)
+            place_file(layer_file_path, layer_file_copy_path, move)
+        elif move:
+            rm(layer_file_path)
+        log.debug('Finish loading layer (%s) from (%s)' % (layer.id, layer_file_path))
+        return layer
+
     def __init__(self, descriptor, diff_id, filesystem, size, images):
+        # descriptor is either a Descriptor or its json (dict), as stored by the
+        # driver. The json is only parsed when the descriptor is first accessed,
+        # most commands touch a few layers out of all the loaded ones.
         self.descriptor = descriptor
         log.debug('Creating instance of %s(%s)' % (type(self).__name__, self.id or ''))
         self.diff_id = diff_id
@@ -70,10 +122,40 @@ class Layer:
         self.images = images
         self.size = size
 
+    @property
+    def descriptor(self):
+        if self.parsed_descriptor is None and self.descriptor_json is not None:
+            self.parsed_descriptor = Descriptor.from_json(self.descriptor_json)
+        return self.parsed_descriptor
+
+    @descriptor.setter
+    def descriptor(self, descriptor):
+        if isinstance(descriptor, dict):
+            self.descriptor_json = descriptor
+            self.parsed_descriptor = None
+        else:
+            self.descriptor_json = None
+            self.parsed_descriptor = descriptor
+
+    def descriptor_to_dict(self):
+        if self.parsed_descriptor is None:
+            return self.descriptor_json
+        return self.parsed_descriptor.to_dict()
+
     @property
     def id(self):
+        if self.parsed_descriptor is None:
+            if self.descriptor_json is None:
+                return None
+            return self.descriptor_json['digest'].split(':', 1)[-1]
         return self.descriptor.get('Digest').encoded()
 
+    @property
+    def media_type(self):
+        if self.parsed_descriptor is None:
+            return self.descriptor_json['mediaType']
+        return self.descriptor.get('MediaType')
+
     @property
     def parent(self):
         self.filesystem.layer
@@ -0,0 +1,284 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import errno
+import logging
+import pathlib
+from oci_spec.image.v1 import MediaTypeImageLayer
+from oci_api import OCIError, oci_config
+from oci_api.util.random import generate_random_filesystem_id
+from oci_api.util.file import rm, tree_size
+from oci_api.util.overlay import overlay_mount, overlay_umount, fuse_overlay_mount, \
+    fuse_overlay_umount, OverlayError
+from .filesystem import Filesystem
+from .changeset import WHITEOUT_PREFIX, OPAQUE_WHITEOUT, ChangesetExtractor
+from .directory_filesystem import POOL_SUFFIX, filesystems_path, scan_directory, list_pooled, \
+    unpool
+
+log = logging.getLogger(__name__)
+
+# Opaque directory xattrs of the kernel (trusted. needs CAP_SYS_ADMIN, user.
+# is used with the userxattr mount option) and of fuse-overlayfs
+OPAQUE_XATTRS = ['trusted.overlay.opaque', 'user.overlay.opaque', 'user.fuseoverlayfs.opaque']
+
+def use_fuse():
+    # driver.overlay.mount, 'auto' is the kernel overlayfs as root
+    mount = oci_config['driver']['overlay'].get('mount', 'auto')
+    if mount == 'auto':
+        return os.geteuid() != 0
+    if mount not in ('kernel', 'fuse'):
+        raise OCIError('Overlay mount (%s) not supported' % mount)
+    return mount == 'fuse'
+
+def is_whiteout(file_stat):
+    return stat.S_ISCHR(file_stat.st_mode) and file_stat.st_rdev == 0
+
+def is_opaque(dir_path):
+    if os.path.lexists(os.path.join(dir_path, OPAQUE_WHITEOUT)):
+        return True
+    for xattr in OPAQUE_XATTRS:
+        try:
+            if os.getxattr(dir_path, xattr, follow_symlinks=False) == b'y':
+                return True
+        except OSError as e:
+            if e.errno not in (errno.ENODATA, errno.ENOTSUP, errno.EPERM):
+                raise
+    return False
+
+def is_lower_directory(lower_paths, relative_path):
+    # Whether the entry visible through the lower directories is a directory
+    for lower_path in lower_paths:
+        try:
+            return stat.S_ISDIR(os.lstat(os.path.join(lower_path, relative_path)).st_mode)
+        except FileNotFoundError:
+            continue
+        except NotADirectoryError:
+            # Under a file, hides the lower directories below too
+            return False
+    return False
+
+def diff_upper(upper_path, lower_paths):
+    # Implemented as generator, zfs_diff records of the changes in an upper
+    # directory: whiteouts (character devices 0/0 or .wh. files) are removed
+    # entries, an opaque directory is removed and added again, anything else
+    # is added. A file replacing a lower directory leaves no whiteout, it is
+    # removed too. Names are sorted, as diff_tree does.
+    upper_path = str(upper_path)
+    pending = [upper_path]
+    while len(pending) > 0:
+        directory = pending.pop()
+        entries = scan_directory(directory)
+        directories = []
+        for name in sorted(entries):
+            file_path = os.path.join(directory, name)
+            file_stat = entries[name]
+            if name == OPAQUE_WHITEOUT:
+                continue
+            if name.startswith(WHITEOUT_PREFIX):
+                yield ['-', os.path.join(directory, name[len(WHITEOUT_PREFIX):])]
+                continue
+            if is_whiteout(file_stat):
+                yield ['-', file_path]
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                if is_opaque(file_path):
+                    yield ['-', file_path]
+                directories.append(file_path)
+            elif is_lower_directory(lower_paths, os.path.relpath(file_path, upper_path)):
+                yield ['-', file_path]
+            yield ['+', file_path]
+        pending.extend(reversed(directories))
+
+class OverlayChangesetExtractor(ChangesetExtractor):
+    # Whiteouts become overlay whiteouts of the lower directories: with the
+    # kernel overlayfs character devices 0/0 and the opaque xattr, with
+    # fuse-overlayfs the .wh. files themselves
+    def __init__(self, path, fuse, threads=None):
+        super().__init__(path, threads)
+        self.fuse = fuse
+
+    def whiteout(self, member, hidden_path):
+        self.remove(hidden_path)
+        if self.fuse:
+            return True
+        os.makedirs(os.path.dirname(hidden_path), exist_ok=True)
+        os.mknod(hidden_path, stat.S_IFCHR, os.makedev(0, 0))
+        return False
+
+    def opaque(self, member, dir_path):
+        # Hides the lower directories only, entries of this changeset are
+        # kept
+        os.makedirs(dir_path, exist_ok=True)
+        self.make_opaque(dir_path)
+
+    def prepare(self, member, target_path):
+        # Added in the same changeset as its whiteout, the lower entry is
+        # replaced
+        whiteout_path = os.path.join(os.path.dirname(target_path), 
+            WHITEOUT_PREFIX + os.path.basename(target_path))
+        if os.path.lexists(whiteout_path) or (os.path.lexists(target_path) and 
+                is_whiteout(os.lstat(target_path))):
+            self.remove(whiteout_path)
+            self.remove(target_path)
+            if member.isdir():
+                os.makedirs(target_path)
+                self.make_opaque(target_path)
+        else:
+            super().prepare(member, target_path)
+
+    def make_opaque(self, dir_path):
+        if self.fuse:
+            pathlib.Path(dir_path, OPAQUE_WHITEOUT).touch()
+        else:
+            os.setxattr(dir_path, OPAQUE_XATTRS[0], b'y')
+
+class OverlayFilesystem(Filesystem):
+    # A filesystem is an upper directory over the upper directories of the
+    # filesystems of its layers, nothing is copied on create. Mounting is a
+    # union mount (overlayfs, or fuse-overlayfs without privileges) at the
+    # container path. Layer contents are their upper directories, changesets
+    # are made from them and loaded into them with overlay whiteouts.
+    @classmethod
+    def create(cls, layer, pooled=False):
+        filesystem_id = generate_random_filesystem_id()
+        path = filesystems_path().joinpath(filesystem_id)
+        log.debug('Creating filesystem (%s)' % path)
+        for name in ['upper', 'work', 'lower']:
+            path.joinpath(name).mkdir(mode=0o755, parents=True)
+        if pooled:
+            path.with_name(filesystem_id + POOL_SUFFIX).write_text(layer.id)
+        return Filesystem(filesystem_id, layer, None)
+
+    @classmethod
+    def receive(cls, layer, changeset, media_type):
+        if media_type != MediaTypeImageLayer:
+            raise OCIError('Layer media type (%s) not supported by overlay driver' % media_type)
+        filesystem = cls.create(layer)
+        try:
+            filesystem.load_changeset(changeset)
+        except:
+            filesystem.destroy()
+            raise
+        return filesystem
+
+    @classmethod
+    def list_pooled(cls):
+        return list_pooled()
+
+    @property
+    def base_path(self):
+        return filesystems_path().joinpath(self.id)
+
+    def unpool(self, layer_id):
+        return unpool(self.base_path, layer_id)
+
+    @property
+    def upper_path(self):
+        return self.base_path.joinpath('upper')
+
+    @property
+    def mounted_path(self):
+        # Symlink to the mount path while mounted
+        return self.base_path.joinpath('mounted')
+
+    @property
+    def path(self):
+        # The merged tree while mounted, only the changes otherwise
+        mounted_path = self.mounted_path
+        if mounted_path.is_symlink():
+            return pathlib.Path(os.readlink(mounted_path))
+        return self.upper_path
+
+    @property
+    def diff_path(self):
+        return self.upper_path
+
+    def lower_dirs(self):
+        # Upper directories of the filesystems of the layers, top first, as
+        # paths relative to filesystems/. The empty lower directory of the
+        # filesystem when there is no layer (overlayfs needs one).
+        lower_dirs = []
+        layer = self.layer
+        while layer is not None:
+            lower_dirs.append(os.path.join(layer.filesystem.id, 'upper'))
+            layer = layer.filesystem.layer
+        if len(lower_dirs) == 0:
+            lower_dirs.append(os.path.join(self.id, 'lower'))
+        return lower_dirs
+
+    def size(self):
+        return tree_size(self.upper_path)
+
+    def virtual_size(self):
+        return self.size()
+
+    def destroy(self):
+        if self.mounted_path.is_symlink():
+            self.umount(self.path)
+        if rm(self.base_path, recursive=True) != 0:
+            raise OCIError('Could not destroy filesystem (%s)' % self.base_path)
+        rm(self.base_path.with_name(self.id + POOL_SUFFIX))
+
+    def commit(self, changeset_file):
+        # The upper directory stays as the lower directory of the children
+        self.save_changeset(changeset_file)
+
+    def diff(self):
+        base_path = filesystems_path()
+        return diff_upper(self.upper_path, 
+            [ base_path.joinpath(lower_dir) for lower_dir in self.lower_dirs() ])
+
+    def changeset_extractor(self):
+        return OverlayChangesetExtractor(self.upper_path, use_fuse())
+
+    def mount(self, container_id, path):
+        if self.is_mounted_for(container_id, path):
+            return
+        path = pathlib.Path(path)
+        if not path.is_dir():
+            path.mkdir(parents=True)
+        overlay_config = oci_config['driver']['overlay']
+        base_path = filesystems_path()
+        try:
+            if use_fuse():
+                # Absolute, fuse-overlayfs keeps running after we change directory
+                fuse_overlay_mount(path,
+                    [ base_path.joinpath(lower_dir) for lower_dir in self.lower_dirs() ],
+                    self.upper_path, self.base_path.joinpath('work'),
+                    overlay_config.get('fuse_command', 'fuse-overlayfs'))
+            else:
+                overlay_mount(path, self.lower_dirs(), self.upper_path,
+                    self.base_path.joinpath('work'), overlay_config.get('options'), cwd=base_path)
+        except OverlayError as e:
+            raise OCIError('Could not mount filesystem (%s) at (%s): %s' % (self.id, path, e))
+        self.container_id = container_id
+        os.symlink(path, self.mounted_path)
+
+    def unmount(self, container_id):
+        path = self.path
+        self.prepare_unmount(container_id)
+        self.umount(path)
+
+    def umount(self, path):
+        try:
+            if use_fuse():
+                fuse_overlay_umount(path,
+                    oci_config['driver']['overlay'].get('fusermount_command', 'fusermount3'))
+            else:
+                overlay_umount(path)
+        except OverlayError as e:
+            raise OCIError('Could not unmount filesystem (%s) from (%s): %s' % (self.id, path, e))
+        self.mounted_path.unlink()
@@ -0,0 +1,193 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import time
+import logging
+import threading
+import collections
+from oci_api import oci_config
+from .filesystem import Filesystem, get_filesystem_class
+from .exceptions import LayerUnknownException
+
+log = logging.getLogger(__name__)
+
+class FilesystemPool:
+    # Clones of the most launched layers, made ahead of time by a background
+    # thread and handed out by Driver.create_filesystem instead of cloning on
+    # the request path. Pooled filesystems are not in the driver metadata
+    # until they are handed out, so every process can take them; the
+    # filesystem class tags them (list_pooled) to find them after a restart
+    # and clears the tag when one is handed out (unpool).
+    # The thread runs in the process that calls start() (a long running
+    # one), launches are only counted there. Other processes list the
+    # pooled filesystems on disk when they need one.
+    def __init__(self, driver):
+        self.driver = driver
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        # layer id -> ids of the pooled filesystems
+        self.available = {}
+        # layer id -> times of the launches within the window
+        self.launches = {}
+        self.thread = None
+
+    @property
+    def config(self):
+        return oci_config['driver']['pool']
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='pool', daemon=True)
+                self.thread.start()
+
+    def launch(self, layer_id):
+        # A filesystem of layer is needed, also wakes up the refill thread
+        with self.lock:
+            if self.thread is None:
+                return
+            self.launches.setdefault(layer_id, collections.deque()).append(time.monotonic())
+        self.event.set()
+
+    def take(self, layer_id):
+        # Id of a pooled filesystem of layer, None if there is none. It may
+        # have been taken by another process in the meantime, see
+        # Driver.take_pooled_filesystem
+        with self.lock:
+            available = self.available.get(layer_id)
+            if available:
+                return available.pop()
+            if self.thread is not None:
+                return None
+        filesystem_ids = [
+            filesystem_id
+                for filesystem_id in get_filesystem_class().list_pooled().get(layer_id, [])
+                    if filesystem_id not in self.driver.filesystems
+        ]
+        if len(filesystem_ids) == 0:
+            return None
+        with self.lock:
+            self.available[layer_id] = filesystem_ids
+            return self.available[layer_id].pop()
+
+    def drain(self, layer_id):
+        # Called with the driver locked before layer is removed, returns the
+        # pooled filesystems of layer (also the ones of other processes) that
+        # have to be destroyed first
+        with self.lock:
+            filesystem_ids = set(self.available.pop(layer_id, []))
+            self.launches.pop(layer_id, None)
+        filesystem_ids.update(get_filesystem_class().list_pooled().get(layer_id, []))
+        return [
+            filesystem_id
+                for filesystem_id in filesystem_ids
+                    if filesystem_id not in self.driver.filesystems
+        ]
+
+    def targets(self):
+        # layer id -> pool size, enough clones for the next `lead` seconds at
+        # the launch rate of the last `window` seconds, hottest layers first
+        # when the total goes over max_total
+        now = time.monotonic()
+        window = self.config['window']
+        targets = {}
+        with self.lock:
+            for layer_id, launches in list(self.launches.items()):
+                while len(launches) > 0 and now - launches[0] > window:
+                    launches.popleft()
+                if len(launches) == 0:
+                    del self.launches[layer_id]
+                    continue
+                rate = len(launches) / window
+                targets[layer_id] = min(self.config['size'], math.ceil(rate * self.config['lead']))
+        total = 0
+        for layer_id in sorted(targets, key=targets.get, reverse=True):
+            targets[layer_id] = min(targets[layer_id], max(self.config['max_total'] - total, 0))
+            total += targets[layer_id]
+        return targets
+
+    def run(self):
+        try:
+            self.recover()
+        except Exception:
+            log.exception('Could not recover pooled filesystems')
+        while True:
+            self.event.wait(self.config['window'])
+            self.event.clear()
+            try:
+                self.refill()
+            except Exception:
+                log.exception('Could not refill filesystem pool')
+
+    def recover(self):
+        # Pooled filesystems left by previous processes are used again, the
+        # ones of removed layers are destroyed
+        pooled = get_filesystem_class().list_pooled()
+        orphans = []
+        with self.driver.mutex:
+            self.driver.refresh()
+            with self.lock:
+                for layer_id, filesystem_ids in pooled.items():
+                    filesystem_ids = [
+                        filesystem_id
+                            for filesystem_id in filesystem_ids
+                                if filesystem_id not in self.driver.filesystems
+                    ]
+                    if layer_id in self.driver.layers:
+                        self.available.setdefault(layer_id, []).extend(filesystem_ids)
+                    else:
+                        orphans.extend(filesystem_ids)
+        for filesystem_id in orphans:
+            log.info('Destroying pooled filesystem (%s) of removed layer' % filesystem_id)
+            Filesystem(filesystem_id, None, None).destroy()
+
+    def refill(self):
+        targets = self.targets()
+        surplus = []
+        with self.lock:
+            for layer_id, available in self.available.items():
+                target = targets.get(layer_id, 0)
+                while len(available) > target:
+                    surplus.append((layer_id, available.pop(0)))
+        for layer_id, filesystem_id in surplus:
+            # Registered first, another process may be handing it out
+            try:
+                filesystem = self.driver.take_pooled_filesystem(layer_id, filesystem_id)
+            except LayerUnknownException:
+                continue
+            if filesystem is not None:
+                log.debug('Destroying surplus pooled filesystem (%s)' % filesystem_id)
+                self.driver.remove_filesystem(filesystem)
+        for layer_id, target in targets.items():
+            while len(self.available.get(layer_id, [])) < target:
+                if not self.create(layer_id):
+                    break
+
+    def create(self, layer_id):
+        # Returns False if layer is gone
+        try:
+            layer = self.driver.prepare_create_filesystem(self.driver.get_layer(layer_id))
+        except LayerUnknownException:
+            with self.lock:
+                self.launches.pop(layer_id, None)
+            return False
+        try:
+            filesystem = get_filesystem_class().create(layer, pooled=True)
+        finally:
+            self.driver.release_layer(layer)
+        log.debug('Pooled filesystem (%s) of layer (%s)' % (filesystem.id, layer_id))
+        with self.lock:
+            self.available.setdefault(layer_id, []).append(filesystem.id)
+        return True
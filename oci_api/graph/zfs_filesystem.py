@@ -14,21 +14,32 @@
 
 import logging
 import pathlib
-import tarfile
-import tempfile
-import humanize
+import threading
 from oci_api import OCIError, oci_config
 from oci_api.util import operating_system
 from oci_api.util.random import generate_random_filesystem_id
 from oci_api.util.zfs import zfs_create, zfs_get, zfs_set, zfs_snapshot, zfs_destroy, \
-    zfs_clone, zfs_diff, zfs_is_filesystem, zfs_rename
-from oci_api.util.file import rm, untar, uncompress, du, sha256sum
+    zfs_clone, zfs_diff, zfs_is_filesystem, zfs_rename, zfs_cache, zfs_configure, zfs_batch, \
+    zfs_list, zfs_inherit, zfs_send_stream, zfs_receive, zfs_receive_stream, async_zfs_create, async_zfs_clone, async_zfs_get, async_zfs_set, async_zfs_destroy, \
+    async_zfs_rename
+from oci_api.util.process import run_blocking
+from oci_api.util.reaper import Reaper
+from oci_api.util.file import rm, du
 from .filesystem import Filesystem
+from .changeset import ChangesetReader
 from .exceptions import FilesystemInUseException
 
 log = logging.getLogger(__name__)
 
+def init_zfs():
+    zfs_config = oci_config['driver']['zfs']
+    zfs_configure(command=zfs_config.get('command'), 
+        channel_programs=zfs_config.get('channel_programs', False))
+    # Every dataset property read by the driver comes from one zfs list of base
+    zfs_cache.add_root(zfs_config['base'], zfs_config.get('cache_ttl', 30))
+
 def create_base_zfs():
+    init_zfs()
     filesystems_path = pathlib.Path(oci_config['global']['path'], 'filesystems')
     if not filesystems_path.is_dir():
         filesystems_path.mkdir(parents=True)
@@ -40,31 +51,163 @@ def create_base_zfs():
         if base_zfs is None:
             raise OCIError('Could not create base zfs (%s)' % base_zfs)
 
+# Layer blobs made with driver.zfs.layer_format = 'send', the zfs send stream
+# of the layer snapshot, incremental from the snapshot of the parent layer
+MediaTypeZFSSend = 'application/vnd.oci-api.layer.v1.zfs-send'
+MediaTypeZFSSendGzip = MediaTypeZFSSend + '+gzip'
+MediaTypeZFSSendZstd = MediaTypeZFSSend + '+zstd'
+
+# User property of the pooled clones, the id of the layer they were cloned from
+POOL_PROPERTY = 'oci:pool'
+
+reaper = None
+reaper_lock = threading.Lock()
+
+def graveyard_zfs():
+    return '%s/graveyard' % oci_config['driver']['zfs']['base']
+
+def destroy_graveyard_zfs(zfs_filesystem):
+    if zfs_destroy(zfs_filesystem, recursive=True) != 0:
+        raise OCIError('Could not destroy zfs filesystem (%s)' % zfs_filesystem)
+
+def get_reaper():
+    # Started by the first deferred destroy of the process, filesystems left
+    # in the graveyard by a previous process (crash, exit with work pending)
+    # are queued again
+    global reaper
+    with reaper_lock:
+        if reaper is None:
+            create_base_zfs()
+            graveyard = graveyard_zfs()
+            if not zfs_is_filesystem(graveyard):
+                log.info('Creating graveyard zfs (%s)' % graveyard)
+                if zfs_create(graveyard, mountpoint='none') != graveyard:
+                    raise OCIError('Could not create graveyard zfs (%s)' % graveyard)
+            reaper = Reaper(destroy_graveyard_zfs, oci_config['driver']['zfs'].get('reapers', 2))
+            for filesystem in zfs_list(graveyard, zfs_type='filesystem', recursive=True, 
+                    properties=['name']):
+                if filesystem['name'].count('/') == graveyard.count('/') + 1:
+                    log.info('Recovering graveyard zfs filesystem (%s)' % filesystem['name'])
+                    reaper.add(filesystem['name'])
+        return reaper
+
 class ZFSFilesystem(Filesystem):
     @classmethod
-    def create(cls, layer):
+    def create(cls, layer, pooled=False):
         create_base_zfs()
-        filesystem_id = generate_random_filesystem_id()
-        zfs_filesystem = '%s/%s' % (oci_config['driver']['zfs']['base'], filesystem_id)
-        mountpoint = pathlib.Path(oci_config['global']['path'], 'filesystems', filesystem_id)
+        (filesystem_id, zfs_filesystem, mountpoint) = cls.new_filesystem()
+        properties = None
+        if pooled:
+            mountpoint = 'none'
+            properties = {POOL_PROPERTY: layer.id}
+        if layer is None:
+            log.debug('Creating filesystem (%s)' % zfs_filesystem)
+            if zfs_create(zfs_filesystem, mountpoint=mountpoint) != zfs_filesystem:
+                raise OCIError('Could not create zfs filesystem (%s)' % zfs_filesystem)
+        else:
+            origin = layer.filesystem
+            log.debug('Cloning filesystem (%s) from (%s)' 
+                % (zfs_filesystem, origin.zfs_snapshot))
+            if zfs_clone(zfs_filesystem, origin.zfs_snapshot, mountpoint=mountpoint, 
+                    properties=properties) != zfs_filesystem:
+                raise OCIError('Could not clone zfs filesystem (%s) from zfs snapshot (%s)' % 
+                    (zfs_filesystem, origin.zfs_snapshot))
+        return Filesystem(filesystem_id, layer, None)
+
+    @classmethod
+    async def async_create(cls, layer, pooled=False):
+        await run_blocking(create_base_zfs)
+        (filesystem_id, zfs_filesystem, mountpoint) = cls.new_filesystem()
+        properties = None
+        if pooled:
+            mountpoint = 'none'
+            properties = {POOL_PROPERTY: layer.id}
         if layer is None:
             log.debug('Creating filesystem (%s)' % zfs_filesystem)
-            zfs_filesystem = zfs_create(zfs_filesystem, mountpoint=mountpoint)
-            if zfs_filesystem != zfs_filesystem:
+            if await async_zfs_create(zfs_filesystem, mountpoint=mountpoint) != zfs_filesystem:
                 raise OCIError('Could not create zfs filesystem (%s)' % zfs_filesystem)
         else:
             origin = layer.filesystem
             log.debug('Cloning filesystem (%s) from (%s)' 
                 % (zfs_filesystem, origin.zfs_snapshot))
-            zfs_filesystem = zfs_clone(zfs_filesystem, origin.zfs_snapshot, 
-                mountpoint=mountpoint)
-            if zfs_filesystem != zfs_filesystem:
+            if await async_zfs_clone(zfs_filesystem, origin.zfs_snapshot, 
+                    mountpoint=mountpoint, properties=properties) != zfs_filesystem:
                 raise OCIError('Could not clone zfs filesystem (%s) from zfs snapshot (%s)' % 
                     (zfs_filesystem, origin.zfs_snapshot))
         return Filesystem(filesystem_id, layer, None)
 
+    @classmethod
+    def receive(cls, layer, changeset, media_type):
+        if media_type != MediaTypeZFSSend:
+            filesystem = cls.create(layer)
+            try:
+                filesystem.load_changeset(changeset)
+            except:
+                filesystem.destroy()
+                raise
+            zfs_snapshot('diff', filesystem.zfs_filesystem)
+            filesystem.seal()
+            return filesystem
+        create_base_zfs()
+        (filesystem_id, zfs_filesystem, mountpoint) = cls.new_filesystem()
+        origin = None
+        if layer is not None:
+            origin = layer.filesystem.zfs_snapshot
+        properties = {'mountpoint': 'none'}
+        if not isinstance(changeset, ChangesetReader):
+            log.debug('Receiving filesystem (%s) from (%s)' % (zfs_filesystem, changeset))
+            if zfs_receive(zfs_filesystem, changeset, origin=origin, properties=properties) != 0:
+                raise OCIError('Could not receive zfs filesystem (%s) from (%s)' % 
+                    (zfs_filesystem, changeset))
+            return Filesystem(filesystem_id, layer, None)
+        log.debug('Receiving filesystem (%s) from (%s)' % (zfs_filesystem, changeset.name))
+        if zfs_receive_stream(zfs_filesystem, changeset, origin=origin, properties=properties) != 0:
+            raise OCIError('Could not receive zfs filesystem (%s) from (%s)' % 
+                (zfs_filesystem, changeset.name))
+        filesystem = Filesystem(filesystem_id, layer, None)
+        try:
+            changeset.verify()
+        except:
+            filesystem.destroy()
+            raise
+        return filesystem
+
+    @classmethod
+    def list_pooled(cls):
+        init_zfs()
+        base_zfs = oci_config['driver']['zfs']['base']
+        pooled = {}
+        for filesystem in zfs_list(base_zfs, zfs_type='filesystem', recursive=True, 
+                properties=['name', POOL_PROPERTY]):
+            layer_id = filesystem.get(POOL_PROPERTY)
+            # Only direct children of base, not the graveyard
+            if layer_id is not None and filesystem['name'].count('/') == base_zfs.count('/') + 1:
+                pooled.setdefault(str(layer_id), []).append(filesystem['name'].split('/')[-1])
+        return pooled
+
+    def unpool(self, layer_id):
+        # The property is read from zfs, the cache may still have it
+        # after another process cleared it
+        if str(zfs_get(self.zfs_filesystem, POOL_PROPERTY, cached=False)) != layer_id:
+            return False
+        return zfs_inherit(self.zfs_filesystem, POOL_PROPERTY) == 0
+
+    @classmethod
+    def new_filesystem(cls):
+        # (id, zfs filesystem, mountpoint) of a filesystem to create
+        filesystem_id = generate_random_filesystem_id()
+        zfs_filesystem = '%s/%s' % (oci_config['driver']['zfs']['base'], filesystem_id)
+        mountpoint = pathlib.Path(oci_config['global']['path'], 'filesystems', filesystem_id)
+        return (filesystem_id, zfs_filesystem, mountpoint)
+
+    @classmethod
+    def batch(cls):
+        init_zfs()
+        return zfs_batch()
+
     @property
     def zfs_filesystem(self):
+        init_zfs()
         base_zfs_filesystem = oci_config['driver']['zfs']['base']
         return '%s/%s' % (base_zfs_filesystem, self.id)
 
@@ -80,89 +223,123 @@ class ZFSFilesystem(Filesystem):
         return du(self.path)
 
     def virtual_size(self):
-        # compressed and/or deduplicated size is smaller than actuall size
-        return zfs_get(self.zfs_filesystem, 'used')
+        # compressed and/or deduplicated size is smaller than actuall size.
+        # Only committed filesystems (not mounted) do not change, the used
+        # space of the others is read from zfs, not from the cache.
+        return zfs_get(self.zfs_filesystem, 'used', cached=self.path is None)
+
+    @classmethod
+    def reap(cls, wait=False):
+        # Recovers the graveyard and, with wait, destroys everything in it
+        if not oci_config['driver']['zfs'].get('graveyard', False):
+            return
+        reaper = get_reaper()
+        if wait:
+            reaper.wait()
+
+    @property
+    def graveyard_filesystem(self):
+        return '%s/%s' % (graveyard_zfs(), self.id)
 
     def destroy(self):
         path = self.path
-        if zfs_destroy(self.zfs_filesystem, recursive=True) != 0:
+        if oci_config['driver']['zfs'].get('graveyard', False):
+            self.bury(path)
+            return
+        # Committed filesystems are not mounted, their destroy can be batched
+        if zfs_destroy(self.zfs_filesystem, recursive=True, batch=path is None) != 0:
+            raise OCIError('Could not destroy zfs filesystem (%s)' % self.zfs_filesystem)
+        if path is not None:
+            rm(path)
+
+    def bury(self, path):
+        # Deferred destroy, the filesystem is unmounted and moved into the
+        # graveyard where the reaper threads destroy it
+        reaper = get_reaper()
+        if path is not None:
+            zfs_set(self.zfs_filesystem, mountpoint='none')
+            rm(path)
+        if zfs_rename(self.zfs_filesystem, self.graveyard_filesystem) != 0:
+            raise OCIError('Could not move zfs filesystem (%s) to (%s)' % 
+                (self.zfs_filesystem, self.graveyard_filesystem))
+        reaper.add(self.graveyard_filesystem)
+
+    async def async_destroy(self):
+        path = await async_zfs_get(self.zfs_filesystem, 'mountpoint')
+        if oci_config['driver']['zfs'].get('graveyard', False):
+            await self.async_bury(path)
+            return
+        if await async_zfs_destroy(self.zfs_filesystem, recursive=True) != 0:
             raise OCIError('Could not destroy zfs filesystem (%s)' % self.zfs_filesystem)
         if path is not None:
             rm(path)
 
-    def commit(self, changeset_file_path):
+    async def async_bury(self, path):
+        reaper = await run_blocking(get_reaper)
+        if path is not None:
+            await async_zfs_set(self.zfs_filesystem, mountpoint='none')
+            rm(path)
+        if await async_zfs_rename(self.zfs_filesystem, self.graveyard_filesystem) != 0:
+            raise OCIError('Could not move zfs filesystem (%s) to (%s)' % 
+                (self.zfs_filesystem, self.graveyard_filesystem))
+        reaper.add(self.graveyard_filesystem)
+
+    def changeset_media_type(self):
+        if oci_config['driver']['zfs'].get('layer_format', 'tar') == 'send':
+            return MediaTypeZFSSend
+        return super().changeset_media_type()
+
+    def commit(self, changeset_file):
         zfs_snapshot('diff', self.zfs_filesystem)
-        self.save_changeset(changeset_file_path)
-        diff_id = sha256sum(changeset_file_path)
-        if diff_id is None:
-            raise OCIError('Could not get hash of file (%s)' % str(changeset_file_path))
+        if self.changeset_media_type() == MediaTypeZFSSend:
+            self.save_stream(changeset_file)
+        else:
+            self.save_changeset(changeset_file)
+        self.seal()
+
+    def seal(self):
+        # Committed filesystems are only the origin of clones, not mounted
         previous_path = self.path
         zfs_set(self.zfs_filesystem, mountpoint='none')
         rm(previous_path)
-        return diff_id
-    
-    def load_changeset(self, changeset_file_path):
-        log.debug('Start loading changeset (%s)' % str(changeset_file_path))
-        path = self.path
-        size = 0
-        with tarfile.open(changeset_file_path, "r") as tar_file:
-            for member in tar_file:
-                file_path = pathlib.Path(member.name)
-                if file_path.name.startswith('.wh.'):
-                    file_path = path.joinpath(file_path)
-                    if file_path.name == '.wh..wh..opq':
-                        rm(file_path.parent, recursive=True)
-                    else:
-                        file_path = file_path.parent.joinpath(file_path.name[4:])
-                        rm(file_path)
-                else:
-                    size += member.size
-                    tar_file.extract(member, path)
-        log.debug('Finish loading changeset (%s), size: %s' % 
-            (str(changeset_file_path), humanize.naturalsize(size)))
+
+    def save_stream(self, stream_file):
+        log.debug('Start saving stream of filesystem (%s)' % self.id)
+        origin_snapshot = None
+        if self.layer is not None:
+            origin_snapshot = self.layer.filesystem.zfs_snapshot
+        if zfs_send_stream(self.zfs_snapshot, stream_file, first_snapshot=origin_snapshot, 
+                intermediary=False) != 0:
+            raise OCIError('Could not send zfs snapshot (%s)' % self.zfs_snapshot)
+        log.debug('Finish saving stream of filesystem (%s)' % self.id)
     
-    def save_changeset(self, changeset_file_path):
-        log.debug('Start saving changeset (%s)' % str(changeset_file_path))
+    def diff(self):
         origin_snapshot = None
         if self.layer is not None:
             origin_snapshot = self.layer.filesystem.zfs_snapshot
-        with tarfile.open(changeset_file_path, "w") as tar_file:
-            with tempfile.NamedTemporaryFile() as wh_temp_file:
-                path = self.path
-                for change_info in zfs_diff(self.zfs_snapshot, origin_snapshot):
-                    change_type = change_info[0]
-                    file_path = pathlib.Path(change_info[1])
-                    if file_path != path:
-                        if change_type == 'M' or change_type == '+':
-                            tar_file.add(file_path, arcname=file_path.relative_to(path), recursive=False)
-                        elif change_type == '-' or change_type == 'R':
-                            file_path = file_path.parent.joinpath('.wh.' + file_path.name)
-                            tar_file.add(wh_temp_file.name, arcname=file_path.relative_to(path), recursive=False)
-                        if change_type == 'R':
-                            file_path = pathlib.Path(change_info[2])
-                            tar_file.add(file_path, arcname=file_path.relative_to(path), recursive=False)
-        log.debug('Finish saving changeset (%s)' % str(changeset_file_path))
+        return zfs_diff(self.zfs_snapshot, origin_snapshot)
 
     def mount(self, container_id, path):
-        if self.container_id is not None:
-            if self.container_id == container_id:
-                log.warning('Filesystem (%s) already mounted for container (%s)' % (self.id, container_id))
-                if self.path != path:
-                    raise OCIError('Filesystem (%s) path (%s) should be (%s)' % (self.id, self.path, path))
-            else:
-                raise OCIError('Filesystem (%s) already mounted for container (%s)' % (self.id, self.container_id))
-        else:
-            self.container_id = container_id
-            previous_path = self.path
-            zfs_set(self.zfs_filesystem, mountpoint=path)
+        if self.is_mounted_for(container_id, path):
+            return
+        self.container_id = container_id
+        previous_path = self.path
+        zfs_set(self.zfs_filesystem, mountpoint=path)
+        # Pooled filesystems have no mountpoint
+        if previous_path is not None:
+            rm(previous_path)
+
+    async def async_mount(self, container_id, path):
+        if self.is_mounted_for(container_id, path):
+            return
+        self.container_id = container_id
+        previous_path = await async_zfs_get(self.zfs_filesystem, 'mountpoint')
+        await async_zfs_set(self.zfs_filesystem, mountpoint=path)
+        if previous_path is not None:
             rm(previous_path)
 
     def unmount(self, container_id):
-        if self.container_id is None:
-            raise OCIError('Filesystem (%s) is not mounted' % self.id)
-        if self.container_id != container_id:
-            raise OCIError('Filesystem (%s) mounted for container (%s), not (%s)' % 
-                (self.id, self.container_id, container_id))
-        self.container_id = None
-        mountpoint = pathlib.Path(oci_config['global']['path'], 'filesystems', self.id)
-        zfs_set(self.zfs_filesystem, mountpoint=mountpoint)
+        zfs_set(self.zfs_filesystem, mountpoint=self.prepare_unmount(container_id))
+
+    async def async_unmount(self, container_id):
+        await async_zfs_set(self.zfs_filesystem, mountpoint=self.prepare_unmount(container_id))
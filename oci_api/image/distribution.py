@@ -15,9 +15,16 @@
 import json
 import pathlib
 import logging
+import threading
+import contextlib
 from oci_api import oci_config, OCIError
 from oci_api.util import Singleton, normalize_image_name, split_image_name
-from oci_api.util.file import rm
+from oci_api.util.file import rm, atomic_write, file_stamp
+from oci_api.util.lock import FileLock
+from oci_api.util.snapshot import Snapshot, write_snapshot
+from oci_api.util.process import run_blocking
+from oci_api.metadata import Database
+from oci_api.graph import Driver
 from .image import Image
 from .exceptions import ImageInUseException, ImageUnknownException, TagUnknownException
 
@@ -27,14 +34,57 @@ class Distribution(metaclass=Singleton):
     def __init__(self):
         log.debug('Creating instance of %s()' % type(self).__name__)
         self.images = None
+        self.database = None
+        self.stamp = None
+        self.generation = None
+        self.mutex = threading.RLock()
         distribution_path = pathlib.Path(oci_config['global']['path'])
         distribution_file_path = distribution_path.joinpath('distribution.json')
-        if distribution_file_path.is_file():
-            self.load()
-        else:
-            self.create()
+        self.lock = FileLock(distribution_path.joinpath('distribution.lock'))
+        if oci_config['global']['metadata'] == 'sqlite':
+            self.database = Database()
+        elif not distribution_file_path.is_file():
+            with self.lock.exclusive():
+                if not distribution_file_path.is_file():
+                    self.create()
+        self.refresh()
+
+    def refresh(self):
+        # Reload if another process changed the distribution since the last
+        # load, images that are still there keep their (already loaded) objects
+        with self.mutex, self.lock.shared():
+            if self.database is not None:
+                if self.images is not None and \
+                        self.database.get_generation('distribution') == self.generation:
+                    return
+            else:
+                distribution_path = pathlib.Path(oci_config['global']['path'])
+                distribution_file_path = distribution_path.joinpath('distribution.json')
+                if self.images is not None and file_stamp(distribution_file_path) == self.stamp:
+                    return
+            previous_images = self.images
+            self.images = None
+            if self.database is not None:
+                self.load_database(previous_images)
+            else:
+                self.load(previous_images)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.mutex, self.lock.exclusive():
+            self.refresh()
+            yield self
 
-    def load(self):
+    def reuse_image(self, previous_images, image_id, tags):
+        image = None
+        if previous_images is not None:
+            image = previous_images.get(image_id)
+        if image is None:
+            return Image(image_id, tags)
+        image.tags = tags
+        return image
+
+    def load(self, previous_images=None):
         if self.images is not None:
             raise OCIError('Distribution already loaded')
         distribution_path = pathlib.Path(oci_config['global']['path'])
@@ -42,17 +92,68 @@ class Distribution(metaclass=Singleton):
         log.debug('Start loading distribution file (%s)' % distribution_file_path)
         if not distribution_file_path.is_file():
             raise OCIError('Distribution file (%s) does not exist' % distribution_file_path)
+        self.stamp = file_stamp(distribution_file_path)
+        if self.load_snapshot(previous_images):
+            log.debug('Finish loading distribution file (%s)' % distribution_file_path)
+            return
         with distribution_file_path.open() as distribution_file:
             self.images = {}
             images_json = json.load(distribution_file)
             for image_json in images_json['images']:
                 image_id = image_json['id']
                 tags = image_json['tags'] or []
-                from .image import Image
-                image = Image(image_id, tags)
-                self.images[image_id] = image
+                self.images[image_id] = self.reuse_image(previous_images, image_id, tags)
+        self.save_snapshot()
         log.debug('Finish loading distribution file (%s)' % distribution_file_path)
 
+    def load_snapshot(self, previous_images=None):
+        if not oci_config['global']['snapshot']:
+            return False
+        distribution_path = pathlib.Path(oci_config['global']['path'])
+        snapshot = Snapshot.open(distribution_path.joinpath('distribution.snapshot'), self.stamp)
+        if snapshot is None:
+            return False
+        with snapshot:
+            tags = {}
+            for image_index, tag in snapshot.rows(1):
+                tags.setdefault(image_index, []).append(tag)
+            self.images = {}
+            for image_index, (image_id,) in enumerate(snapshot.rows(0)):
+                self.images[image_id] = self.reuse_image(previous_images, image_id, 
+                    tags.get(image_index, []))
+        return True
+
+    def save_snapshot(self):
+        if not oci_config['global']['snapshot']:
+            return
+        distribution_path = pathlib.Path(oci_config['global']['path'])
+        images = list(self.images.values())
+        try:
+            write_snapshot(distribution_path.joinpath('distribution.snapshot'), self.stamp, 0, [
+                ('s', ((image.id,) for image in images)),
+                ('qs', (
+                    (image_index, tag)
+                        for image_index, image in enumerate(images)
+                            for tag in image.tags
+                ))
+            ])
+        except OSError as e:
+            log.warning('Could not write distribution snapshot: %s' % e)
+
+    def load_database(self, previous_images=None):
+        if self.images is not None:
+            raise OCIError('Distribution already loaded')
+        log.debug('Start loading distribution database (%s)' % self.database.file_path)
+        self.generation = self.database.get_generation('distribution')
+        tags = {}
+        for tag, image_id in self.database.select('SELECT tag, image_id FROM tags ORDER BY rowid'):
+            tags.setdefault(image_id, []).append(tag)
+        self.images = {}
+        for (image_id,) in self.database.select('SELECT id FROM images ORDER BY rowid'):
+            self.images[image_id] = self.reuse_image(previous_images, image_id, 
+                tags.get(image_id, []))
+        log.debug('Finish loading distribution database (%s)' % self.database.file_path)
+
     def create(self):
         distribution_path = pathlib.Path(oci_config['global']['path'])
         distribution_file_path = distribution_path.joinpath('distribution.json')
@@ -82,10 +183,20 @@ class Distribution(metaclass=Singleton):
         distribution_json = {
             'images': images_json
         }
-        with distribution_file_path.open('w') as distribution_file:
-            json.dump(distribution_json, distribution_file, separators=(',', ':'))
+        atomic_write(distribution_file_path, 
+            json.dumps(distribution_json, separators=(',', ':')).encode())
+        self.stamp = file_stamp(distribution_file_path)
+        self.save_snapshot()
         log.debug('Finish saving distribution file (%s)' % distribution_file_path)
 
+    def write_record(self, operation, **arguments):
+        if self.database is None:
+            self.save()
+        else:
+            record = {'operation': operation}
+            record.update(arguments)
+            self.generation = self.database.write_records([record], 'distribution')
+
     def get_repositories(self, image):
         tags = image.tags
         repositories = []
@@ -95,11 +206,13 @@ class Distribution(metaclass=Singleton):
         return repositories
 
     def get_image_by_id(self, image_id):        
-        for image in self.images.values():                
-            if image.id == image_id:
-                return image
-            if image.small_id == image_id:
-                return image
+        with self.mutex:
+            self.refresh()
+            for image in self.images.values():                
+                if image.id == image_id:
+                    return image
+                if image.small_id == image_id:
+                    return image
         raise ImageUnknownException('Image (%s) is unknown' % image_id)
         
     def get_image(self, image_ref):        
@@ -112,48 +225,69 @@ class Distribution(metaclass=Singleton):
             return self.get_image_by_id(image_ref)
         except ImageUnknownException:
             image_name = normalize_image_name(image_ref)
-            for image in self.images.values():
-                if image_name in image.tags:
-                    return image
+            with self.mutex:
+                for image in self.images.values():
+                    if image_name in image.tags:
+                        return image
         raise ImageUnknownException('Image (%s) is unknown' % image_ref)
 
     def create_image(self, config, layers):
         log.debug('Start creating image')
-        image = Image.create(config, layers)
-        self.images[image.id] = image
-        self.save()
+        with self.locked():
+            with Driver().transaction():
+                image = Image.create(config, layers)
+            self.images[image.id] = image
+            self.write_record('create_image', id=image.id)
         log.debug('Finish creating image (%s)' % image.id)
         return image
 
+    async def async_create_image(self, config, layers):
+        # Image creation keeps the distribution locked, it runs in a thread
+        return await run_blocking(self.create_image, config, layers)
+
     def remove_image(self, image, force=False):
         image_id = image.id
         log.debug('Start removing image (%s)' % image_id)
-        if self.images is None:
-            raise ImageUnknownException('Distribution images is not initialized, can not remove image (%s)' % image_id)
-        if image_id not in self.images:
-            raise ImageUnknownException('Image is unknown, can not remove image (%s)' % image_id)
-        image.destroy()
-        del self.images[image_id]
-        self.save()
+        with self.locked():
+            if self.images is None:
+                raise ImageUnknownException('Distribution images is not initialized, can not remove image (%s)' % image_id)
+            if image_id not in self.images:
+                raise ImageUnknownException('Image is unknown, can not remove image (%s)' % image_id)
+            image = self.images[image_id]
+            with Driver().transaction():
+                image.destroy()
+            del self.images[image_id]
+            self.write_record('remove_image', id=image_id)
         log.debug('Finish removing image (%s)' % image_id)
 
+    async def async_remove_image(self, image, force=False):
+        return await run_blocking(self.remove_image, image, force)
+
     def add_tag(self, image, tag):
         log.debug('Start adding tag (%s) to image (%s)' % (tag, image.id))
         normalized_tag = normalize_image_name(tag)
-        try:
-            other_image = self.get_image(normalized_tag)
-            if other_image != image:
-                self.remove_tag(other_image, normalized_tag)
+        with self.locked():
+            if image.id not in self.images:
+                raise ImageUnknownException('Image is unknown, can not add tag to image (%s)' % image.id)
+            image = self.images[image.id]
+            try:
+                other_image = self.get_image(normalized_tag)
+                if other_image != image:
+                    self.remove_tag(other_image, normalized_tag)
+                    image.add_tag(normalized_tag)
+                    self.write_record('add_tag', image=image.id, tag=normalized_tag)
+            except ImageUnknownException:
                 image.add_tag(normalized_tag)
-                self.save()
-        except ImageUnknownException:
-            image.add_tag(normalized_tag)
-            self.save()
+                self.write_record('add_tag', image=image.id, tag=normalized_tag)
         log.debug('Finish adding tag (%s) to image (%s)' % (tag, image.id))
 
     def remove_tag(self, image, tag):
         log.debug('Start removing tag (%s) from image (%s)' % (tag, image.id))
         normalized_tag = normalize_image_name(tag)
-        image.remove_tag(normalized_tag)
-        self.save()
+        with self.locked():
+            if image.id not in self.images:
+                raise ImageUnknownException('Image is unknown, can not remove tag from image (%s)' % image.id)
+            image = self.images[image.id]
+            image.remove_tag(normalized_tag)
+            self.write_record('remove_tag', image=image.id, tag=normalized_tag)
         log.debug('Finish removing tag (%s) from image (%s)' % (tag, image.id))
@@ -24,7 +24,7 @@ from oci_spec.image.v1 import ImageConfig, Descriptor, \
 from oci_api import oci_config, OCIError
 from oci_api.util import digest_to_id, id_to_digest, architecture, operating_system, \
     normalize_image_name
-from oci_api.util.file import rm, sha256sum, untar, cp
+from oci_api.util.file import rm, sha256sum, untar, atomic_write, place_file
 from oci_api.graph import Driver, LayerInUseException
 from .exceptions import ImageInUseException
 
@@ -68,7 +68,7 @@ def save_config(config):
     if not configs_path.is_dir():
         configs_path.mkdir(parents=True)
     config_file_path = configs_path.joinpath(config_id)
-    config_file_path.write_bytes(config_json)
+    atomic_write(config_file_path, config_json)
     config_descriptor = Descriptor(
         digest=id_to_digest(config_id),
         size=len(config_json),
@@ -96,7 +96,7 @@ def save_manifest(manifest):
     if not manifests_path.is_dir():
         manifests_path.mkdir(parents=True)
     manifest_file_path = manifests_path.joinpath(manifest_id)
-    manifest_file_path.write_bytes(manifest_json)
+    atomic_write(manifest_file_path, manifest_json)
     manifest_descriptor = Descriptor(
         digest=id_to_digest(manifest_id),
         size=len(manifest_json),
@@ -185,6 +185,28 @@ class Image():
             self.copy_config(config_file_path)
         self.load_layers(path)
 
+    def copy_manifest(self, manifest_file_path):
+        # Manifest of an image loaded from path (an image layout) into
+        # manifests/, staged in manifests/ and renamed
+        manifests_path = pathlib.Path(oci_config['global']['path'], 'manifests')
+        self.copy_blob(manifest_file_path, manifests_path.joinpath(self.id))
+
+    def copy_config(self, config_file_path):
+        configs_path = pathlib.Path(oci_config['global']['path'], 'configs')
+        config_id = self.manifest.get('Config').get('Digest').encoded()
+        self.copy_blob(config_file_path, configs_path.joinpath(config_id))
+
+    def copy_blob(self, file_path, blob_file_path):
+        # Same digest, same contents: an existing file is kept
+        if blob_file_path.is_file():
+            return
+        if not blob_file_path.parent.is_dir():
+            blob_file_path.parent.mkdir(parents=True)
+        if sha256sum(file_path) != blob_file_path.name:
+            raise OCIError('File (%s) does not match digest (%s)' % (str(file_path), 
+                blob_file_path.name))
+        place_file(file_path, blob_file_path)
+
     def load_layers(self, path=None):
         log.debug('Start loading image (%s) layers' % self.id)
         if self.config is None:
@@ -0,0 +1,183 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import pathlib
+import sqlite3
+import logging
+import threading
+from oci_api import oci_config
+from oci_api.util import Singleton
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS generations (
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS filesystems (
+    id TEXT PRIMARY KEY,
+    layer_id TEXT,
+    container_id TEXT UNIQUE
+);
+CREATE INDEX IF NOT EXISTS filesystems_layer_id ON filesystems (layer_id);
+CREATE TABLE IF NOT EXISTS layers (
+    id TEXT PRIMARY KEY,
+    descriptor TEXT NOT NULL,
+    diff_id TEXT NOT NULL UNIQUE,
+    filesystem_id TEXT NOT NULL UNIQUE,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS image_references (
+    layer_id TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    PRIMARY KEY (layer_id, image_id)
+);
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT PRIMARY KEY,
+    image_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_image_id ON tags (image_id);
+CREATE TABLE IF NOT EXISTS containers (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    create_time TEXT NOT NULL
+);
+'''
+
+# Statements run for each record written by Driver, Distribution and Runtime,
+# the named parameters are taken from the record itself
+STATEMENTS = {
+    'create_filesystem': [
+        'INSERT INTO filesystems (id, layer_id) VALUES (:id, :layer)'
+    ],
+    'mount_filesystem': [
+        'UPDATE filesystems SET container_id = :container_id WHERE id = :id'
+    ],
+    'unmount_filesystem': [
+        'UPDATE filesystems SET container_id = NULL WHERE id = :id'
+    ],
+    'remove_filesystem': [
+        'DELETE FROM filesystems WHERE id = :id'
+    ],
+    'create_layer': [
+        'INSERT INTO layers (id, descriptor, diff_id, filesystem_id, size) '
+            'VALUES (:id, :descriptor, :diff_id, :filesystem, :size)'
+    ],
+    'remove_layer': [
+        'DELETE FROM image_references WHERE layer_id = :id',
+        'DELETE FROM layers WHERE id = :id'
+    ],
+    'add_image_reference': [
+        'INSERT INTO image_references (layer_id, image_id) VALUES (:layer, :image)'
+    ],
+    'remove_image_reference': [
+        'DELETE FROM image_references WHERE layer_id = :layer AND image_id = :image'
+    ],
+    'create_image': [
+        'INSERT INTO images (id) VALUES (:id)'
+    ],
+    'remove_image': [
+        'DELETE FROM tags WHERE image_id = :id',
+        'DELETE FROM images WHERE id = :id'
+    ],
+    'add_tag': [
+        'INSERT INTO tags (tag, image_id) VALUES (:tag, :image)'
+    ],
+    'remove_tag': [
+        'DELETE FROM tags WHERE tag = :tag AND image_id = :image'
+    ],
+    'create_container': [
+        'INSERT INTO containers (id, name, create_time) VALUES (:id, :name, :create_time)'
+    ],
+    'remove_container': [
+        'DELETE FROM containers WHERE id = :id'
+    ]
+}
+
+def record_parameters(record):
+    parameters = {}
+    for key, value in record.items():
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, separators=(',', ':'))
+        parameters[key] = value
+    return parameters
+
+class Database(metaclass=Singleton):
+    def __init__(self):
+        log.debug('Creating instance of %s()' % type(self).__name__)
+        database_path = pathlib.Path(oci_config['global']['path'])
+        if not database_path.is_dir():
+            database_path.mkdir(parents=True)
+        self.file_path = database_path.joinpath('metadata.db')
+        log.debug('Start opening database (%s)' % self.file_path)
+        # The connection is shared by the threads of the process, statements
+        # and transactions are serialized with the mutex
+        self.mutex = threading.RLock()
+        self.connection = sqlite3.connect(str(self.file_path), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        log.debug('Finish opening database (%s)' % self.file_path)
+
+    def select(self, sql, parameters=()):
+        with self.mutex:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def get_setting(self, key):
+        rows = self.select('SELECT value FROM settings WHERE key = ?', (key,))
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    def set_setting(self, key, value):
+        with self.mutex, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    def get_generation(self, name):
+        # Bumped on every write of the named store, lets other processes
+        # detect that their in memory copy is stale
+        rows = self.select('SELECT generation FROM generations WHERE name = ?', (name,))
+        if len(rows) == 0:
+            return 0
+        return rows[0][0]
+
+    def is_empty(self):
+        for table in ['filesystems', 'layers', 'images', 'containers']:
+            if len(self.select('SELECT 1 FROM %s LIMIT 1' % table)) != 0:
+                return False
+        return True
+
+    def write_records(self, records, generation_name=None):
+        generation = None
+        with self.mutex, self.connection:
+            for record in records:
+                parameters = record_parameters(record)
+                for sql in STATEMENTS[record['operation']]:
+                    self.connection.execute(sql, parameters)
+            if generation_name is not None:
+                self.connection.execute(
+                    'INSERT INTO generations (name, generation) VALUES (?, 1) '
+                        'ON CONFLICT (name) DO UPDATE SET generation = generation + 1',
+                    (generation_name,))
+                generation = self.get_generation(generation_name)
+        return generation
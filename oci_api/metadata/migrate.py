@@ -0,0 +1,110 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+import logging
+from oci_api import oci_config, OCIError
+from oci_api.util import Singleton
+from oci_api.util.file import mv
+from .database import Database
+
+log = logging.getLogger(__name__)
+
+def driver_records(driver):
+    records = []
+    for filesystem in driver.filesystems.values():
+        records.append({
+            'operation': 'create_filesystem',
+            'id': filesystem.id,
+            'layer': filesystem.layer.id if filesystem.layer is not None else None
+        })
+        if filesystem.container_id is not None:
+            records.append({
+                'operation': 'mount_filesystem',
+                'id': filesystem.id,
+                'container_id': filesystem.container_id
+            })
+    for layer in driver.layers.values():
+        records.append({
+            'operation': 'create_layer',
+            'id': layer.id,
+            'descriptor': layer.descriptor_to_dict(),
+            'diff_id': layer.diff_id,
+            'filesystem': layer.filesystem.id,
+            'size': layer.size
+        })
+        for image_id in layer.images:
+            records.append({
+                'operation': 'add_image_reference',
+                'layer': layer.id,
+                'image': image_id
+            })
+    return records
+
+def distribution_records(distribution):
+    records = []
+    for image in distribution.images.values():
+        records.append({'operation': 'create_image', 'id': image.id})
+        for tag in image.tags:
+            records.append({'operation': 'add_tag', 'image': image.id, 'tag': tag})
+    return records
+
+def runtime_records(runtime):
+    records = []
+    for container in runtime.containers.values():
+        record = {'operation': 'create_container'}
+        record.update(container.to_json())
+        records.append(record)
+    return records
+
+def migrate_json_to_sqlite():
+    # One shot conversion of driver.json (and its journal), distribution.json
+    # and runtime.json into metadata.db, the json files are kept renamed with
+    # a .migrated suffix
+    from oci_api.graph import Driver
+    from oci_api.image import Distribution
+    from oci_api.runtime import Runtime
+    metadata_path = pathlib.Path(oci_config['global']['path'])
+    file_names = ['driver.json', 'distribution.json', 'runtime.json']
+    log.debug('Start migrating metadata (%s) to sqlite' % metadata_path)
+    for file_name in file_names:
+        if not metadata_path.joinpath(file_name).is_file():
+            raise OCIError('Metadata file (%s) does not exist, can not migrate' 
+                % metadata_path.joinpath(file_name))
+    database = Database()
+    if not database.is_empty():
+        raise OCIError('Database (%s) is not empty, can not migrate' % database.file_path)
+    classes = [Driver, Distribution, Runtime]
+    metadata = oci_config['global']['metadata']
+    oci_config['global']['metadata'] = 'json'
+    try:
+        for cls in classes:
+            Singleton._instances.pop(cls, None)
+        driver = Driver()
+        distribution = Distribution()
+        runtime = Runtime()
+        records = driver_records(driver) + distribution_records(distribution) + \
+            runtime_records(runtime)
+    finally:
+        oci_config['global']['metadata'] = metadata
+        for cls in classes:
+            Singleton._instances.pop(cls, None)
+    database.set_setting('driver_type', oci_config['driver']['type'])
+    database.write_records(records)
+    for file_name in file_names + ['driver.journal']:
+        file_path = metadata_path.joinpath(file_name)
+        if file_path.is_file():
+            mv(file_path, file_path.with_name(file_name + '.migrated'))
+    log.info('Migrated %i metadata records to (%s)' % (len(records), database.file_path))
+    log.debug('Finish migrating metadata (%s) to sqlite' % metadata_path)
@@ -21,7 +21,7 @@ from oci_spec.runtime.v1 import Spec, Platform, Process, User, Root, Solaris, So
 from oci_api import oci_config, OCIError
 from oci_api.util import generate_random_sha256, digest_to_id, id_to_digest, operating_system, architecture
 from oci_api.util.runc import runc_create, runc_delete, runc_exec, \
-    runc_start
+    runc_start, async_runc_create, async_runc_delete, async_runc_start
 from oci_api.util.file import rm
 from oci_api.graph import Driver
 
@@ -37,6 +37,30 @@ class Container():
     def create(cls, image, name, command=None, workdir=None):
         log.debug('Start creating container named (%s) from image (%s)' % (name, image.id))
         create_time = datetime.utcnow()
+        (container_id, container_path, root_path, config) = cls.prepare(image, command, workdir)
+        filesystem = Driver().create_filesystem(image.top_layer())
+        Driver().mount_filesystem(filesystem, container_id, root_path)
+        config.save(container_path.joinpath('config.json'))
+        runc_create(container_id[:12], container_path)
+        log.debug('Finish creating container named (%s) from image (%s)' % (name, image.id))
+        return cls(container_id, name, create_time)
+
+    @classmethod
+    async def async_create(cls, image, name, command=None, workdir=None):
+        log.debug('Start creating container named (%s) from image (%s)' % (name, image.id))
+        create_time = datetime.utcnow()
+        (container_id, container_path, root_path, config) = cls.prepare(image, command, workdir)
+        filesystem = await Driver().async_create_filesystem(image.top_layer())
+        await Driver().async_mount_filesystem(filesystem, container_id, root_path)
+        config.save(container_path.joinpath('config.json'))
+        await async_runc_create(container_id[:12], container_path)
+        log.debug('Finish creating container named (%s) from image (%s)' % (name, image.id))
+        return cls(container_id, name, create_time)
+
+    @classmethod
+    def prepare(cls, image, command=None, workdir=None):
+        # Returns the id, bundle path, root filesystem path and runtime config
+        # of a new container
         os = image.config.get('OS')
         if os != operating_system():
             raise OCIError('Image (%s) operating system (%s) is not supported' % (image.id, os))
@@ -52,7 +76,6 @@ class Container():
         args = command or image_config_config.get('Cmd') or ['/bin/sh']
         env = image_config_config.get('Env') or []
         cwd = workdir or image_config_config.get('WorkingDir') or '/'
-        layer = image.top_layer()
         container_path = pathlib.Path(oci_config['global']['path'], 'containers', container_id)
         if not container_path.is_dir():
             container_path.mkdir(parents=True)
@@ -62,8 +85,6 @@ class Container():
         if os == 'SunOS':
             solaris = Solaris(anet=[SolarisAnet()])
             root_path = rootfs_path.joinpath('root')
-        filesystem = Driver().create_filesystem(layer)
-        Driver().mount_filesystem(filesystem, container_id, root_path)
         config = Spec(
             platform=Platform(os=os, arch=arch),
             hostname=runc_id,
@@ -71,11 +92,7 @@ class Container():
             root=Root(path=str(rootfs_path), readonly=False),
             solaris=solaris
         )
-        config_file_path = container_path.joinpath('config.json')
-        config.save(config_file_path)
-        runc_create(runc_id, container_path)
-        log.debug('Finish creating container named (%s) from image (%s)' % (name, image.id))
-        return cls(container_id, name, create_time)
+        return (container_id, container_path, root_path, config)
 
     def __init__(self, id, name, create_time):
         log.debug('Creating instance of %s(%s)' % (type(self).__name__, id))
@@ -141,6 +158,20 @@ class Container():
         if container_status != 'exited':
             self.delete_container()
         Driver().unmount_filesystem(self.id, remove=remove_filesystem)
+        self.remove_files()
+        log.debug('Finish destroying container (%s)' % container_id)
+
+    async def async_destroy(self, remove_filesystem=True):
+        container_id = self.id
+        log.debug('Start destroying container (%s)' % container_id)
+        container_status = self.status()
+        if container_status != 'exited':
+            await self.async_delete_container()
+        await Driver().async_unmount_filesystem(self.id, remove=remove_filesystem)
+        self.remove_files()
+        log.debug('Finish destroying container (%s)' % container_id)
+
+    def remove_files(self):
         container_path = pathlib.Path(oci_config['global']['path'], 'containers', self.id)
         rm(container_path.joinpath('config.json'))
         rootfs_path = pathlib.Path(self.config.get('Root').get('Path'))
@@ -152,20 +183,31 @@ class Container():
         self.id = None
         self.name = None
         self.create_time = None
-        log.debug('Finish destroying container (%s)' % container_id)
 
     def delete_container(self):
         container_status = self.status
         force = container_status == 'running'
         runc_delete(self.runc_id, force)
 
+    async def async_delete_container(self):
+        container_status = self.status
+        force = container_status == 'running'
+        await async_runc_delete(self.runc_id, force)
+
     def exec(self, command, args=None):
         raise NotImplementedError()
         runc_exec(self.runc_id, command, args)
 
     def start(self):
+        self.check_start()
+        runc_start(self.runc_id)
+
+    async def async_start(self):
+        self.check_start()
+        await async_runc_start(self.runc_id)
+
+    def check_start(self):
         container_state = self.state()
         if container_state == 'created' or container_state == 'stopped':
             raise OCIError('Can not start container (%s) in state (%s)' % 
                 (self.id, container_state))
-        runc_start(self.runc_id)
\ No newline at end of file
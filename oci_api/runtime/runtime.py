@@ -15,11 +15,18 @@
 import json
 import pathlib
 import logging
+import threading
+import contextlib
 from dateutil import parser
 from oci_api import oci_config, OCIError
 from oci_api.util import Singleton, generate_random_name
+from oci_api.util.file import atomic_write, file_stamp
+from oci_api.util.lock import FileLock
+from oci_api.util.snapshot import Snapshot, write_snapshot
+from oci_api.metadata import Database
+from oci_api.graph import Driver
 from .container import Container
-from .exceptions import ContainerUnknownException
+from .exceptions import ContainerUnknownException, ContainerInUseException
 
 log = logging.getLogger(__name__)
 
@@ -27,25 +34,111 @@ class Runtime(metaclass=Singleton):
     def __init__(self):
         log.debug('Creating instance of %s()' % type(self).__name__)
         self.containers = None
+        self.database = None
+        self.stamp = None
+        self.generation = None
+        self.mutex = threading.RLock()
+        # Names taken by containers being created and ids of containers being
+        # removed, the (slow) container work runs without the runtime locked
+        self.reserved_names = set()
+        self.removing = set()
         runtime_path = pathlib.Path(oci_config['global']['path'])
         runtime_file_path = runtime_path.joinpath('runtime.json')
-        if runtime_file_path.is_file():
-            self.load()
-        else:
-            self.create()
+        self.lock = FileLock(runtime_path.joinpath('runtime.lock'))
+        if oci_config['global']['metadata'] == 'sqlite':
+            self.database = Database()
+        elif not runtime_file_path.is_file():
+            with self.lock.exclusive():
+                if not runtime_file_path.is_file():
+                    self.create()
+        self.refresh()
+
+    def refresh(self):
+        # Reload if another process changed the runtime since the last load,
+        # containers that are still there keep their objects
+        with self.mutex, self.lock.shared():
+            if self.database is not None:
+                if self.containers is not None and \
+                        self.database.get_generation('runtime') == self.generation:
+                    return
+            else:
+                runtime_path = pathlib.Path(oci_config['global']['path'])
+                runtime_file_path = runtime_path.joinpath('runtime.json')
+                if self.containers is not None and file_stamp(runtime_file_path) == self.stamp:
+                    return
+            previous_containers = self.containers
+            if self.database is not None:
+                self.load_database(previous_containers)
+            else:
+                self.load(previous_containers)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.mutex, self.lock.exclusive():
+            self.refresh()
+            yield self
 
-    def load(self):
+    def reuse_container(self, previous_containers, container_id, name, create_time):
+        if previous_containers is not None and container_id in previous_containers:
+            return previous_containers[container_id]
+        return Container(container_id, name, parser.isoparse(create_time))
+
+    def load(self, previous_containers=None):
         runtime_path = pathlib.Path(oci_config['global']['path'])
         runtime_file_path = runtime_path.joinpath('runtime.json')
+        self.stamp = file_stamp(runtime_file_path)
+        if self.load_snapshot(previous_containers):
+            return
         with runtime_file_path.open() as runtime_file:
             runtime = json.load(runtime_file)
             self.containers = {}
             for container_json in runtime.get('containers', []):
                 container_id = container_json['id']
                 name = container_json['name']
-                create_time = parser.isoparse(container_json['create_time'])
-                container = Container(container_id, name, create_time)
+                create_time = container_json['create_time']
+                container = self.reuse_container(previous_containers, container_id, 
+                    name, create_time)
+                self.containers[container_id] = container
+        self.save_snapshot()
+
+    def load_snapshot(self, previous_containers=None):
+        if not oci_config['global']['snapshot']:
+            return False
+        runtime_path = pathlib.Path(oci_config['global']['path'])
+        snapshot = Snapshot.open(runtime_path.joinpath('runtime.snapshot'), self.stamp)
+        if snapshot is None:
+            return False
+        with snapshot:
+            self.containers = {}
+            for container_id, name, create_time in snapshot.rows(0):
+                container = self.reuse_container(previous_containers, container_id, 
+                    name, create_time)
                 self.containers[container_id] = container
+        return True
+
+    def save_snapshot(self):
+        if not oci_config['global']['snapshot']:
+            return
+        runtime_path = pathlib.Path(oci_config['global']['path'])
+        try:
+            write_snapshot(runtime_path.joinpath('runtime.snapshot'), self.stamp, 0, [
+                ('sss', (
+                    (container_json['id'], container_json['name'], container_json['create_time'])
+                        for container_json in 
+                            (container.to_json() for container in self.containers.values())
+                ))
+            ])
+        except OSError as e:
+            log.warning('Could not write runtime snapshot: %s' % e)
+
+    def load_database(self, previous_containers=None):
+        self.generation = self.database.get_generation('runtime')
+        self.containers = {}
+        for container_id, name, create_time in self.database.select(
+                'SELECT id, name, create_time FROM containers ORDER BY rowid'):
+            container = self.reuse_container(previous_containers, container_id, 
+                name, create_time)
+            self.containers[container_id] = container
 
     def create(self):
         runtime_path = pathlib.Path(oci_config['global']['path'])
@@ -64,45 +157,121 @@ class Runtime(metaclass=Singleton):
             'containers': containers
         }
         runtime_file_path = runtime_path.joinpath('runtime.json')
-        with runtime_file_path.open('w') as runtime_file:
-            json.dump(runtime_json, runtime_file, separators=(',', ':'))
+        atomic_write(runtime_file_path, json.dumps(runtime_json, separators=(',', ':')).encode())
+        self.stamp = file_stamp(runtime_file_path)
+        self.save_snapshot()
+
+    def write_record(self, operation, **arguments):
+        if self.database is None:
+            self.save()
+        else:
+            record = {'operation': operation}
+            record.update(arguments)
+            self.generation = self.database.write_records([record], 'runtime')
 
     def generate_container_name(self):
-        container_names = [container.name for container in self.containers.values()]
-        return generate_random_name(exclude_list=container_names)
+        with self.mutex:
+            self.refresh()
+            container_names = [container.name for container in self.containers.values()]
+            container_names.extend(self.reserved_names)
+            return generate_random_name(exclude_list=container_names)
 
     def create_container(self, image, name=None, **kwargs):
-        if name is None:
-            name = self.generate_container_name()
-        container = Container.create(image, name, **kwargs)
-        self.containers[container.id] = container
-        self.save()
+        name = self.reserve_name(name)
+        try:
+            with Driver().transaction():
+                container = Container.create(image, name, **kwargs)
+            self.insert_container(container)
+        finally:
+            self.release_name(name)
+        return container
+
+    async def async_create_container(self, image, name=None, **kwargs):
+        name = self.reserve_name(name)
+        try:
+            with Driver().transaction():
+                container = await Container.async_create(image, name, **kwargs)
+            self.insert_container(container)
+        finally:
+            self.release_name(name)
         return container
 
+    def reserve_name(self, name):
+        with self.locked():
+            if name is None:
+                name = self.generate_container_name()
+            if name in self.reserved_names:
+                raise ContainerInUseException('Container name (%s) is being used' % name)
+            self.reserved_names.add(name)
+        return name
+
+    def release_name(self, name):
+        with self.mutex:
+            self.reserved_names.discard(name)
+
+    def insert_container(self, container):
+        with self.locked():
+            self.containers[container.id] = container
+            self.write_record('create_container', **container.to_json())
+
     def remove_container(self, container_ref, remove_filesystem=True):
-        container = self.get_container(container_ref)
+        container = self.reserve_removal(container_ref)
         container_id = container.id
-        container.destroy(remove_filesystem)
-        del self.containers[container_id]
-        self.save()
+        try:
+            with Driver().transaction():
+                container.destroy(remove_filesystem)
+            self.delete_container(container_id)
+        finally:
+            self.release_removal(container_id)
+
+    async def async_remove_container(self, container_ref, remove_filesystem=True):
+        container = self.reserve_removal(container_ref)
+        container_id = container.id
+        try:
+            with Driver().transaction():
+                await container.async_destroy(remove_filesystem)
+            self.delete_container(container_id)
+        finally:
+            self.release_removal(container_id)
+
+    def reserve_removal(self, container_ref):
+        with self.locked():
+            container = self.get_container(container_ref)
+            if container.id in self.removing:
+                raise ContainerInUseException('Container (%s) is being removed' % container.id)
+            self.removing.add(container.id)
+        return container
+
+    def release_removal(self, container_id):
+        with self.mutex:
+            self.removing.discard(container_id)
+
+    def delete_container(self, container_id):
+        with self.locked():
+            del self.containers[container_id]
+            self.write_record('remove_container', id=container_id)
 
     def get_container(self, container_ref):        
         # container_ref, can either be:
         # small id (6 bytes, 12 octets, 96 bits), the first 12 octets from id
         # id (16 bytes, 32 octets, 256 bits), the sha256 hash
         # name of the container
-        for container in self.containers.values():
-            if container.id == container_ref:
-                return container
-            if container.small_id == container_ref:
-                return container
-            if container.name == container_ref:
-                return container
+        with self.mutex:
+            self.refresh()
+            for container in self.containers.values():
+                if container.id == container_ref:
+                    return container
+                if container.small_id == container_ref:
+                    return container
+                if container.name == container_ref:
+                    return container
         raise ContainerUnknownException('Container (%s) is unknown' % container_ref)
 
     def get_containers_using_image(self, image_id):
-        return [
-            container 
-                for container in self.containers.values() 
-                    if container.image.id == image_id
-        ]
\ No newline at end of file
+        with self.mutex:
+            self.refresh()
+            return [
+                container 
+                    for container in self.containers.values() 
+                        if container.image.id == image_id
+            ]
\ No newline at end of file
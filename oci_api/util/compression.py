@@ -0,0 +1,274 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import bz2
+import zlib
+import lzma
+import queue
+import logging
+import threading
+import collections
+import concurrent.futures
+from oci_api import oci_config, OCIError
+
+log = logging.getLogger(__name__)
+
+# zlib window bits of a gzip member (header and trailer)
+GZIP_WBITS = 31
+# Uncompressed size of every gzip member, compressed by one thread
+GZIP_BLOCK_SIZE = 1 << 20
+# Compressed data read at a time and most data returned per inflate call
+GZIP_READ_SIZE = 1 << 20
+
+def compression_threads():
+    # global.compression.threads, 0 is one per cpu
+    return oci_config['global']['compression'].get('threads', 0) or os.cpu_count() or 1
+
+def compress_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class GzipWriter:
+    # Same as pigz: the stream is split in blocks compressed by a thread pool
+    # (zlib releases the GIL), written in order as one gzip member each. Any
+    # gzip reader reads a multi-member stream as the concatenation of the
+    # members. close() writes what is left, it does not close file.
+    def __init__(self, file, level=None, threads=None, block_size=GZIP_BLOCK_SIZE):
+        self.file = file
+        self.level = level if level is not None else \
+            oci_config['global']['compression'].get('level', 6)
+        self.threads = threads or compression_threads()
+        self.block_size = block_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads,
+            thread_name_prefix='gzip')
+        self.buffer = bytearray()
+        # Compressed blocks not written yet, oldest first
+        self.pending = collections.deque()
+        self.members = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        self.close()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            with memoryview(self.buffer) as view:
+                offset = 0
+                while len(self.buffer) - offset >= self.block_size:
+                    self.submit(bytes(view[offset:offset + self.block_size]))
+                    offset += self.block_size
+            del self.buffer[:offset]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(compress_block, block, self.level))
+        self.members += 1
+        # At most two blocks per thread in memory
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        # An empty stream is still one (empty) member
+        if len(self.buffer) > 0 or self.members == 0:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        try:
+            while len(self.pending) > 0:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.abort()
+
+    def abort(self):
+        self.closed = True
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+class GzipReader:
+    # Streaming reader of a (multi-member) gzip file, tarfile.open(fileobj=
+    # reader, mode='r|') extracts while a thread reads and inflates ahead.
+    # Integrity (crc and size of every member) is checked by zlib.
+    def __init__(self, file, read_size=GZIP_READ_SIZE, queue_size=8):
+        self.file = file
+        self.read_size = read_size
+        self.queue = queue.Queue(queue_size)
+        self.buffer = bytearray()
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='gunzip', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, item):
+        # False if the reader was closed
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        try:
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+            member = False
+            while True:
+                data = self.file.read(self.read_size)
+                if not data:
+                    break
+                while len(data) > 0:
+                    if not member and data.count(0) == len(data):
+                        # Zero padding after the last member
+                        break
+                    member = True
+                    chunk = decompressor.decompress(data, self.read_size)
+                    if len(chunk) > 0 and not self.put(chunk):
+                        return
+                    if decompressor.eof:
+                        data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(GZIP_WBITS)
+                        member = False
+                    else:
+                        data = decompressor.unconsumed_tail
+            if member:
+                chunk = decompressor.flush()
+                if not decompressor.eof:
+                    raise OCIError('Compressed stream ended before the end of a gzip member')
+                if len(chunk) > 0 and not self.put(chunk):
+                    return
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and not self.finished:
+            item = self.queue.get()
+            if item is None:
+                self.finished = True
+            elif isinstance(item, Exception):
+                self.finished = True
+                raise item
+            else:
+                self.buffer += item
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+def zstd_module():
+    # Optional dependency, pip install oci-api-python[zstd]
+    try:
+        import zstandard
+    except ImportError:
+        raise OCIError('zstd compression needs the zstandard package')
+    return zstandard
+
+def zstd_compressor(file, level=None, threads=None):
+    # threads -1 is one per cpu, 0 compresses in the calling thread
+    if level is None:
+        level = oci_config['global']['compression'].get('zstd_level', 3)
+    if threads is None:
+        threads = oci_config['global']['compression'].get('threads', 0) or -1
+    zstd_compressor = zstd_module().ZstdCompressor(level=level, threads=threads,
+        write_checksum=True)
+    return zstd_compressor.stream_writer(file, closefd=False)
+
+class ZstdReader(GzipReader):
+    # Same read ahead as GzipReader, of a stream of one or more zstd frames
+    # (pzstd writes one per thread). The checksum of every frame is checked
+    # by zstd, a stream ending inside a frame is an error.
+    def __init__(self, file, read_size=GZIP_READ_SIZE, queue_size=8):
+        self.zstandard = zstd_module()
+        super().__init__(file, read_size, queue_size)
+
+    def run(self):
+        try:
+            decompressor = None
+            while True:
+                data = self.file.read(self.read_size)
+                if not data:
+                    break
+                while len(data) > 0:
+                    if decompressor is None:
+                        decompressor = self.zstandard.ZstdDecompressor().decompressobj()
+                    chunk = decompressor.decompress(data)
+                    if len(chunk) > 0 and not self.put(chunk):
+                        return
+                    if decompressor.eof:
+                        data = decompressor.unused_data
+                        decompressor = None
+                    else:
+                        data = b''
+            if decompressor is not None:
+                raise OCIError('Compressed stream ended before the end of a zstd frame')
+            self.put(None)
+        except self.zstandard.ZstdError as e:
+            self.put(OCIError('Could not uncompress zstd stream: %s' % e))
+        except Exception as e:
+            self.put(e)
+
+def compressor(file, method='gz', parallel=True):
+    # File object compressing what is written into file, closing it does not
+    # close file
+    if method == 'gz':
+        return GzipWriter(file, threads=None if parallel else 1)
+    if method == 'zst':
+        return zstd_compressor(file, threads=None if parallel else 0)
+    if method == 'xz':
+        return lzma.LZMAFile(file, 'wb')
+    if method == 'bz2':
+        return bz2.BZ2File(file, 'wb')
+    if method == 'lz':
+        return lzma.LZMAFile(file, 'wb', format=lzma.FORMAT_ALONE)
+    raise OCIError('method (%s) not supported' % method)
+
+def decompressor(file, method='gz'):
+    # File object reading file uncompressed, closing it does not close file
+    if method == 'gz':
+        return GzipReader(file)
+    if method == 'zst':
+        return ZstdReader(file)
+    if method == 'xz':
+        return lzma.LZMAFile(file, 'rb')
+    if method == 'bz2':
+        return bz2.BZ2File(file, 'rb')
+    if method == 'lz':
+        return lzma.LZMAFile(file, 'rb', format=lzma.FORMAT_ALONE)
+    raise OCIError('method (%s) not supported' % method)
@@ -13,28 +13,80 @@
 # limitations under the License.
 
 
+import os
+import stat
+import mmap
+import zlib
+import lzma
+import errno
+import fcntl
+import hashlib
 import subprocess
+import concurrent.futures
 import secrets
 import time
 import logging
 import shutil
+import tempfile
 from oci_api import OCIError
+from .process import run_process, run_blocking
+from .compression import compressor, decompressor
 
 log = logging.getLogger(__name__)
 
-def sha256sum(file_path):
+# Buffer of the in process (un)compression copies
+COPY_BUFFER_SIZE = 1 << 20
+# Failures of compress and uncompress, they return None
+COMPRESSION_ERRORS = (OSError, EOFError, OCIError, zlib.error, lzma.LZMAError)
+
+# Read size of sha256sum, one buffer per call reused for every read
+HASH_BUFFER_SIZE = 1 << 20
+# Slice of a mapped file hashed at a time
+MMAP_CHUNK_SIZE = 1 << 26
+
+def file_sha256(file_path, buffer_size=HASH_BUFFER_SIZE, use_mmap=False):
+    # hashlib releases the GIL while hashing a buffer, threads hash in parallel
+    hash = hashlib.sha256()
+    with open(file_path, 'rb', buffering=0) as hashed_file:
+        size = os.fstat(hashed_file.fileno()).st_size
+        if use_mmap and size > 0:
+            with mmap.mmap(hashed_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                if hasattr(mapped_file, 'madvise'):
+                    mapped_file.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped_file) as view:
+                    for offset in range(0, size, MMAP_CHUNK_SIZE):
+                        hash.update(view[offset:offset + MMAP_CHUNK_SIZE])
+            return hash.hexdigest()
+        buffer = bytearray(buffer_size)
+        with memoryview(buffer) as view:
+            while True:
+                read_size = hashed_file.readinto(buffer)
+                if not read_size:
+                    break
+                hash.update(view[:read_size])
+    return hash.hexdigest()
+
+def sha256sum(file_path, buffer_size=HASH_BUFFER_SIZE, use_mmap=False):
+    # None if the file can not be read
     log.debug('Start getting hash of file (%s)' % file_path)
-    cmd = ['/usr/bin/sha256sum', str(file_path)]
-    log.debug('Running command: "' + ' '.join(cmd) + '"')
-    sha256sum_run = subprocess.run(cmd, capture_output=True)
     sha256sum_result = None
-    if sha256sum_run.returncode == 0:
-        sha256sum_stdout = str(sha256sum_run.stdout.decode('utf-8'))
-        records = sha256sum_stdout.split(' ')  
-        sha256sum_result = records[0]
+    try:
+        sha256sum_result = file_sha256(file_path, buffer_size, use_mmap)
+    except OSError as e:
+        log.error('Could not get hash of file (%s): %s' % (file_path, e))
     log.debug('Finish getting hash of file (%s)' % file_path)
     return sha256sum_result
 
+def sha256sums(file_paths, threads=None, buffer_size=HASH_BUFFER_SIZE, use_mmap=False):
+    # file path -> sha256sum(file path), up to threads files at the same time
+    # (default: the ThreadPoolExecutor default)
+    file_paths = list(file_paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads, 
+            thread_name_prefix='sha256sum') as executor:
+        results = executor.map(lambda file_path: sha256sum(file_path, buffer_size, use_mmap), 
+            file_paths)
+        return dict(zip(file_paths, results))
+
 def tar(dir_path, tar_file_path=None, compress=False):
     if tar_file_path is None:
         tar_file_path_str = '-'
@@ -69,19 +121,8 @@ def untar(dir_path, tar_file_path=None, tar_file=None):
 
 def uncompress(compressed_file_path, uncompressed_file_path=None, method='gz', 
         keep_original=False, force=True):
+    # In process, see oci_api.util.compression
     log.debug('Start uncompressing file (%s)' % compressed_file_path)
-    commands  = {
-        'xz': ['/usr/bin/xzcat'],
-        'gz': ['/usr/bin/gzcat'],
-        'bz2': ['/usr/bin/bzcat'],
-        'lz': ['/usr/bin/lzcat']
-    }
-
-    cmd = commands.get(method, None)
-    if cmd is None:
-        raise OCIError('method (%s) not supported' % method)
-    cmd.append(str(compressed_file_path))
-
     if uncompressed_file_path is None:
         if compressed_file_path.suffix == 'method':
             uncompressed_file_path = compressed_file_path.parent.joinpath(compressed_file_path.stem)
@@ -93,61 +134,150 @@ def uncompress(compressed_file_path, uncompressed_file_path=None, method='gz',
         else:
             raise OCIError('Target file (%s) allready exist, can not uncompress' % str(uncompressed_file_path))
     result = None
-    with open(uncompressed_file_path, 'wb') as uncompressed_file:
-        log.debug('Start running command: "' + ' '.join(cmd) + ' > %s"' % uncompressed_file_path)
-        rc =  subprocess.call(cmd,  stdout=uncompressed_file)
-        log.debug('Finish running command: "' + ' '.join(cmd) + ' > %s"' % uncompressed_file_path)
-        if rc == 0:
-            if not keep_original:
-                rm(compressed_file_path)
-            result = uncompressed_file_path
+    try:
+        with open(compressed_file_path, 'rb') as compressed_file, \
+                open(uncompressed_file_path, 'wb') as uncompressed_file:
+            with decompressor(compressed_file, method) as reader:
+                shutil.copyfileobj(reader, uncompressed_file, COPY_BUFFER_SIZE)
+        if not keep_original:
+            rm(compressed_file_path)
+        result = uncompressed_file_path
+    except COMPRESSION_ERRORS as e:
+        log.error('Could not uncompress file (%s): %s' % (compressed_file_path, e))
+        rm(uncompressed_file_path)
     log.debug('Finish uncompressing file (%s)' % compressed_file_path)
     return result
 
 def compress(uncompressed_file_path, compressed_file_path=None, method='gz', 
         keep_original=False, force=True, parallel=True):
+    # In process, see oci_api.util.compression. gz is compressed by a thread
+    # per cpu with parallel, as pigz does
     log.debug('Start compressing file (%s)' % uncompressed_file_path)
-    commands  = {
-        'xz': ['/usr/bin/xz'],
-        'gz': ['/usr/bin/gzip'],
-        'bz2': ['/usr/bin/bzip2'],
-        'lz': ['/usr/bin/lzma']
-    }
-
-    parallel_commands = {
-        'gz': ['/usr/bin/pigz'],
-        'xz': ['/usr/bin/xz', '-T', '0'],
-    }
-    if parallel:
-        cmd = parallel_commands.get(method, None)
-    else:
-        cmd = commands.get(method, None)
-    if cmd is None:
-        raise OCIError('method (%s) not supported' % method)
-    cmd.append('--stdout')
-        
-    cmd.append(str(uncompressed_file_path))
     if compressed_file_path is None:
         compressed_file_path = uncompressed_file_path.with_suffix(uncompressed_file_path.suffix +
             '.' + method)
-
     if compressed_file_path.is_file():
         if force:
             rm(compressed_file_path)
         else:
             raise OCIError('Target file (%s) allready exist, can not compress' % str(compressed_file_path))
     result = None
-    with open(compressed_file_path, 'wb') as compressed_file:
-        log.debug('Start running command: "' + ' '.join(cmd) + ' > %s"' % compressed_file_path)
-        rc =  subprocess.call(cmd,  stdout=compressed_file)
-        log.debug('Finish running command: "' + ' '.join(cmd) + ' > %s"' % compressed_file_path)
-        if rc == 0:
-            if not keep_original:
-                rm(uncompressed_file_path)
-            result = compressed_file_path
+    try:
+        with open(uncompressed_file_path, 'rb') as uncompressed_file, \
+                open(compressed_file_path, 'wb') as compressed_file:
+            with compressor(compressed_file, method, parallel) as writer:
+                shutil.copyfileobj(uncompressed_file, writer, COPY_BUFFER_SIZE)
+        if not keep_original:
+            rm(uncompressed_file_path)
+        result = compressed_file_path
+    except COMPRESSION_ERRORS as e:
+        log.error('Could not compress file (%s): %s' % (uncompressed_file_path, e))
+        rm(compressed_file_path)
     log.debug('Finish compressing file (%s)' % uncompressed_file_path)
     return result
 
+class HashWriter:
+    # Writes through to file, keeping the sha256 and size of what was written
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+class HashReader:
+    # Reads from file, keeping the sha256 and size of what was read
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+class BlobWriter:
+    # Single pass store of a blob: what is written is hashed (diff_id),
+    # compressed with method (None to store it as is), hashed again (digest)
+    # and written to a temp file in dir_path. After close() the temp file is
+    # renamed with store() or removed with discard().
+    def __init__(self, dir_path, method='gz', parallel=True):
+        self.temp_file = tempfile.NamedTemporaryFile(dir=dir_path, prefix='.blob.', delete=False)
+        # Mode of a blob copied with cp, not 0600
+        os.fchmod(self.temp_file.fileno(), default_file_mode())
+        self.output = HashWriter(self.temp_file)
+        self.compressor = None
+        if method is None:
+            self.input = HashWriter(self.output)
+        else:
+            self.compressor = compressor(self.output, method, parallel)
+            self.input = HashWriter(self.compressor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+            return
+        self.close()
+
+    def write(self, data):
+        return self.input.write(data)
+
+    def close(self):
+        try:
+            if self.compressor is not None:
+                self.compressor.close()
+            self.temp_file.flush()
+            os.fsync(self.temp_file.fileno())
+            self.temp_file.close()
+        except:
+            self.discard()
+            raise
+
+    def discard(self):
+        if self.compressor is not None and hasattr(self.compressor, 'abort'):
+            self.compressor.abort()
+        self.temp_file.close()
+        if os.path.exists(self.temp_file.name):
+            os.unlink(self.temp_file.name)
+
+    def store(self, file_path):
+        # Same digest, same contents: an existing file is kept
+        log.debug('Storing blob (%s)' % file_path)
+        if file_path.is_file():
+            os.unlink(self.temp_file.name)
+        else:
+            os.replace(self.temp_file.name, file_path)
+            # Durable before a driver record points at it
+            fsync_path(file_path.parent)
+
+    @property
+    def diff_id(self):
+        # sha256 of the uncompressed blob
+        return self.input.hexdigest()
+
+    @property
+    def digest(self):
+        # sha256 of the stored blob
+        return self.output.hexdigest()
+
+    @property
+    def size(self):
+        return self.output.size
+
 def du(dir_name):
     log.debug('Start calculating disk usage at (%s)' % str(dir_name))
     cmd = ['/usr/gnu/bin/du', '-bs', str(dir_name)]
@@ -157,6 +287,20 @@ def du(dir_name):
     log.debug('Finish calculating disk usage at (%s)' % str(dir_name))
     return int(value)
         
+def tree_size(dir_path):
+    # Same as du -bs, apparent size of every entry, hardlinks counted once
+    size = 0
+    inodes = set()
+    for (root, dir_names, file_names) in os.walk(dir_path):
+        for name in [root] + [os.path.join(root, name) for name in dir_names + file_names]:
+            file_stat = os.lstat(name)
+            if file_stat.st_nlink > 1 and not stat.S_ISDIR(file_stat.st_mode):
+                if (file_stat.st_dev, file_stat.st_ino) in inodes:
+                    continue
+                inodes.add((file_stat.st_dev, file_stat.st_ino))
+            size += file_stat.st_size
+    return size
+
 def rm(file_name, retries=5, sleep=1, recursive=False):
     for i in range(retries):
         if not file_name.exists():
@@ -178,12 +322,169 @@ def rm(file_name, retries=5, sleep=1, recursive=False):
             time.sleep(sleep)
     return -1
       
+def file_stamp(file_path):
+    # Changes whenever the file is rewritten, replaced (new inode) or appended
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def umask():
+    # Linux has it in /proc, elsewhere it is set and restored
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+def default_file_mode():
+    # Mode of a file made by open(), temp files are made 0600
+    return 0o666 & ~umask()
+
+def atomic_write(file_path, data):
+    # Readers see either the old or the new content, never a partial write.
+    # The file keeps its mode, a new one gets the mode open() would give it.
+    log.debug('Start writing (%s)' % file_path)
+    try:
+        mode = stat.S_IMODE(os.stat(file_path).st_mode)
+    except FileNotFoundError:
+        mode = default_file_mode()
+    with tempfile.NamedTemporaryFile(dir=file_path.parent, prefix='.' + file_path.name + '.', 
+            delete=False) as temp_file:
+        try:
+            os.fchmod(temp_file.fileno(), mode)
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        except:
+            os.unlink(temp_file.name)
+            raise
+    os.replace(temp_file.name, file_path)
+    fsync_path(file_path.parent)
+    log.debug('Finish writing (%s)' % file_path)
+
 def cp(src_file_path, dst_file_path):
     log.debug('Start copying (%s) to (%s)' % (src_file_path, dst_file_path))
     shutil.copy(src_file_path, dst_file_path)
     log.debug('Finish copying (%s) to (%s)' % (src_file_path, dst_file_path))
       
+# ioctl of Linux copy on write clones (btrfs, xfs with reflink=1, ...)
+FICLONE = 0x40049409
+
+def clone_file(src_file_path, dst_file_path, reflink='auto'):
+    # Copies a file sharing its blocks (reflink) when the filesystem supports
+    # it, otherwise in the kernel (copy_file_range) or as a plain copy. reflink
+    # is 'auto', 'always' (raise if not supported) or 'never'. Returns True if
+    # the copy is a reflink.
+    with open(src_file_path, 'rb') as src_file, open(dst_file_path, 'wb') as dst_file:
+        if reflink != 'never':
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                return True
+            except OSError as e:
+                if reflink == 'always' or e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, 
+                        errno.EXDEV, errno.EINVAL, errno.EBADF):
+                    raise
+        try:
+            while os.copy_file_range(src_file.fileno(), dst_file.fileno(), 1 << 30) > 0:
+                pass
+            return False
+        except AttributeError:
+            pass
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+        try:
+            while os.sendfile(dst_file.fileno(), src_file.fileno(), None, 1 << 30) > 0:
+                pass
+            return False
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+        # Neither copy_file_range nor sendfile available (kernel, filesystem or
+        # python), goes on from the offsets reached so far
+        shutil.copyfileobj(src_file, dst_file)
+    return False
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def place_file(src_file_path, dst_file_path, move=False):
+    # Puts a file into a store directory (layers/, manifests/...) under its
+    # final name, readers never see a partial file. With move the file is
+    # renamed when it is on the same filesystem, nothing is copied. Otherwise
+    # it is cloned (reflink, copy_file_range or sendfile) into a temp file
+    # next to dst_file_path that is renamed over it.
+    log.debug('Start placing (%s) at (%s)' % (src_file_path, dst_file_path))
+    if move:
+        try:
+            os.replace(src_file_path, dst_file_path)
+            fsync_path(dst_file_path.parent)
+            log.debug('Finish placing (%s) at (%s)' % (src_file_path, dst_file_path))
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    temp_fd, temp_file_name = tempfile.mkstemp(dir=dst_file_path.parent, 
+        prefix='.' + dst_file_path.name + '.')
+    os.close(temp_fd)
+    try:
+        # Mode of the source, as shutil.copy, not the 0600 of mkstemp
+        os.chmod(temp_file_name, stat.S_IMODE(os.stat(src_file_path).st_mode))
+        clone_file(src_file_path, temp_file_name)
+        fsync_path(temp_file_name)
+        os.replace(temp_file_name, dst_file_path)
+    except:
+        os.unlink(temp_file_name)
+        raise
+    fsync_path(dst_file_path.parent)
+    if move:
+        os.unlink(src_file_path)
+    log.debug('Finish placing (%s) at (%s)' % (src_file_path, dst_file_path))
+
 def mv(src_file_path, dst_file_path):
     log.debug('Start moving (%s) to (%s)' % (src_file_path, dst_file_path))
     shutil.move(src_file_path, dst_file_path)
     log.debug('Finish moving (%s) to (%s)' % (src_file_path, dst_file_path))
+
+# asyncio versions, for the async api
+
+async def async_sha256sum(file_path):
+    # In process, in a thread so the event loop is not blocked
+    return await run_blocking(sha256sum, file_path)
+
+async def async_tar(dir_path, tar_file_path, compress=False):
+    args = '-c'
+    if compress:
+        args += 'z'
+    cmd = ['/usr/gnu/bin/tar', args, '-f', str(tar_file_path)]
+    cmd += [ str(f.relative_to(dir_path)) for f in dir_path.glob('*') ]
+    (returncode, output, error) = await run_process(cmd, cwd=dir_path)
+    return returncode
+
+async def async_untar(dir_path, tar_file_path):
+    cmd = ['/usr/gnu/bin/tar', '-x', '-f', str(tar_file_path)]
+    (returncode, output, error) = await run_process(cmd, cwd=dir_path)
+    return returncode
+
+async def async_compress(uncompressed_file_path, compressed_file_path=None, method='gz', 
+        keep_original=False, force=True, parallel=True):
+    return await run_blocking(compress, uncompressed_file_path, compressed_file_path, method, 
+        keep_original, force, parallel)
+
+async def async_du(dir_name):
+    (returncode, output, error) = await run_process(['/usr/gnu/bin/du', '-bs', str(dir_name)], 
+        stdout=subprocess.PIPE)
+    if returncode != 0:
+        raise OCIError('Could not get disk usage of (%s)' % dir_name)
+    return int(output.decode('utf-8').split()[0])
@@ -0,0 +1,77 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+class Journal:
+    # Append only file of json records, one per line. A record is only valid
+    # once its trailing newline hits the disk, so a partially written record
+    # (crash in the middle of an append) is discarded on replay.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.length = 0
+        self.offset = 0
+
+    def size(self):
+        try:
+            return self.file_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def replay(self, tail=False):
+        # With tail, only the records appended (by other processes) since the
+        # last replay or append are returned
+        log.debug('Start replaying journal (%s)' % self.file_path)
+        if not tail:
+            self.length = 0
+            self.offset = 0
+        if self.file_path.is_file():
+            with self.file_path.open('rb') as journal_file:
+                journal_file.seek(self.offset)
+                for line in journal_file:
+                    if not line.endswith(b'\n'):
+                        log.warning('Discarding incomplete record at the end of journal (%s)'
+                            % self.file_path)
+                        break
+                    record = json.loads(line)
+                    self.length += 1
+                    self.offset += len(line)
+                    yield record
+        log.debug('Finish replaying journal (%s), %i records' % (self.file_path, self.length))
+
+    def append(self, records):
+        data = b''.join(
+            json.dumps(record, separators=(',', ':')).encode() + b'\n'
+                for record in records
+        )
+        with self.file_path.open('ab') as journal_file:
+            if journal_file.tell() != self.offset:
+                # Incomplete record left behind by a crashed writer
+                journal_file.truncate(self.offset)
+            journal_file.write(data)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self.length += len(records)
+        self.offset += len(data)
+
+    def truncate(self):
+        log.debug('Truncating journal (%s)' % self.file_path)
+        with self.file_path.open('wb') as journal_file:
+            os.fsync(journal_file.fileno())
+        self.length = 0
+        self.offset = 0
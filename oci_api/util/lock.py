@@ -0,0 +1,88 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import logging
+import threading
+import contextvars
+import contextlib
+from oci_api import OCIError
+
+log = logging.getLogger(__name__)
+
+class FileLock:
+    # Advisory lock shared between processes, many readers or one writer.
+    # The lock is held by the process: threads join a lock that is already
+    # held in a compatible mode (exclusion between threads of the same process
+    # is up to the caller) and a thread asking for an exclusive lock waits for
+    # the shared holders to finish. Nested acquisitions in the same thread (or
+    # asyncio task) are reentrant, a shared lock can not be upgraded to an
+    # exclusive one.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.condition = threading.Condition()
+        # Nesting depth of the calling thread or asyncio task
+        self.depth = contextvars.ContextVar('depth', default=0)
+        self.lock_file = None
+        self.count = 0
+        self.exclusive_lock = False
+
+    def shared(self):
+        return self.acquire(fcntl.LOCK_SH)
+
+    def exclusive(self):
+        return self.acquire(fcntl.LOCK_EX)
+
+    def is_locked(self):
+        return self.count > 0
+
+    @contextlib.contextmanager
+    def acquire(self, operation):
+        exclusive = operation == fcntl.LOCK_EX
+        depth = self.depth.get()
+        with self.condition:
+            if depth > 0:
+                if exclusive and not self.exclusive_lock:
+                    raise OCIError('Can not upgrade shared lock (%s) to exclusive' % self.file_path)
+            else:
+                while self.count > 0 and exclusive and not self.exclusive_lock:
+                    self.condition.wait()
+                if self.count == 0:
+                    self.lock_file = self.open_lock_file(operation)
+                    self.exclusive_lock = exclusive
+            self.count += 1
+            self.depth.set(depth + 1)
+        try:
+            yield self
+        finally:
+            with self.condition:
+                self.count -= 1
+                self.depth.set(depth)
+                if self.count == 0:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+                    self.lock_file.close()
+                    self.lock_file = None
+                    self.exclusive_lock = False
+                    self.condition.notify_all()
+
+    def open_lock_file(self, operation):
+        if not self.file_path.parent.is_dir():
+            self.file_path.parent.mkdir(parents=True)
+        lock_file = self.file_path.open('a')
+        try:
+            fcntl.flock(lock_file, operation)
+        except:
+            lock_file.close()
+            raise
+        return lock_file
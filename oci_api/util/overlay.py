@@ -0,0 +1,56 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import subprocess
+import logging
+
+log = logging.getLogger(__name__)
+
+class OverlayError(Exception):
+    pass
+
+def overlay_options(lower_dirs, upper_dir, work_dir, options=None):
+    # lower_dirs top first
+    option_list = [
+        'lowerdir=' + ':'.join([ str(lower_dir) for lower_dir in lower_dirs ]),
+        'upperdir=' + str(upper_dir),
+        'workdir=' + str(work_dir)
+    ]
+    if options is not None:
+        option_list += options
+    return ','.join(option_list)
+
+def overlay_run(cmd, cwd=None):
+    log.debug('Running command: "' + ' '.join(cmd) + '"')
+    process = subprocess.run(cmd, cwd=cwd, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise OverlayError(process.stderr.decode('utf-8', errors='replace').strip())
+
+def overlay_mount(path, lower_dirs, upper_dir, work_dir, options=None, cwd=None):
+    # Kernel overlayfs, needs CAP_SYS_ADMIN. Relative directories are relative
+    # to cwd, keeps the options of deep layer stacks under the page size limit.
+    overlay_run(['mount', '-t', 'overlay', 'overlay', '-o',
+        overlay_options(lower_dirs, upper_dir, work_dir, options), str(path)], cwd=cwd)
+
+def overlay_umount(path):
+    overlay_run(['umount', str(path)])
+
+def fuse_overlay_mount(path, lower_dirs, upper_dir, work_dir, command='fuse-overlayfs'):
+    # Unprivileged mount through fuse-overlayfs, it runs in the background
+    # until fuse_overlay_umount
+    overlay_run([command, '-o', overlay_options(lower_dirs, upper_dir, work_dir), str(path)])
+
+def fuse_overlay_umount(path, command='fusermount3'):
+    overlay_run([command, '-u', str(path)])
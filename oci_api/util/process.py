@@ -0,0 +1,64 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import logging
+import weakref
+import contextvars
+from oci_api import oci_config
+
+log = logging.getLogger(__name__)
+
+# One semaphore per event loop, limits the external commands (and blocking
+# calls run in threads) of the async api that run at the same time
+semaphores = weakref.WeakKeyDictionary()
+# Task that called run_blocking, as seen by the function running in a thread
+blocking_task = contextvars.ContextVar('blocking_task', default=None)
+
+def get_semaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(oci_config['global']['concurrency'])
+        semaphores[loop] = semaphore
+    return semaphore
+
+async def run_process(cmd, stdin=None, stdout=None, stderr=None, cwd=None):
+    # asyncio version of subprocess.run, returns (returncode, stdout, stderr),
+    # stdout and stderr are only returned for asyncio.subprocess.PIPE
+    async with get_semaphore():
+        log.debug('Running command: "' + ' '.join(cmd) + '"')
+        process = await asyncio.create_subprocess_exec(*cmd, stdin=stdin, stdout=stdout, 
+            stderr=stderr, cwd=cwd)
+        (output, error) = await process.communicate()
+        return (process.returncode, output, error)
+
+def current_task():
+    # asyncio task of the caller, also inside the functions that task runs
+    # through run_blocking, None for plain threads
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return blocking_task.get()
+
+async def run_blocking(function, *args):
+    # For the operations without an async implementation, runs function in the
+    # default executor with a copy of the context of the calling task (locks
+    # held and driver transaction)
+    async with get_semaphore():
+        context = contextvars.copy_context()
+        context.run(blocking_task.set, asyncio.current_task())
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, context.run, function, *args)
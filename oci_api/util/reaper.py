@@ -0,0 +1,70 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import queue
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class Reaper:
+    # Calls destroy(name) for every added name from background threads, at
+    # most `threads` at the same time. A failed destroy is retried after the
+    # rest of the queue (it may depend on another name being destroyed first).
+    # Threads are daemons, whatever is left when the process exits has to be
+    # added again by the next one.
+    def __init__(self, destroy, threads=2, retries=5, delay=1):
+        self.destroy = destroy
+        self.threads = threads
+        self.retries = retries
+        self.delay = delay
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.pending = set()
+
+    def add(self, name):
+        with self.lock:
+            if name in self.pending:
+                return
+            self.pending.add(name)
+            while len(self.workers) < self.threads:
+                worker = threading.Thread(target=self.run, name='reaper', daemon=True)
+                worker.start()
+                self.workers.append(worker)
+        self.queue.put((name, 0))
+
+    def wait(self):
+        # Returns when everything added so far is destroyed or given up
+        self.queue.join()
+
+    def run(self):
+        while True:
+            (name, attempt) = self.queue.get()
+            try:
+                log.debug('Start reaping (%s)' % name)
+                self.destroy(name)
+                log.debug('Finish reaping (%s)' % name)
+            except Exception as e:
+                if attempt + 1 < self.retries:
+                    log.debug('Could not reap (%s), retrying: %s' % (name, e))
+                    time.sleep(self.delay)
+                    self.queue.put((name, attempt + 1))
+                    self.queue.task_done()
+                    continue
+                log.error('Could not reap (%s), left for the next start: %s' % (name, e))
+            with self.lock:
+                self.pending.discard(name)
+            self.queue.task_done()
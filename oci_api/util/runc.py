@@ -16,18 +16,23 @@
 import subprocess
 import pathlib
 import logging
+from .process import run_process
 
 log = logging.getLogger(__name__)
 
 class RunCError(Exception):
     pass
 
-def runc(command,  options=None, arguments=None, stdout=None):
+def runc_command(command, options=None, arguments=None):
     cmd = ['runc', command]
     if options is not None:
         cmd += options
     if arguments is not None:
         cmd += arguments
+    return cmd
+
+def runc(command,  options=None, arguments=None, stdout=None):
+    cmd = runc_command(command, options, arguments)
     log.debug('Running command: "' + ' '.join(cmd) + '"')
     process = subprocess.Popen(cmd, stdout=stdout)
     stdout, stderr = process.communicate()
@@ -60,3 +65,26 @@ def runc_start(container_id):
     arguments = [container_id]
     options = None
     runc('start', options, arguments)
+
+# asyncio versions, for the async api
+
+async def async_runc(command, options=None, arguments=None):
+    (returncode, output, error) = await run_process(runc_command(command, options, arguments),
+        stderr=subprocess.PIPE)
+    if returncode != 0:
+        raise RunCError(error)
+
+async def async_runc_create(container_id, bundle_path=None):
+    options = None
+    if bundle_path is not None:
+        options = ['-b', str(bundle_path)]
+    await async_runc('create', options, [container_id])
+
+async def async_runc_delete(container_id, force=False):
+    options = None
+    if force:
+        options = ['--force']
+    await async_runc('delete', options, [container_id])
+
+async def async_runc_start(container_id):
+    await async_runc('start', None, [container_id])
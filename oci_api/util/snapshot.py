@@ -0,0 +1,155 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import struct
+import logging
+from .file import atomic_write
+
+log = logging.getLogger(__name__)
+
+# Binary copy of a json metadata file, read through mmap without parsing.
+# Rows are still decoded one by one when they are loaded, reading does not
+# skip the records that are never used.
+#
+# header:    magic, version, source file stamp (inode, size, mtime), sequence,
+#            number of tables, offset of the string table
+# tables:    (format, number of rows, offset) for each table, followed by the
+#            rows, fixed size records where every field is either a string
+#            table index ('s') or a 64 bits integer ('q')
+# strings:   number of strings, data length and the utf-8 data of the strings
+#            separated by NUL, equal strings are stored once
+SNAPSHOT_MAGIC = b'OCISNAP\0'
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct('<8sIQqqQIQ')
+TABLE = struct.Struct('<8sIQ')
+STRINGS = struct.Struct('<IQ')
+NULL_STRING = 0xffffffff
+
+def row_struct(table_format):
+    return struct.Struct('<' + ''.join('I' if field == 's' else 'q' for field in table_format))
+
+def write_snapshot(file_path, stamp, sequence, tables):
+    # tables is a list of (format, rows), rows are tuples matching the format,
+    # strings may be None
+    log.debug('Start writing snapshot (%s)' % file_path)
+    strings = {}
+    def string_index(string):
+        if string is None:
+            return NULL_STRING
+        index = strings.get(string)
+        if index is None:
+            index = strings[string] = len(strings)
+        return index
+    offset = HEADER.size + TABLE.size * len(tables)
+    directory = []
+    data = []
+    for table_format, rows in tables:
+        row = row_struct(table_format)
+        string_fields = [index for index, field in enumerate(table_format) if field == 's']
+        table_data = bytearray()
+        count = 0
+        for values in rows:
+            values = list(values)
+            for index in string_fields:
+                values[index] = string_index(values[index])
+            table_data += row.pack(*values)
+            count += 1
+        directory.append(TABLE.pack(table_format.encode(), count, offset))
+        data.append(bytes(table_data))
+        offset += len(table_data)
+    encoded = '\0'.join(strings).encode()
+    strings_data = STRINGS.pack(len(strings), len(encoded)) + encoded
+    (inode, size, mtime) = stamp
+    header = HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, inode, size, mtime, sequence,
+        len(tables), offset)
+    atomic_write(file_path, header + b''.join(directory) + b''.join(data) + strings_data)
+    log.debug('Finish writing snapshot (%s)' % file_path)
+
+class Snapshot:
+    # Use open(), it returns None when the snapshot does not exist, was written
+    # by another version or is older than the json file it was made from
+    @classmethod
+    def open(cls, file_path, stamp):
+        try:
+            snapshot_file = file_path.open('rb')
+        except FileNotFoundError:
+            return None
+        with snapshot_file:
+            try:
+                data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                return None
+        if len(data) < HEADER.size:
+            data.close()
+            return None
+        (magic, version, inode, size, mtime, sequence, table_count, strings_offset) = \
+            HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or \
+                stamp != (inode, size, mtime):
+            log.debug('Snapshot (%s) is stale, ignoring it' % file_path)
+            data.close()
+            return None
+        return cls(file_path, data, sequence, table_count, strings_offset)
+
+    def __init__(self, file_path, data, sequence, table_count, strings_offset):
+        self.file_path = file_path
+        self.data = data
+        self.sequence = sequence
+        self.tables = [
+            TABLE.unpack_from(data, HEADER.size + TABLE.size * index)
+                for index in range(table_count)
+        ]
+        (string_count, length) = STRINGS.unpack_from(data, strings_offset)
+        start = strings_offset + STRINGS.size
+        # Decoded at once, splitting is done in C
+        self.strings = data[start:start + length].decode().split('\0') if string_count > 0 else []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def string(self, index):
+        if index == NULL_STRING:
+            return None
+        return self.strings[index]
+
+    def rows(self, table_index):
+        (table_format, count, offset) = self.tables[table_index]
+        table_format = table_format.rstrip(b'\0').decode()
+        row = row_struct(table_format)
+        strings = self.strings
+        view = memoryview(self.data)[offset:offset + row.size * count]
+        try:
+            if 'q' not in table_format:
+                for values in row.iter_unpack(view):
+                    yield tuple([strings[index] if index != NULL_STRING else None for index in values])
+            else:
+                string_fields = [index for index, field in enumerate(table_format) if field == 's']
+                for values in row.iter_unpack(view):
+                    values = list(values)
+                    for index in string_fields:
+                        if values[index] != NULL_STRING:
+                            values[index] = strings[values[index]]
+                        else:
+                            values[index] = None
+                    yield tuple(values)
+        finally:
+            view.release()
@@ -14,48 +14,285 @@
 
 
 import subprocess
+import shutil
+import contextlib
+import contextvars
+import threading
+import tempfile
 import pathlib
 import logging
+import time
 import io
+from .process import run_process
 
 log = logging.getLogger(__name__)
 
-def _zfs(command,  arguments=None, options=None, stdout=None):
-    cmd = ['/usr/sbin/zfs', command]
+class ZFSError(Exception):
+    pass
+
+zfs_settings = {
+    'command': '/usr/sbin/zfs',
+    # Run the snapshots and destroys of a zfs_batch() as one channel program
+    # (zfs program), needs OpenZFS 0.8 or newer
+    'channel_programs': False
+}
+
+def zfs_configure(command=None, channel_programs=None):
+    if command is not None:
+        zfs_settings['command'] = command
+    if channel_programs is not None:
+        zfs_settings['channel_programs'] = channel_programs
+
+# Channel program run by ZFSProgram, the dataset names come as arguments.
+# Every operation is checked (zfs.check) before any is made (zfs.sync), so a
+# failing check leaves the pool untouched.
+ZFS_PROGRAM_HEADER = '''\
+-- Generated by oci_api.util.zfs.ZFSProgram
+local argv = ...
+argv = argv['argv']
+local function ok(code, operation, name)
+    if code ~= 0 then
+        error(operation .. ' ' .. name .. ' failed with error ' .. code)
+    end
+end
+local function destroy_recursive(name)
+    for child in zfs.list.children(name) do
+        destroy_recursive(child)
+    end
+    for snapshot in zfs.list.snapshots(name) do
+        ok(zfs.sync.destroy(snapshot), 'destroy', snapshot)
+    end
+    ok(zfs.sync.destroy(name), 'destroy', name)
+end
+'''
+
+class ZFSProgram:
+    # Sequence of dataset operations compiled into one channel program, one
+    # fork/exec and one pool sync instead of one per operation. Channel
+    # programs can not clone, mount or set native properties (mountpoint),
+    # those keep running as zfs commands.
+    def __init__(self):
+        self.operations = []
+        self.arguments = []
+
+    @property
+    def pool(self):
+        if len(self.arguments) == 0:
+            return None
+        return self.arguments[0].split('/')[0].split('@')[0]
+
+    def add(self, operation, *names):
+        indexes = []
+        for name in names:
+            self.arguments.append(name)
+            indexes.append(len(self.arguments))
+        self.operations.append((operation, indexes))
+
+    def snapshot(self, snapshot):
+        self.add('snapshot', snapshot)
+
+    def destroy(self, zfs_name, recursive=False):
+        self.add('destroy_recursive' if recursive else 'destroy', zfs_name)
+
+    def set_user_property(self, zfs_name, property_name, value):
+        # Only user properties (module:property) can be set from a program
+        self.add('set_prop', zfs_name, property_name, str(value))
+
+    def compile(self):
+        checks = []
+        syncs = []
+        for operation, indexes in self.operations:
+            names = ', '.join('argv[%i]' % index for index in indexes)
+            if operation == 'snapshot':
+                checks.append('ok(zfs.check.snapshot(%s), "snapshot", %s)' % (names, names))
+                syncs.append('ok(zfs.sync.snapshot(%s), "snapshot", %s)' % (names, names))
+            elif operation == 'destroy':
+                checks.append('ok(zfs.check.destroy(%s), "destroy", %s)' % (names, names))
+                syncs.append('ok(zfs.sync.destroy(%s), "destroy", %s)' % (names, names))
+            elif operation == 'destroy_recursive':
+                syncs.append('destroy_recursive(%s)' % names)
+            elif operation == 'set_prop':
+                name = 'argv[%i]' % indexes[0]
+                checks.append('ok(zfs.check.set_prop(%s), "set", %s)' % (names, name))
+                syncs.append('ok(zfs.sync.set_prop(%s), "set", %s)' % (names, name))
+        return ZFS_PROGRAM_HEADER + '\n'.join(checks + syncs) + '\n'
+
+    def run(self):
+        if len(self.operations) == 0:
+            return
+        with tempfile.NamedTemporaryFile('w', suffix='.lua') as program_file:
+            program_file.write(self.compile())
+            program_file.flush()
+            cmd = [zfs_settings['command'], 'program', self.pool, program_file.name] + self.arguments
+            log.debug('Running command: "' + ' '.join(cmd) + '"')
+            process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.operations = []
+        self.arguments = []
+        if process.returncode != 0:
+            raise ZFSError('zfs program failed: %s' % process.stderr.decode('utf-8', 'replace').strip())
+
+# Program of the current zfs_batch() of the thread or asyncio task
+zfs_batch_program_var = contextvars.ContextVar('zfs_batch_program', default=None)
+
+@contextlib.contextmanager
+def zfs_batch():
+    # Within the batch, snapshots and (batch=True) destroys are collected and
+    # run as one channel program at the end, also if the batch exits with an
+    # exception (the driver records them as done). Any other zfs command runs
+    # the collected ones first, so the order of the operations is kept.
+    if not zfs_settings['channel_programs'] or zfs_batch_program_var.get() is not None:
+        yield
+        return
+    program = ZFSProgram()
+    token = zfs_batch_program_var.set(program)
+    try:
+        yield
+    finally:
+        zfs_batch_program_var.reset(token)
+        program.run()
+
+def zfs_batch_program(zfs_name):
+    # Program collecting the operations on zfs_name, None outside a batch
+    program = zfs_batch_program_var.get()
+    if program is not None and program.pool not in (None, zfs_name.split('/')[0].split('@')[0]):
+        program.run()
+    return program
+
+def zfs_batch_flush():
+    program = zfs_batch_program_var.get()
+    if program is not None:
+        program.run()
+
+def zfs_command(command, arguments=None, options=None):
+    cmd = [zfs_settings['command'], command]
     if options is not None:
         for option in options:
             cmd += ['-o', option]
     if arguments is not None:
         cmd += arguments
+    return cmd
+
+def _zfs(command,  arguments=None, options=None, stdout=None, stdin=None):
+    zfs_batch_flush()
+    cmd = zfs_command(command, arguments, options)
     log.debug('Running command: "' + ' '.join(cmd) + '"')
-    return subprocess.Popen(cmd, stdout=stdout)
+    return subprocess.Popen(cmd, stdout=stdout, stdin=stdin)
 
-def zfs(command,  arguments=None, options=None):
-    process = _zfs(command, arguments, options)
+def zfs(command,  arguments=None, options=None, stdout=None, stdin=None):
+    process = _zfs(command, arguments, options, stdout, stdin)
     stdout = process.communicate()[0]
     return process.returncode
 
-def zfs_create(zfs_name, parent=None, mountpoint=None, compression=None):
-    filesystem = zfs_name
-    if parent is not None:
-        filesystem = parent + '/' + zfs_name
+class ZFSCache:
+    # Properties of every dataset under the registered roots, read with a
+    # single zfs list instead of a zfs get per property and dataset. Our own
+    # changes (zfs_create, zfs_clone, zfs_set, zfs_rename, zfs_destroy) update
+    # the cache, changes made by others are picked up when the ttl expires.
+    properties = ['name', 'type', 'used', 'mountpoint']
 
-    # Just debugging, don't fail if already created
-    #if(destroy(filesystem, recursive=True) == 0):
-    #    print('WARNING: Deleting filesystem (%s) ' % filesystem)
+    def __init__(self):
+        self.lock = threading.RLock()
+        # root -> [ttl, time of the last listing]
+        self.roots = {}
+        # dataset name -> {property name: value}
+        self.datasets = {}
+
+    def add_root(self, root, ttl):
+        with self.lock:
+            if root in self.roots:
+                self.roots[root][0] = ttl
+            else:
+                self.roots[root] = [ttl, None]
+
+    def find_root(self, zfs_name):
+        for root in self.roots:
+            if zfs_name == root or zfs_name.startswith(root + '/'):
+                return root
+        return None
+
+    def refresh(self, root):
+        (ttl, listed) = self.roots[root]
+        if listed is not None and time.monotonic() - listed < ttl:
+            return
+        for dataset in list(self.datasets):
+            if dataset == root or dataset.startswith(root + '/'):
+                del self.datasets[dataset]
+        for filesystem in zfs_list(root, zfs_type='filesystem', recursive=True, 
+                properties=self.properties):
+            self.datasets[filesystem['name']] = filesystem
+        self.roots[root][1] = time.monotonic()
 
+    def get(self, zfs_name, property_name):
+        # Returns (True, value) when the value is known
+        if property_name not in self.properties:
+            return (False, None)
+        with self.lock:
+            root = self.find_root(zfs_name)
+            if root is None or self.roots[root][0] <= 0:
+                return (False, None)
+            self.refresh(root)
+            dataset = self.datasets.get(zfs_name)
+            if dataset is None or property_name not in dataset:
+                return (False, None)
+            return (True, dataset[property_name])
+
+    def update(self, zfs_name, property_name, value):
+        # A value read or changed outside of the listing
+        with self.lock:
+            if self.find_root(zfs_name) is not None and property_name in self.properties:
+                self.datasets.setdefault(zfs_name, {'name': zfs_name})[property_name] = value
+
+    def invalidate(self, zfs_name, children=True):
+        with self.lock:
+            self.datasets.pop(zfs_name, None)
+            if children:
+                for dataset in list(self.datasets):
+                    if dataset.startswith(zfs_name + '/'):
+                        del self.datasets[dataset]
+            if zfs_name in self.roots:
+                self.roots[zfs_name][1] = None
+
+    def rename(self, original_zfs_name, new_zfs_name):
+        with self.lock:
+            for dataset in list(self.datasets):
+                if dataset == original_zfs_name or dataset.startswith(original_zfs_name + '/'):
+                    properties = self.datasets.pop(dataset)
+                    properties['name'] = new_zfs_name + dataset[len(original_zfs_name):]
+                    # Inherited mountpoints change with the new parent
+                    properties.pop('mountpoint', None)
+                    if self.find_root(properties['name']) is not None:
+                        self.datasets[properties['name']] = properties
+
+zfs_cache = ZFSCache()
+
+def create_options(mountpoint=None, compression=None, properties=None):
     options = []
     if mountpoint is not None:
         options += ['mountpoint=' + str(mountpoint)]
     if compression is not None:
         options.append('compression=' + compression)
+    if properties is not None:
+        options += ['%s=%s' % (property_name, value) for property_name, value in properties.items()]
     if len(options) == 0:
         options = None
+    return options
+
+def zfs_create(zfs_name, parent=None, mountpoint=None, compression=None):
+    filesystem = zfs_name
+    if parent is not None:
+        filesystem = parent + '/' + zfs_name
+
+    # Just debugging, don't fail if already created
+    #if(destroy(filesystem, recursive=True) == 0):
+    #    print('WARNING: Deleting filesystem (%s) ' % filesystem)
+
+    options = create_options(mountpoint, compression)
+    zfs_cache.invalidate(filesystem)
     if zfs('create', [filesystem], options) == 0:
         return filesystem
     return None
 
-def zfs_clone(zfs_name, snapshot, parent=None, mountpoint=None):
+def zfs_clone(zfs_name, snapshot, parent=None, mountpoint=None, properties=None):
     filesystem = zfs_name
     if parent is not None:
         filesystem = parent + '/' + zfs_name
@@ -64,30 +301,34 @@ def zfs_clone(zfs_name, snapshot, parent=None, mountpoint=None):
     #if(destroy(filesystem, recursive=True) == 0):
     #    print('WARNING: Deleting filesystem (%s) ' % filesystem)
 
-    options = None
-    if mountpoint is not None:
-        options = ['mountpoint=' + str(mountpoint)]
+    options = create_options(mountpoint, properties=properties)
+    zfs_cache.invalidate(filesystem)
     if zfs('clone', [snapshot, filesystem], options) == 0:
         return filesystem
     return None
 
-def zfs_set(zfs_name, readonly=None, mountpoint=None, mounted=None):
+def set_options(readonly=None, mountpoint=None, mounted=None):
+    options = []
     if readonly is not None:
-        option = 'readonly='
-        if readonly:
-            option += 'on'
-        else:
-            option += 'off'
-        zfs('set', [option, zfs_name])
+        options.append('readonly=' + ('on' if readonly else 'off'))
     if mounted is not None:
-        option = 'mounted='
-        if mounted:
-            option += 'on'
-        else:
-            option += 'off'
-        zfs('set', [option, zfs_name])
+        options.append('mounted=' + ('on' if mounted else 'off'))
     if mountpoint is not None:
-        zfs('set', ['mountpoint=' + str(mountpoint), zfs_name])
+        options.append('mountpoint=' + str(mountpoint))
+    return options
+
+def zfs_set(zfs_name, readonly=None, mountpoint=None, mounted=None):
+    for option in set_options(readonly, mountpoint, mounted):
+        if option.startswith('mountpoint='):
+            # Children inheriting the mountpoint change too
+            zfs_cache.invalidate(zfs_name)
+        if zfs('set', [option, zfs_name]) == 0 and option.startswith('mountpoint='):
+            zfs_cache.update(zfs_name, 'mountpoint', value_convert('mountpoint', str(mountpoint)))
+
+def zfs_inherit(zfs_name, property_name):
+    # Clears a property set on zfs_name (user properties are removed)
+    zfs_cache.invalidate(zfs_name, children=False)
+    return zfs('inherit', [property_name, zfs_name])
 
 def value_convert(property_name, value):
     if value == 'on':
@@ -97,21 +338,31 @@ def value_convert(property_name, value):
     if value == '-':
         return None
     if property_name == 'mountpoint':
+        if value in ('none', 'legacy'):
+            return None
         return pathlib.Path(value)
     try: 
         return int(value)
     except ValueError:
         return value
 
-def zfs_get(zfs_name, property_name):
+def zfs_get(zfs_name, property_name, cached=True):
+    # Not cached reads the current value (the used space of a filesystem
+    # being written), and updates the cache with it
     if property_name == 'all':
         raise NotImplementedError()
-    cmd = ['/usr/sbin/zfs', 'get', '-Hp', property_name, zfs_name]
+    if cached:
+        (found, value) = zfs_cache.get(zfs_name, property_name)
+        if found:
+            return value
+    zfs_batch_flush()
+    cmd = zfs_command('get', ['-Hp', property_name, zfs_name])
     with open('/dev/null', 'w') as dev_null:
         log.debug('Running command: "' + ' '.join(cmd) + '"')
         output = subprocess.check_output(cmd, stderr=dev_null)
-        value = output.decode('utf-8').split('\t')[2]
-        return value_convert(property_name, value)
+        value = value_convert(property_name, output.decode('utf-8').split('\t')[2])
+        zfs_cache.update(zfs_name, property_name, value)
+        return value
     return None
 
 def zfs_snapshot(zfs_name, filesystem, recursive=False):
@@ -120,32 +371,103 @@ def zfs_snapshot(zfs_name, filesystem, recursive=False):
         arguments.append('-r')
     snapshot = filesystem + '@' + zfs_name
     arguments.append(snapshot)
+    program = zfs_batch_program(snapshot)
+    if program is not None and not recursive:
+        program.snapshot(snapshot)
+        return snapshot
     if zfs('snapshot', arguments) == 0:
         return snapshot
     return None
 
-def zfs_destroy(zfs_name, recursive=False, synchronous=True):
+def zfs_destroy(zfs_name, recursive=False, synchronous=True, batch=False):
+    # With batch, the destroy may be deferred to the end of the current
+    # zfs_batch(), only for datasets that are not mounted
+    if batch:
+        program = zfs_batch_program(zfs_name)
+        if program is not None:
+            zfs_cache.invalidate(zfs_name)
+            program.destroy(zfs_name, recursive)
+            return 0
+    zfs_cache.invalidate(zfs_name)
+    return zfs('destroy', destroy_arguments(zfs_name, recursive, synchronous))
+
+def destroy_arguments(zfs_name, recursive=False, synchronous=True):
     arguments = []
     if recursive:
         arguments.append('-r')
     if synchronous:
         arguments.append('-s')
     arguments.append(zfs_name)
-    return zfs('destroy', arguments)
+    return arguments
 
-def zfs_send(last_snapshot, target_file_path, first_snapshot=None, recursive=False):
+def send_arguments(last_snapshot, first_snapshot=None, recursive=False, intermediary=True):
+    # Without intermediary the incremental stream only has last_snapshot (-i)
     arguments = []
     if recursive:
         arguments.append('-R')
     if first_snapshot is not None:
-        arguments += ['-I', first_snapshot]
+        arguments += ['-I' if intermediary else '-i', first_snapshot]
     arguments.append(last_snapshot)
+    return arguments
+
+def zfs_send(last_snapshot, target_file_path, first_snapshot=None, recursive=False, 
+        intermediary=True):
+    arguments = send_arguments(last_snapshot, first_snapshot, recursive, intermediary)
     with open(target_file_path,'wb') as target_file:
         return zfs('send', arguments, stdout=target_file)
 
+def zfs_send_stream(last_snapshot, target_file, first_snapshot=None, recursive=False, 
+        intermediary=True):
+    # zfs_send to a file object without file descriptor (a BlobWriter)
+    arguments = send_arguments(last_snapshot, first_snapshot, recursive, intermediary)
+    process = _zfs('send', arguments, stdout=subprocess.PIPE)
+    try:
+        shutil.copyfileobj(process.stdout, target_file, 1 << 20)
+    finally:
+        process.stdout.close()
+    return process.wait()
+
+def receive_options(origin=None, properties=None):
+    # An incremental stream is received as a clone of origin, the snapshot
+    # it was sent from (same guid)
+    options = []
+    if origin is not None:
+        options.append('origin=' + origin)
+    if properties is not None:
+        options += ['%s=%s' % (property_name, value) for property_name, value in properties.items()]
+    return options
+
+def zfs_receive(zfs_name, source_file_path, origin=None, properties=None):
+    zfs_cache.invalidate(zfs_name)
+    with open(source_file_path, 'rb') as source_file:
+        return zfs('receive', [zfs_name], receive_options(origin, properties), stdin=source_file)
+
+def zfs_receive_stream(zfs_name, source_file, origin=None, properties=None):
+    # zfs_receive from a file object without file descriptor (a decompressing
+    # reader). A failed receive stops reading, its return code tells why.
+    zfs_cache.invalidate(zfs_name)
+    process = _zfs('receive', [zfs_name], receive_options(origin, properties), 
+        stdin=subprocess.PIPE)
+    try:
+        shutil.copyfileobj(source_file, process.stdin, 1 << 20)
+    except BrokenPipeError:
+        pass
+    except:
+        # Nothing half received is kept
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    return process.wait()
+
 def zfs_list(zfs_name=None, zfs_type=None, recursive=False,\
         properties=['name', 'used', 'avail', 'refer', 'mountpoint']):
-    cmd = ['/usr/sbin/zfs', 'list', '-Hp']
+    zfs_batch_flush()
+    cmd = [zfs_settings['command'], 'list', '-Hp']
     if recursive:
         cmd.append('-r')   
     if zfs_type is not None and zfs_type in ['all', 'filesystem', 
@@ -222,4 +544,81 @@ def zfs_diff(final_snapshot, origin_snapshot=None, include_file_types=False, rec
 
 def zfs_rename(original_zfs_name, new_zfs_name):
     arguments = [original_zfs_name, new_zfs_name]
-    return zfs('rename', arguments)
+    returncode = zfs('rename', arguments)
+    if returncode == 0:
+        zfs_cache.rename(original_zfs_name, new_zfs_name)
+    else:
+        zfs_cache.invalidate(original_zfs_name)
+    return returncode
+
+# asyncio versions, for the async api. They do not take part in zfs_batch().
+
+async def async_zfs(command, arguments=None, options=None):
+    zfs_batch_flush()
+    (returncode, output, error) = await run_process(zfs_command(command, arguments, options))
+    return returncode
+
+async def async_zfs_create(zfs_name, parent=None, mountpoint=None, compression=None):
+    filesystem = zfs_name
+    if parent is not None:
+        filesystem = parent + '/' + zfs_name
+    zfs_cache.invalidate(filesystem)
+    if await async_zfs('create', [filesystem], create_options(mountpoint, compression)) == 0:
+        return filesystem
+    return None
+
+async def async_zfs_clone(zfs_name, snapshot, parent=None, mountpoint=None, properties=None):
+    filesystem = zfs_name
+    if parent is not None:
+        filesystem = parent + '/' + zfs_name
+    zfs_cache.invalidate(filesystem)
+    if await async_zfs('clone', [snapshot, filesystem], 
+            create_options(mountpoint, properties=properties)) == 0:
+        return filesystem
+    return None
+
+async def async_zfs_set(zfs_name, readonly=None, mountpoint=None, mounted=None):
+    for option in set_options(readonly, mountpoint, mounted):
+        if option.startswith('mountpoint='):
+            zfs_cache.invalidate(zfs_name)
+        if await async_zfs('set', [option, zfs_name]) == 0 and option.startswith('mountpoint='):
+            zfs_cache.update(zfs_name, 'mountpoint', value_convert('mountpoint', str(mountpoint)))
+
+async def async_zfs_get(zfs_name, property_name, cached=True):
+    if property_name == 'all':
+        raise NotImplementedError()
+    if cached:
+        (found, value) = zfs_cache.get(zfs_name, property_name)
+        if found:
+            return value
+    zfs_batch_flush()
+    cmd = zfs_command('get', ['-Hp', property_name, zfs_name])
+    (returncode, output, error) = await run_process(cmd, stdout=subprocess.PIPE, 
+        stderr=subprocess.DEVNULL)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output)
+    value = value_convert(property_name, output.decode('utf-8').split('\t')[2])
+    zfs_cache.update(zfs_name, property_name, value)
+    return value
+
+async def async_zfs_snapshot(zfs_name, filesystem, recursive=False):
+    arguments = []
+    if recursive:
+        arguments.append('-r')
+    snapshot = filesystem + '@' + zfs_name
+    arguments.append(snapshot)
+    if await async_zfs('snapshot', arguments) == 0:
+        return snapshot
+    return None
+
+async def async_zfs_destroy(zfs_name, recursive=False, synchronous=True):
+    zfs_cache.invalidate(zfs_name)
+    return await async_zfs('destroy', destroy_arguments(zfs_name, recursive, synchronous))
+
+async def async_zfs_rename(original_zfs_name, new_zfs_name):
+    returncode = await async_zfs('rename', [original_zfs_name, new_zfs_name])
+    if returncode == 0:
+        zfs_cache.rename(original_zfs_name, new_zfs_name)
+    else:
+        zfs_cache.invalidate(original_zfs_name)
+    return returncode
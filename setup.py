@@ -68,7 +68,7 @@ if __name__ == "__main__":
         author_email=AUTHOR_EMAIL,
         maintainer=AUTHOR,
         maintainer_email=AUTHOR_EMAIL,
-        packages=find_packages(), 
+        packages=find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']), 
         include_package_data=True,
         zip_safe=False,
         url=PACKAGE_URL,
@@ -80,6 +80,10 @@ if __name__ == "__main__":
         setup_requires=["pytest-runner"],
         #tests_require=TESTS_REQUIRES,
         install_requires=INSTALL_REQUIRES,
+        extras_require={
+            # driver.<type>.layer_compression = 'zstd'
+            'zstd': ['zstandard'],
+        },
         entry_points={
             'console_scripts': [
             ]
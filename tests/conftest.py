@@ -0,0 +1,35 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from oci_api import oci_config
+from oci_api.util import Singleton
+
+def reload_driver():
+    # A new Driver (and Database) loaded from the store, as another process
+    # would see it
+    from oci_api.graph import Driver
+    Singleton._instances.clear()
+    return Driver()
+
+@pytest.fixture(params=['json', 'sqlite'])
+def driver(request, tmp_path, monkeypatch):
+    # Empty store of the directory driver in a temporary directory, with
+    # either metadata store. Compactions of driver.journal happen often.
+    monkeypatch.setitem(oci_config['global'], 'path', str(tmp_path.joinpath('oci')))
+    monkeypatch.setitem(oci_config['global'], 'metadata', request.param)
+    monkeypatch.setitem(oci_config['driver'], 'type', 'directory')
+    monkeypatch.setitem(oci_config['driver']['journal'], 'max_records', 16)
+    yield reload_driver()
+    Singleton._instances.clear()
@@ -0,0 +1,146 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# ChangesetExtractor with a thread pool must leave the same tree as the
+# extraction in the calling thread only
+
+import io
+import os
+import stat
+import random
+import tarfile
+import pytest
+from oci_api import oci_config
+from oci_api.graph.changeset import ChangesetExtractor
+
+MTIME = 1600000000
+
+def add_directory(tar_file, name, mode=0o755):
+    tar_info = tarfile.TarInfo(name)
+    tar_info.type = tarfile.DIRTYPE
+    tar_info.mode = mode
+    tar_info.mtime = MTIME
+    tar_file.addfile(tar_info)
+
+def add_file(tar_file, name, data, mode=0o644):
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(data)
+    tar_info.mode = mode
+    tar_info.mtime = MTIME
+    tar_file.addfile(tar_info, io.BytesIO(data))
+
+def add_link(tar_file, name, target, type=tarfile.SYMTYPE):
+    tar_info = tarfile.TarInfo(name)
+    tar_info.type = type
+    tar_info.linkname = target
+    tar_info.mtime = MTIME
+    tar_file.addfile(tar_info)
+
+def make_changeset(build):
+    changeset = io.BytesIO()
+    with tarfile.open(fileobj=changeset, mode='w') as tar_file:
+        build(tar_file)
+    return changeset.getvalue()
+
+def lower_layer(tar_file):
+    for name in ['a', 'a/sub', 'opaque', 'opaque/sub', 'gone_directory', 'replaced']:
+        add_directory(tar_file, name)
+    for name in ['a/keep', 'a/old', 'a/sub/x', 'opaque/old', 'opaque/sub/y', 'gone',
+            'gone_directory/z', 'replaced/w', 'to_directory']:
+        add_file(tar_file, name, name.encode())
+
+def upper_layer(tar_file):
+    generator = random.Random(0)
+    add_directory(tar_file, 'a', 0o750)
+    add_file(tar_file, 'a/.wh.old', b'')
+    add_file(tar_file, '.wh.gone', b'')
+    add_file(tar_file, '.wh.gone_directory', b'')
+    add_file(tar_file, 'a/keep', b'new contents', 0o600)
+    # Entries of the changeset before and after the opaque whiteout are kept
+    add_directory(tar_file, 'opaque', 0o700)
+    add_file(tar_file, 'opaque/before', b'before')
+    add_file(tar_file, 'opaque/.wh..wh..opq', b'')
+    add_file(tar_file, 'opaque/after', b'after')
+    # A file replaced by a directory and the other way round
+    add_file(tar_file, 'replaced', b'now a file', 0o640)
+    add_directory(tar_file, 'to_directory', 0o711)
+    add_file(tar_file, 'to_directory/v', b'v')
+    add_directory(tar_file, 'files', 0o755)
+    for index in range(200):
+        size = generator.choice([0, 10, 1000, 5000, 20000])
+        mode = generator.choice([0o644, 0o600, 0o755, 0o444])
+        add_file(tar_file, 'files/%03i' % index, generator.randbytes(size), mode)
+        # Hardlinks right after their target, small (written by the threads)
+        # and large (written by the calling thread) ones
+        if index % 20 == 0:
+            add_link(tar_file, 'files/%03i.link' % index, 'files/%03i' % index, tarfile.LNKTYPE)
+    add_link(tar_file, 'files/099.link', 'files/099', tarfile.LNKTYPE)
+    add_link(tar_file, 'symlink', 'a/keep')
+    add_link(tar_file, 'dangling', 'missing')
+    # A file written twice, the second one wins
+    add_file(tar_file, 'files/000', b'written again')
+    add_directory(tar_file, 'files/directory', 0o555)
+
+def extract(path, changesets, threads):
+    os.mkdir(path)
+    size = 0
+    for changeset in changesets:
+        with tarfile.open(fileobj=io.BytesIO(changeset), mode='r|') as tar_file:
+            size = ChangesetExtractor(path, threads).extract(tar_file)
+    return size
+
+def tree(path):
+    # relative path -> type, mode, mtime, contents or link target, and the
+    # groups of hardlinked paths
+    entries = {}
+    inodes = {}
+    for directory, directory_names, file_names in os.walk(path):
+        for name in directory_names + file_names:
+            file_path = os.path.join(directory, name)
+            relative_path = os.path.relpath(file_path, path)
+            file_stat = os.lstat(file_path)
+            contents = None
+            if stat.S_ISREG(file_stat.st_mode):
+                with open(file_path, 'rb') as entry_file:
+                    contents = entry_file.read()
+                inodes.setdefault(file_stat.st_ino, []).append(relative_path)
+            elif stat.S_ISLNK(file_stat.st_mode):
+                contents = os.readlink(file_path)
+            entries[relative_path] = (stat.S_IFMT(file_stat.st_mode), stat.S_IMODE(file_stat.st_mode),
+                file_stat.st_mtime if not stat.S_ISLNK(file_stat.st_mode) else None, contents)
+    links = sorted(sorted(paths) for paths in inodes.values() if len(paths) > 1)
+    return (entries, links)
+
+@pytest.mark.parametrize('threads', [2, 8])
+def test_parallel_extraction(tmp_path, monkeypatch, threads):
+    # Small limits, most files go through the threads and the read ahead is
+    # often full
+    monkeypatch.setitem(oci_config['global'], 'extraction', 
+        {'max_file_size': 8192, 'max_pending_size': 32768})
+    changesets = [make_changeset(lower_layer), make_changeset(upper_layer)]
+    serial_size = extract(tmp_path.joinpath('serial'), changesets, 1)
+    parallel_size = extract(tmp_path.joinpath('parallel'), changesets, threads)
+    (entries, links) = tree(tmp_path.joinpath('serial'))
+    assert (entries, links) == tree(tmp_path.joinpath('parallel'))
+    assert parallel_size == serial_size
+
+    assert 'a/old' not in entries and 'gone' not in entries and 'gone_directory' not in entries
+    assert sorted(name for name in entries if name.startswith('opaque/')) == ['opaque/after', 'opaque/before']
+    assert entries['a'][1] == 0o750 and entries['a'][2] == MTIME
+    assert entries['a/keep'][1:] == (0o600, MTIME, b'new contents')
+    assert entries['files/000'][3] == b'written again'
+    assert stat.S_ISREG(entries['replaced'][0]) and stat.S_ISDIR(entries['to_directory'][0])
+    assert entries['symlink'][3] == 'a/keep'
+    assert ['files/099', 'files/099.link'] in links
+    assert ['files/020', 'files/020.link'] in links
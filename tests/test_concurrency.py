@@ -0,0 +1,145 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Many threads creating, cloning, mounting, committing and removing through
+# one Driver, the store loaded again afterwards must match the memory of the
+# driver and the directories and blobs on disk.
+
+import os
+import pathlib
+import threading
+from oci_api import oci_config
+from oci_api.graph.directory_filesystem import filesystems_path
+from .conftest import reload_driver
+
+THREADS = 8
+ITERATIONS = 4
+
+def driver_state(driver):
+    filesystems = sorted(
+        (filesystem.id, filesystem.layer.id if filesystem.layer is not None else None, 
+            filesystem.container_id)
+            for filesystem in driver.filesystems.values()
+    )
+    layers = sorted(
+        (layer.id, layer.diff_id, layer.filesystem.id, tuple(sorted(layer.images)))
+            for layer in driver.layers.values()
+    )
+    return (filesystems, layers)
+
+def work(driver, shared_layer, containers_path, index):
+    for iteration in range(ITERATIONS):
+        name = '%i-%i' % (index, iteration)
+        # A layer of its own
+        filesystem = driver.create_filesystem()
+        filesystem.path.joinpath('file').write_text(name)
+        layer = driver.create_layer(filesystem)
+        # A container on the shared layer, committed
+        clone = driver.create_filesystem(shared_layer)
+        container_id = 'container-' + name
+        container_path = containers_path.joinpath(container_id)
+        driver.mount_filesystem(clone, container_id, container_path)
+        container_path.joinpath(name).write_text(name)
+        driver.unmount_filesystem(container_id)
+        child_layer = driver.create_layer(clone)
+        driver.add_image_reference(shared_layer, 'image-' + name)
+        # Every other iteration removes what it made
+        if iteration % 2 == 1:
+            driver.remove_image_reference(shared_layer, 'image-' + name)
+            driver.remove_layer(child_layer)
+            driver.remove_layer(layer)
+    # A container left mounted
+    clone = driver.create_filesystem(shared_layer)
+    driver.mount_filesystem(clone, 'container-%i' % index, containers_path.joinpath('container-%i' % index))
+
+def test_concurrent_driver(driver, tmp_path):
+    filesystem = driver.create_filesystem()
+    filesystem.path.joinpath('shared').write_text('shared')
+    shared_layer = driver.create_layer(filesystem)
+    containers_path = tmp_path.joinpath('containers')
+    containers_path.mkdir()
+
+    errors = []
+    def run(index):
+        try:
+            work(driver, shared_layer, containers_path, index)
+        except BaseException as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    state = driver_state(driver)
+    (filesystems, layers) = state
+    # Shared layer, and per thread: 2 layers of every kept iteration
+    assert len(layers) == 1 + THREADS * ITERATIONS
+    # Shared layer filesystem, the filesystem of every layer and the mounted clones
+    assert len(filesystems) == 1 + THREADS * ITERATIONS + THREADS
+    assert len(driver.get_child_filesystems(shared_layer)) == THREADS * ITERATIONS // 2 + THREADS
+    assert len(driver.get_layer(shared_layer.id).images) == THREADS * ITERATIONS // 2
+    for index in range(THREADS):
+        assert driver.get_filesystem_by_container_id('container-%i' % index).is_mounted()
+
+    assert driver_state(reload_driver()) == state
+    # Nothing left behind on disk, nothing missing
+    filesystem_ids = set(filesystem_id for (filesystem_id, layer_id, container_id) in filesystems)
+    assert set(os.listdir(filesystems_path())) == filesystem_ids
+    layers_path = pathlib.Path(oci_config['global']['path'], 'layers')
+    assert set(os.listdir(layers_path)) == set(layer_id for (layer_id, diff_id, filesystem_id, images) in layers)
+
+def test_records_of_open_transaction(driver, tmp_path, monkeypatch):
+    # Changes made by other threads while a transaction is open, and the
+    # compactions they trigger, must not persist the changes of the
+    # transaction before its records or out of order
+    monkeypatch.setitem(oci_config['driver']['journal'], 'max_records', 4)
+    filesystem = driver.create_filesystem()
+    layer = driver.create_layer(filesystem)
+    started = threading.Event()
+    finish = threading.Event()
+    created = []
+    def run():
+        with driver.transaction():
+            driver.add_image_reference(layer, 'image-a')
+            created.append(driver.create_filesystem(layer))
+            started.set()
+            finish.wait()
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait()
+    for _ in range(6):
+        driver.create_filesystem()
+    driver.mount_filesystem(created[0], 'container-b', tmp_path.joinpath('container-b'))
+    finish.set()
+    thread.join()
+    assert driver_state(reload_driver()) == driver_state(driver)
+
+def test_failed_transaction(driver, tmp_path):
+    # Image references are rolled back, the filesystems made on disk are kept
+    filesystem = driver.create_filesystem()
+    layer = driver.create_layer(filesystem)
+    driver.add_image_reference(layer, 'image-a')
+    try:
+        with driver.transaction():
+            driver.remove_image_reference(layer, 'image-a')
+            driver.add_image_reference(layer, 'image-b')
+            clone = driver.create_filesystem(layer)
+            raise KeyError()
+    except KeyError:
+        pass
+    assert driver.get_layer(layer.id).images == ['image-a']
+    assert driver.get_filesystem(clone.id).path.is_dir()
+    assert driver_state(reload_driver()) == driver_state(driver)
@@ -0,0 +1,89 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Driver lookups and save() go through the indexes (diff id, container id,
+# child layer, child filesystems), their cost grows with the store size and
+# not with its square: a store k times larger takes about k times longer.
+
+import time
+import hashlib
+import pytest
+from oci_api import oci_config
+from .conftest import reload_driver
+
+SIZE = 2000
+FACTOR = 8
+# Linear work gives a ratio near FACTOR, a scan per item FACTOR ** 2
+MAX_RATIO = FACTOR * 3
+
+def digest(name):
+    return hashlib.sha256(name.encode()).hexdigest()
+
+def fill(driver, size):
+    # A chain of size layers, each committed from a clone of the one below
+    # it, and a container cloned from every layer
+    filesystem_rows = []
+    layer_rows = []
+    parent_id = None
+    for index in range(size):
+        filesystem_id = 'filesystem-%i' % index
+        filesystem_rows.append((filesystem_id, parent_id, None))
+        descriptor = {
+            'mediaType': 'application/vnd.oci.image.layer.v1.tar+gzip',
+            'digest': 'sha256:' + digest('layer-%i' % index),
+            'size': 1024
+        }
+        layer_rows.append((descriptor, digest('diff-%i' % index), filesystem_id, 2048, ['image']))
+        parent_id = digest('layer-%i' % index)
+        filesystem_rows.append(('container-filesystem-%i' % index, parent_id, 'container-%i' % index))
+    with driver.mutex:
+        driver.load_rows(filesystem_rows, layer_rows)
+
+def best_time(function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def lookups(driver):
+    for layer in list(driver.layers.values()):
+        assert driver.get_layer_by_diff_id(layer.diff_id) is layer
+        assert len(driver.get_child_filesystems(layer)) in (1, 2)
+    for filesystem in list(driver.filesystems.values()):
+        if filesystem.container_id is not None:
+            assert driver.get_filesystem_by_container_id(filesystem.container_id) is filesystem
+
+def measure(driver, size, monkeypatch):
+    fill(driver, size)
+    assert len(driver.layers) == size
+    assert len(driver.filesystems) == 2 * size
+    save_time = best_time(driver.save)
+    # Nothing else writes the store, the check for changes of other processes
+    # (a stat and a file lock per call) would hide the cost of the lookups
+    monkeypatch.setattr(driver, 'refresh', lambda: None)
+    return (best_time(lambda: lookups(driver)), save_time)
+
+# save() writes driver.json, the sqlite store writes records only
+@pytest.mark.parametrize('driver', ['json'], indirect=True)
+def test_linear_scaling(driver, tmp_path, monkeypatch):
+    (small_lookups, small_save) = measure(driver, SIZE, monkeypatch)
+    monkeypatch.setitem(oci_config['global'], 'path', str(tmp_path.joinpath('large')))
+    large_driver = reload_driver()
+    (large_lookups, large_save) = measure(large_driver, SIZE * FACTOR, monkeypatch)
+    assert large_lookups / small_lookups < MAX_RATIO
+    assert large_save / small_save < MAX_RATIO
+    # The saved store is complete
+    assert len(reload_driver().layers) == SIZE * FACTOR
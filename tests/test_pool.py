@@ -0,0 +1,54 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Pooled filesystems handed out by the Driver of one process while another
+# one, with an older list of the pool, takes and removes them
+
+from oci_api import oci_config
+from oci_api.util import Singleton
+from oci_api.graph import Driver
+from oci_api.graph.filesystem import get_filesystem_class
+from .conftest import reload_driver
+
+def other_process_driver():
+    # A second Driver on the same store, the singleton is left alone
+    return super(Singleton, Driver).__call__()
+
+def test_pool_across_processes(driver, monkeypatch):
+    monkeypatch.setitem(oci_config['driver']['pool'], 'size', 2)
+    driver = reload_driver()
+    filesystem = driver.create_filesystem()
+    layer = driver.create_layer(filesystem)
+    pooled_ids = [get_filesystem_class().create(layer, pooled=True).id for _ in range(2)]
+
+    # Takes one and keeps the other in its list
+    first = driver.create_filesystem(layer)
+    assert first.id in pooled_ids
+    assert driver.pool.thread is None
+    (other_id,) = set(pooled_ids) - {first.id}
+    assert driver.pool.available[layer.id] == [other_id]
+
+    # Another process takes and removes the other one
+    other_driver = other_process_driver()
+    other = other_driver.create_filesystem(layer)
+    assert other.id == other_id
+    assert get_filesystem_class().list_pooled() == {}
+    other_driver.remove_filesystem(other)
+
+    # The stale entry is not registered, a new clone is made
+    second = driver.create_filesystem(layer)
+    assert second.id not in pooled_ids
+    assert second.path.is_dir()
+    assert other_id not in driver.filesystems
+    assert sorted(reload_driver().filesystems) == sorted(driver.filesystems)
@@ -0,0 +1,118 @@
+# Copyright 2020, Guillermo Adrián Molina
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# zfs_batch() against a stub zfs executable that records its command lines
+# and the channel programs it is given
+
+import sys
+import json
+import pytest
+from oci_api.util.zfs import zfs_settings, zfs_batch, zfs_batch_program, zfs_snapshot, \
+    zfs_destroy, zfs_set, ZFSError, ZFS_PROGRAM_HEADER
+
+STUB = '''#!%s
+import sys, json
+arguments = sys.argv[1:]
+program = None
+if arguments[0] == 'program':
+    with open(arguments[2]) as program_file:
+        program = program_file.read()
+with open(%r, 'a') as calls_file:
+    calls_file.write(json.dumps({'arguments': arguments, 'program': program}) + '\\n')
+sys.exit(%i)
+'''
+
+@pytest.fixture
+def zfs_stub(tmp_path, monkeypatch):
+    # Returns a function making the stub exit with the given status, and
+    # returning the calls recorded so far
+    calls_path = tmp_path.joinpath('calls')
+    command_path = tmp_path.joinpath('zfs')
+    def stub(status=0):
+        command_path.write_text(STUB % (sys.executable, str(calls_path), status))
+        command_path.chmod(0o755)
+        if not calls_path.exists():
+            return []
+        with calls_path.open() as calls_file:
+            return [json.loads(line) for line in calls_file]
+    stub()
+    monkeypatch.setitem(zfs_settings, 'command', str(command_path))
+    monkeypatch.setitem(zfs_settings, 'channel_programs', True)
+    return stub
+
+def test_batch_program(zfs_stub):
+    with zfs_batch():
+        assert zfs_snapshot('diff', 'rpool/oci/a') == 'rpool/oci/a@diff'
+        assert zfs_destroy('rpool/oci/b', batch=True) == 0
+        assert zfs_destroy('rpool/oci/c', recursive=True, batch=True) == 0
+        zfs_batch_program('rpool/oci/d').set_user_property('rpool/oci/d', 'oci:pool', 'layer')
+        # Nothing runs until the end of the batch
+        assert zfs_stub() == []
+    (call,) = zfs_stub()
+    arguments = call['arguments']
+    assert arguments[:2] == ['program', 'rpool']
+    assert arguments[3:] == ['rpool/oci/a@diff', 'rpool/oci/b', 'rpool/oci/c', 
+        'rpool/oci/d', 'oci:pool', 'layer']
+    # Every check before any change
+    assert call['program'] == ZFS_PROGRAM_HEADER + '\n'.join([
+        'ok(zfs.check.snapshot(argv[1]), "snapshot", argv[1])',
+        'ok(zfs.check.destroy(argv[2]), "destroy", argv[2])',
+        'ok(zfs.check.set_prop(argv[4], argv[5], argv[6]), "set", argv[4])',
+        'ok(zfs.sync.snapshot(argv[1]), "snapshot", argv[1])',
+        'ok(zfs.sync.destroy(argv[2]), "destroy", argv[2])',
+        'destroy_recursive(argv[3])',
+        'ok(zfs.sync.set_prop(argv[4], argv[5], argv[6]), "set", argv[4])'
+    ]) + '\n'
+
+def test_batch_order(zfs_stub):
+    # Another zfs command runs the operations collected before it, unmounted
+    # destroys only are batched
+    with zfs_batch():
+        zfs_snapshot('diff', 'rpool/oci/a')
+        zfs_set('rpool/oci/a', readonly=True)
+        zfs_destroy('rpool/oci/a')
+    commands = [call['arguments'] for call in zfs_stub()]
+    assert [arguments[0] for arguments in commands] == ['program', 'set', 'destroy']
+    assert commands[0][3:] == ['rpool/oci/a@diff']
+
+def test_batch_exception(zfs_stub):
+    # The collected operations run, the exception goes on
+    with pytest.raises(KeyError):
+        with zfs_batch():
+            zfs_snapshot('diff', 'rpool/oci/a')
+            raise KeyError()
+    (call,) = zfs_stub()
+    assert call['arguments'][3:] == ['rpool/oci/a@diff']
+
+def test_batch_failure(zfs_stub):
+    zfs_stub(status=1)
+    with pytest.raises(ZFSError):
+        with zfs_batch():
+            zfs_snapshot('diff', 'rpool/oci/a')
+            zfs_destroy('rpool/oci/b', batch=True)
+    (call,) = zfs_stub(status=0)
+    # A failed program is not submitted again
+    with zfs_batch():
+        zfs_snapshot('diff', 'rpool/oci/c')
+    calls = zfs_stub()
+    assert len(calls) == 2
+    assert calls[1]['arguments'][3:] == ['rpool/oci/c@diff']
+
+def test_no_channel_programs(zfs_stub, monkeypatch):
+    monkeypatch.setitem(zfs_settings, 'channel_programs', False)
+    with zfs_batch():
+        zfs_snapshot('diff', 'rpool/oci/a')
+        zfs_destroy('rpool/oci/b', batch=True)
+    commands = [call['arguments'] for call in zfs_stub()]
+    assert commands == [['snapshot', 'rpool/oci/a@diff'], ['destroy', '-s', 'rpool/oci/b']]